@@ -10,6 +10,17 @@ DATABASE = "elogy.db"  # !!!Do not use /tmp for anything beyond testing!!!
 # The folder where all uploaded files will be stored.
 UPLOAD_FOLDER = '/tmp/elogy'  # !!!Again, /tmp is a bad choice!!!
 
+# Where PDF exports are kept for a while, so that they can be reused.
+# Defaults to the "exports" folder inside UPLOAD_FOLDER.
+# EXPORT_FOLDER = '/tmp/elogy-exports'
+
+# How to make PDF exports; "reportlab" (the default, if the package is
+# installed) or "pdfkit" (which needs the "wkhtmltopdf" program).
+# PDF_EXPORT_BACKEND = "reportlab"
+
+# How many processes may render PDFs with reportlab at the same time.
+# PDF_EXPORT_PROCESSES = 2
+
 # Optional LDAP config. Used to autocomplete author names.
 # Requires the "pyldap" package. If not set, elogy will try
 # to fall back to looking up users through the local system.
@@ -31,8 +42,10 @@ def new_entry(data):
     # scripts to accidentally modify the database...
 
     # It's OK to do potentially slow stuff here such as network
-    # calls, since actions are run in a thread. But make sure it
-    # terminates sooner or later or you will have a resource leak!
+    # calls, since actions are run in the background. But make sure it
+    # terminates within a minute, or it will be considered failed.
+    # Failed actions are retried a few times, so take care not to
+    # e.g. send the same email twice.
 
     # Some example actions:
     if "Mailto" in entry["attributes"]:
@@ -64,5 +77,10 @@ DATABASE = {
     "name": DATABASE,
     "engine": "playhouse.sqlite_ext.SqliteExtDatabase",
     "threadlocals": True,
-    "journal_mode": "WAL"
+    "journal_mode": "WAL",
+    # SQLite settings, overriding the defaults in elogy.db.PRAGMAS. See
+    # https://www.sqlite.org/pragma.html
+    "pragmas": {
+        # "cache_size": -64000,  # KiB
+    }
 }
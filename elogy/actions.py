@@ -5,11 +5,12 @@ Actions themselves are presumably defined in the config file.
 
 from functools import partial
 import logging
-from threading import Thread
 
 from flask import current_app
 from blinker import Namespace
 
+from . import jobs
+
 
 signals = Namespace()
 
@@ -21,23 +22,35 @@ new_logbook = signals.signal("new_logbook")
 edit_logbook = signals.signal("edit_logbook")
 
 
+# Actions are run by the background workers, so that e.g. a slow mail
+# server won't hang the request. They are stored in the database until
+# they have been run, in case the server is restarted.
+ACTION_TIMEOUT = 60  # seconds
+ACTION_RETRIES = 3
+
+
 def on_signal(signal_name, *args, **kwargs):
-    "Find and run any action configured for the signal."
+    "Queue up any action configured for the signal."
     action_config = current_app.config.get("ACTIONS", {})
     action = action_config.get(signal_name)
     if action:
-        logging.debug("Running configured action for '%s'", signal_name)
+        logging.debug("Queueing configured action for '%s'", signal_name)
         try:
-            # The action is run in a thread, to prevent it from hanging
-            # the whole app, e.g. if it does some slow network stuff.
-            # This is a bit naive, a flood of actions might create a
-            # ridiculous number of threads. Maybe better to use a worker
-            # pool and a queue or something?
-            Thread(target=action, args=args, kwargs=kwargs).run()
+            jobs.queue.submit("action", signal_name=signal_name,
+                              args=args, kwargs=kwargs)
         except Exception as e:
-            logging.error("Caught exception in action for '%s': %s",
+            logging.error("Could not queue action for '%s': %s",
                           signal_name, e)
 
 
+@jobs.handler("action", timeout=ACTION_TIMEOUT, retries=ACTION_RETRIES)
+def run_action(signal_name, args, kwargs):
+    "Run the action configured for the signal"
+    action = current_app.config.get("ACTIONS", {}).get(signal_name)
+    if action:
+        logging.debug("Running configured action for '%s'", signal_name)
+        action(*args, **kwargs)
+
+
 for name, signal in signals.items():
     signal.connect(partial(on_signal, name), weak=False)
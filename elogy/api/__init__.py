@@ -1,4 +1,9 @@
 from functools import wraps
+from hashlib import sha1
+
+from flask import current_app, request
+from flask_restful.utils import unpack
+from werkzeug.wrappers import BaseResponse
 
 
 def send_signal(signal):
@@ -13,3 +18,40 @@ def send_signal(signal):
             return result
         return decorated_function
     return decorator
+
+
+# Old revisions don't change, but they are shown together with some
+# current information (e.g. followups), so they are not cached forever.
+REVISION_MAX_AGE = 3600  # seconds
+
+
+def cached(get_state):
+    """Decorator that makes a view function support conditional
+    requests. The get_state function is called with the same keyword
+    arguments as the view, and should cheaply return something that
+    changes whenever the response would. Its hash is used as ETag, and
+    if the client already has that version we skip the view entirely."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            state = [request.full_path, get_state(**kwargs)]
+            etag = sha1(repr(state).encode()).hexdigest()
+            if kwargs.get("revision_n") is not None:
+                cache_control = "max-age={}".format(REVISION_MAX_AGE)
+            else:
+                cache_control = "no-cache"  # always check with us first
+            if request.if_none_match.contains(etag):
+                result = current_app.response_class(status=304)
+            else:
+                result = f(*args, **kwargs)
+            if isinstance(result, BaseResponse):
+                result.set_etag(etag)
+                result.headers["Cache-Control"] = cache_control
+                return result
+            data, code, headers = unpack(result)
+            headers = dict(headers or {})
+            headers["ETag"] = '"{}"'.format(etag)
+            headers["Cache-Control"] = cache_control
+            return data, code, headers
+        return decorated_function
+    return decorator
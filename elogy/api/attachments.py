@@ -5,7 +5,7 @@ from flask import jsonify, url_for
 from flask_restful import Resource, reqparse
 from werkzeug import FileStorage
 
-from ..attachments import save_attachment
+from ..attachments import save_attachment, request_thumbnail
 from ..utils import get_utc_datetime
 
 
@@ -38,6 +38,7 @@ class AttachmentsResource(Resource):
                                          entry_id, metadata,
                                          embedded=args["embedded"])
             attachment.save()
+            request_thumbnail(attachment)
         return jsonify(id=attachment.id,
                        location=url_for("get_attachment",
                                         path=attachment.path),
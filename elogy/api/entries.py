@@ -1,16 +1,22 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import binascii
+import json
 import logging
 
-from flask import request, send_file
+from flask import request, Response, stream_with_context
 from flask_restful import Resource, marshal, marshal_with, abort
 from webargs.fields import (Integer, Str, Boolean, Dict, List,
                             Nested, Email, LocalDateTime)
 from webargs.flaskparser import use_args
 
-from ..db import Entry, Logbook, EntryLock
-from ..attachments import handle_img_tags
-from ..export import export_entries_as_pdf
+from ..db import db, Entry, Logbook, EntryLock
+from ..attachments import (handle_img_tags, request_thumbnail,
+                           remove_attachment_file)
+from ..events import record_entry_events
+from ..export import (export_entries_as_ndjson, export_entries_as_csv,
+                      iter_entries)
 from ..actions import new_entry, edit_entry
-from . import fields, send_signal
+from . import fields, send_signal, cached
 
 
 entry_args = {
@@ -34,10 +40,54 @@ entry_args = {
 }
 
 
+def prepare_new_entry(logbook, args):
+    """Get the arguments ready for creating an entry in the logbook.
+    Returns any inline images, extracted as attachments."""
+    if args.get("content"):
+        content_type = args["content_type"]
+        if content_type.startswith("text/html"):
+            # extract any inline images as attachments
+            args["content"], inline_attachments = handle_img_tags(
+                args["content"], timestamp=args.get("created_at"))
+        else:
+            inline_attachments = []
+    else:
+        inline_attachments = []
+    args["logbook"] = logbook
+    # make sure the attributes are of proper types
+    if "attributes" in args:
+        attributes = {}
+        for attr_name, attr_value in args["attributes"].items():
+            try:
+                converted_value = logbook.convert_attribute(attr_name,
+                                                            attr_value)
+                attributes[attr_name] = converted_value
+            except ValueError as e:
+                logging.warning(
+                    "Discarding attribute %s with value %r; %s",
+                    attr_name, attr_value, e)
+                # TODO: return a helpful error if this fails?
+        args["attributes"] = attributes
+    if args.get("follows_id"):
+        # don't allow pinning followups, that makes no sense
+        args["pinned"] = False
+    return inline_attachments
+
+
+def entry_state(entry_id, logbook_id=None, revision_n=None):
+    "Whatever is needed to tell if the entry has changed"
+    entry = Entry.get(Entry.id == entry_id)
+    lock = entry.lock
+    # the change count covers followups, attachments, ...
+    return (entry.revision_n, entry.last_changed_at,
+            entry.logbook.change_count, lock and lock.id)
+
+
 class EntryResource(Resource):
 
     "Handle requests for a single entry"
 
+    @cached(entry_state)
     @use_args({"thread": Boolean(missing=False)})
     @marshal_with(fields.entry_full, envelope="entry")
     def get(self, args, entry_id, logbook_id=None, revision_n=None):
@@ -45,7 +95,8 @@ class EntryResource(Resource):
         if revision_n is not None:
             return entry.get_revision(revision_n)
         if args["thread"]:
-            return entry._thread
+            entry = entry._thread
+        entry.prefetch_followups()
         return entry
 
     @send_signal(new_entry)
@@ -58,38 +109,12 @@ class EntryResource(Resource):
         if entry_id is not None:
             # we're creating a followup to an existing entry
             args["follows"] = entry_id
-        if args.get("content"):
-            content_type = args["content_type"]
-            if content_type.startswith("text/html"):
-                # extract any inline images as attachments
-                args["content"], inline_attachments = handle_img_tags(
-                    args["content"], timestamp=args.get("created_at"))
-            else:
-                inline_attachments = []
-        else:
-            inline_attachments = []
-        args["logbook"] = logbook
-        # make sure the attributes are of proper types
-        if "attributes" in args:
-            attributes = {}
-            for attr_name, attr_value in args["attributes"].items():
-                try:
-                    converted_value = logbook.convert_attribute(attr_name,
-                                                                attr_value)
-                    attributes[attr_name] = converted_value
-                except ValueError as e:
-                    logging.warning(
-                        "Discarding attribute %s with value %r; %s",
-                        attr_name, attr_value, e)
-                    # TODO: return a helpful error if this fails?
-            args["attributes"] = attributes
-        if args.get("follows_id"):
-            # don't allow pinning followups, that makes no sense
-            args["pinned"] = False
+        inline_attachments = prepare_new_entry(logbook, args)
         entry = Entry.create(**args)
         for attachment in inline_attachments:
             attachment.entry = entry
             attachment.save()
+            request_thumbnail(attachment)
         return entry
 
     @send_signal(edit_entry)
@@ -98,46 +123,106 @@ class EntryResource(Resource):
     def put(self, args, entry_id, logbook_id=None):
         "update entry"
         entry_id = entry_id or args["id"]
-        entry = Entry.get(Entry.id == entry_id)
         # to prevent overwiting someone else's changes we require the
         # client to supply the "revision_n" field of the entry they
         # are editing. If this does not match the current entry in the
         # db, it means someone has changed it inbetween and we abort.
         if "revision_n" not in args:
             abort(400, message="Missing 'revision_n' field!")
-        if args["revision_n"] != entry.revision_n:
-            abort(409, message=(
-                "Conflict: Entry {} has been edited since you last loaded it!"
-                .format(entry_id)))
-        # check for a lock on the entry
-        if entry.lock:
-            if entry.lock.owned_by_ip == request.remote_addr:
-                entry.lock.cancel(request.remote_addr)
-            else:
+        # Take the write lock before checking, so that nobody else can
+        # change the entry until we're done. Otherwise two edits could
+        # both pass the check, and the change (which may be a patch
+        # against the current content) would be made from a stale entry.
+        with db.transaction("IMMEDIATE"):
+            entry = Entry.get(Entry.id == entry_id)
+            if args["revision_n"] != entry.revision_n:
                 abort(409, message=(
-                    "Conflict: Entry {} is locked by IP {} since {}"
-                    .format(entry_id, entry.lock.owned_by_ip,
-                            entry.lock.created_at)))
-        if args.get("content"):
-            content_type = args.get("content_type", entry.content_type)
-            if content_type.startswith("text/html"):
-                args["content"], inline_attachments = handle_img_tags(
-                    args["content"])
+                    "Conflict: Entry {} has been edited since you last"
+                    " loaded it!".format(entry_id)))
+            # check for a lock on the entry
+            if entry.lock:
+                if entry.lock.owned_by_ip == request.remote_addr:
+                    entry.lock.cancel(request.remote_addr)
+                else:
+                    abort(409, message=(
+                        "Conflict: Entry {} is locked by IP {} since {}"
+                        .format(entry_id, entry.lock.owned_by_ip,
+                                entry.lock.created_at)))
+            if args.get("content"):
+                content_type = args.get("content_type", entry.content_type)
+                if content_type.startswith("text/html"):
+                    args["content"], inline_attachments = handle_img_tags(
+                        args["content"])
+                else:
+                    inline_attachments = []
             else:
                 inline_attachments = []
-        else:
-            inline_attachments = []
 
-        entry = Entry.get(Entry.id == entry_id)
-        change = entry.make_change(**args)
-        entry.save()
-        change.save()
+            change = entry.make_change(**args)
+            entry.save()
+            change.save()
+            for attachment in inline_attachments:
+                attachment.entry = entry
+                attachment.save()
+        # after committing, so that the jobs can see the attachments
         for attachment in inline_attachments:
-            attachment.entry = entry
-            attachment.save()
+            request_thumbnail(attachment)
         return entry
 
 
+# In a batch, entries may follow other entries in the same batch. Each
+# entry can be given a "ref", that later entries refer to by "follows_ref".
+batch_entry_args = dict(entry_args,
+                        ref=Str(allow_none=True),
+                        follows_ref=Str(allow_none=True))
+
+
+class EntryBatchResource(Resource):
+
+    "Create many entries at once, e.g. when importing"
+
+    @use_args({"entries": List(Nested(batch_entry_args), required=True)})
+    @marshal_with(fields.entry_batch)
+    def post(self, args, logbook_id):
+        """Note that no actions are run for the new entries, but an
+        event is recorded for each of them."""
+        logbook = Logbook.get(Logbook.id == logbook_id)
+        entries, refs = [], []
+        by_ref = {}
+        # check everything before writing any inline images to disk
+        for i, entry_args in enumerate(args["entries"]):
+            ref = entry_args.pop("ref", None)
+            follows_ref = entry_args.pop("follows_ref", None)
+            if follows_ref is not None:
+                if follows_ref not in by_ref:
+                    abort(400, message=(
+                        "Entry {} follows '{}', which is not the ref of"
+                        " an earlier entry in the batch"
+                        .format(i, follows_ref)))
+                entry_args["follows"] = by_ref[follows_ref]
+            entries.append(entry_args)
+            refs.append(ref)
+            if ref is not None:
+                by_ref[ref] = entry_args
+        inline_attachments = [prepare_new_entry(logbook, entry_args)
+                              for entry_args in entries]
+        try:
+            entry_ids = Entry.create_many(entries)
+        except Exception:
+            # the images are not used by anything, then
+            for attachment in sum(inline_attachments, []):
+                remove_attachment_file(attachment)
+            raise
+        for entry_id, attachments in zip(entry_ids, inline_attachments):
+            for attachment in attachments:
+                attachment.entry = entry_id
+                attachment.save()
+                request_thumbnail(attachment)
+        record_entry_events("new_entry", logbook.id, entry_ids)
+        return {"entries": [{"id": entry_id, "ref": ref}
+                            for entry_id, ref in zip(entry_ids, refs)]}
+
+
 entries_args = {
     "title": Str(),
     "content": Str(),
@@ -148,63 +233,116 @@ entries_args = {
     "ignore_children": Boolean(),
     "n": Integer(missing=50),
     "offset": Integer(),
-    "download": Boolean()
+    "cursor": Str(),
+    "download": Str(validate=lambda d: d in ["ndjson", "csv"])
 }
 
 
+def get_search_args(args):
+    "The arguments to Entry.search for the filters given in the request"
+    return dict(child_logbooks=not args.get("ignore_children"),
+                title_filter=args.get("title"),
+                content_filter=args.get("content"),
+                author_filter=args.get("authors"),
+                attachment_filter=args.get("attachments"),
+                attribute_filter=[attr.split(":")
+                                  for attr in args.get("attribute", [])])
+
+
+def encode_cursor(entry):
+    "Make an opaque string pointing to the position after the entry"
+    position = [entry.priority, entry.timestamp, entry.id]
+    return urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        priority, timestamp, entry_id = json.loads(
+            urlsafe_b64decode(cursor.encode()).decode())
+        if not (isinstance(timestamp, str) and timestamp):
+            raise ValueError("bad timestamp")
+        return int(priority), timestamp, int(entry_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        abort(400, message="Invalid cursor!")
+
+
+def entries_state(logbook_id=None):
+    return Logbook.get_change_counts(logbook_id or None)
+
+
 class EntriesResource(Resource):
 
     "Handle requests for entries from a given logbook, optionally filtered"
 
+    @cached(entries_state)
     @use_args(entries_args)
     def get(self, args, logbook_id=None):
 
-        attributes = [attr.split(":")
-                      for attr in args.get("attribute", [])]
-
         if logbook_id:
             # restrict search to the given logbook and its descendants
             logbook = Logbook.get(Logbook.id == logbook_id)
-            search_args = dict(child_logbooks=not args.get("ignore_children"),
-                               title_filter=args.get("title"),
-                               content_filter=args.get("content"),
-                               author_filter=args.get("authors"),
-                               attachment_filter=args.get("attachments"),
-                               attribute_filter=attributes,
-                               n=args["n"], offset=args.get("offset"))
-            entries = logbook.get_entries(**search_args)
-            # TODO: figure out a nicer way to get the total number of hits
-            count = logbook.get_entries(count=True, **search_args).tuples()
-            count = list(count)[0][0] if list(count) else 0
-
         else:
             # global search (all logbooks)
             logbook = None
-            search_args = dict(child_logbooks=not args.get("ignore_children"),
-                               title_filter=args.get("title"),
-                               content_filter=args.get("content"),
-                               author_filter=args.get("authors"),
-                               attachment_filter=args.get("attachments"),
-                               attribute_filter=attributes,
-                               n=args["n"], offset=args.get("offset"))
-            entries = Entry.search(**search_args)
-            # TODO: figure out a nicer way to get the total number of hits
-            count = Entry.search(count=True, **search_args).tuples()
-            count = list(count)[0][0] if list(count) else 0
-
-        if args.get("download") == "pdf":
-            # return a PDF version
-            # TODO: not sure if this belongs in the API
-            pdf = export_entries_as_pdf(logbook, entries)
-            if pdf is None:
-                abort(400, message="Could not create PDF!")
-            return send_file(pdf, mimetype="application/pdf",
-                             as_attachment=True,
-                             attachment_filename=("{logbook.name}.pdf"
-                                                  .format(logbook=logbook)))
-
-        return marshal(dict(logbook=logbook,
-                            entries=list(entries), count=count), fields.entries)
+
+        search_args = dict(get_search_args(args), logbook=logbook)
+
+        if args.get("download") in ["ndjson", "csv"]:
+            # all the matching entries, not just a page
+            return export_entries(logbook, search_args, args["download"])
+
+        search_args["n"] = args["n"]
+        if "cursor" in args:
+            # Page by cursor; each response contains a "next_cursor" that
+            # can be used to get the following page. Start with an empty
+            # cursor. The total count is only included on the first page.
+            search_args["ranked"] = False
+            if args["cursor"]:
+                search_args["after"] = decode_cursor(args["cursor"])
+                entries, count = list(Entry.search(**search_args)), None
+            else:
+                entries, count = Entry.search_with_count(**search_args)
+            if entries and len(entries) == args["n"]:
+                next_cursor = encode_cursor(entries[-1])
+            else:
+                next_cursor = None
+        else:
+            search_args["offset"] = args.get("offset")
+            entries, count = Entry.search_with_count(**search_args)
+            next_cursor = None
+        Entry.prefetch_related(entries)
+
+        return marshal(dict(logbook=logbook, entries=entries, count=count,
+                            next_cursor=next_cursor),
+                       fields.entries)
+
+
+def export_entries(logbook, search_args, file_format):
+    "Stream the entries as they are read from the database"
+    entries = iter_entries(**search_args)
+    if file_format == "csv":
+        # the attributes get a column each
+        if logbook is None:
+            logbooks = Logbook.select()
+        elif search_args["child_logbooks"]:
+            logbooks = [logbook] + list(logbook.descendants)
+        else:
+            logbooks = [logbook]
+        attribute_names = []
+        for lb in logbooks:
+            for attribute in lb.attributes:
+                if attribute["name"] not in attribute_names:
+                    attribute_names.append(attribute["name"])
+        content = export_entries_as_csv(entries, attribute_names)
+        mimetype = "text/csv"
+    else:
+        content = export_entries_as_ndjson(entries)
+        mimetype = "application/x-ndjson"
+    filename = "{}.{}".format(logbook.name if logbook else "elogy",
+                              file_format)
+    return Response(stream_with_context(content), mimetype=mimetype,
+                    headers={"Content-Disposition":
+                             'attachment; filename="{}"'.format(filename)})
 
 
 class EntryLockResource(Resource):
@@ -245,4 +383,4 @@ class EntryChangesResource(Resource):
     @marshal_with(fields.entry_changes)
     def get(self, entry_id, logbook_id=None):
         entry = Entry.get(Entry.id == entry_id)
-        return {"entry_changes": entry.changes}
+        return {"entry_changes": entry.get_changes()}
@@ -0,0 +1,59 @@
+import json
+from time import sleep
+
+from flask import Response, request
+from flask_restful import Resource
+
+from ..db import db, Event, Logbook
+from .. import events  # noqa: records the events
+
+
+POLL_INTERVAL = 1  # seconds between checking for new events
+KEEPALIVE_INTERVAL = 15  # seconds, to keep proxies from closing
+
+
+def format_event(event):
+    data = {"id": event.id, "type": event.kind,
+            "logbook_id": event.logbook_id, "entry_id": event.entry_id}
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        event.id, event.kind, json.dumps(data))
+
+
+def stream_events(logbook_id, last_id):
+    try:
+        yield "retry: {}\n\n".format(POLL_INTERVAL * 1000)
+        idle = 0
+        while True:
+            new_events = Event.since(last_id, logbook_id)
+            db.close()  # no need to keep the connection while waiting
+            for event in new_events:
+                yield format_event(event)
+                last_id = event.id
+            if new_events:
+                idle = 0
+            else:
+                idle += POLL_INTERVAL
+                if idle >= KEEPALIVE_INTERVAL:
+                    yield ":\n\n"  # a comment, ignored by the client
+                    idle = 0
+                sleep(POLL_INTERVAL)
+    finally:
+        db.close()
+
+
+class EventsResource(Resource):
+
+    def get(self, logbook_id=None):
+        """A stream of server-sent events about changes in the logbook
+        (or its descendants), with logbook 0 meaning all logbooks."""
+        if logbook_id:
+            Logbook.get(Logbook.id == logbook_id)  # must exist
+        try:
+            # the browser sends this when reconnecting
+            last_id = int(request.headers["Last-Event-ID"])
+        except (KeyError, ValueError):
+            last_id = Event.last_id()
+        return Response(stream_events(logbook_id or None, last_id),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
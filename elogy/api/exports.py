@@ -0,0 +1,58 @@
+import re
+
+from flask import send_file, url_for
+from flask_restful import Resource, marshal_with, abort
+from webargs.flaskparser import use_args
+
+from ..db import Logbook
+from ..export import request_pdf_export, get_pdf_export_status
+from .entries import entries_args, get_search_args
+from . import fields
+
+
+def get_export(key):
+    "The status of an export, and where to get it when it's done"
+    if not re.fullmatch("[0-9a-f]{40}", key):
+        abort(404, message="Export does not exist!")
+    status, info = get_pdf_export_status(key)
+    if status is None:
+        abort(404, message="Export does not exist!")
+    return dict(id=key, status=status,
+                error=info if status == "failed" else None,
+                link=(url_for("pdf_export_file", key=key)
+                      if status == "done" else None))
+
+
+class PdfExportsResource(Resource):
+
+    @use_args(entries_args)
+    @marshal_with(fields.export, envelope="export")
+    def post(self, args, logbook_id=None):
+        """Start making a PDF of the entries in the logbook (0 meaning
+        all logbooks), with the same filters as when listing them."""
+        if logbook_id:
+            Logbook.get(Logbook.id == logbook_id)  # must exist
+        search_args = dict(get_search_args(args),
+                           n=args["n"], offset=args.get("offset"))
+        return get_export(request_pdf_export(logbook_id or None,
+                                             search_args))
+
+
+class PdfExportResource(Resource):
+
+    @marshal_with(fields.export, envelope="export")
+    def get(self, key):
+        "Check on an export; poll this until it's done, or failed"
+        return get_export(key)
+
+
+class PdfExportFileResource(Resource):
+
+    def get(self, key):
+        get_export(key)
+        status, path = get_pdf_export_status(key)
+        if status != "done":
+            abort(404, message="Export is not finished!")
+        return send_file(path, mimetype="application/pdf",
+                         as_attachment=True,
+                         attachment_filename="elogy-export.pdf")
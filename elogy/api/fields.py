@@ -1,9 +1,6 @@
-from collections import OrderedDict
 from dateutil.parser import parse
-import json
 
 from flask_restful import fields, marshal, marshal_with_field
-import lxml
 
 
 class NumberOf(fields.Raw):
@@ -11,6 +8,15 @@ class NumberOf(fields.Raw):
         return len(value)
 
 
+def prefetched(name):
+    """Get the related things of the given name, preferring the ones
+    that have been loaded beforehand, see Entry.prefetch_followups"""
+    def get(obj):
+        things = getattr(obj, "_prefetched_" + name, None)
+        return getattr(obj, name) if things is None else things
+    return get
+
+
 logbook_child = {
     "id": fields.Integer,
     "name": fields.String,
@@ -119,11 +125,12 @@ followup = {
     "title": fields.String,
     "created_at": fields.DateTime,
     "authors": fields.List(fields.Nested(authors)),
-    "attachments": fields.List(fields.Nested(attachment)),
+    "attachments": fields.List(fields.Nested(attachment),
+                               attribute=prefetched("attachments")),
     "attributes": fields.Raw,
     "content": fields.String,
     "content_type": fields.String,
-    "followups": fields.List(Followup),
+    "followups": fields.List(Followup, attribute=prefetched("followups")),
 }
 
 
@@ -149,14 +156,15 @@ entry_full = {
     "last_changed_at": fields.DateTime,
     "authors": fields.List(fields.Nested(authors)),
     "attributes": fields.Raw(attribute="converted_attributes"),
-    "attachments": fields.List(fields.Nested(attachment)),
+    "attachments": fields.List(fields.Nested(attachment),
+                               attribute=prefetched("attachments")),
     "priority": fields.Integer,
     "metadata": fields.Raw,
     "content": fields.String,
     "content_type": fields.String,
     "follows": EntryId,
-    "n_followups": NumberOf(attribute="followups"),
-    "followups": fields.List(Followup),
+    "n_followups": NumberOf(attribute=prefetched("followups")),
+    "followups": fields.List(Followup, attribute=prefetched("followups")),
     "revision_n": fields.Integer,
     "lock": fields.Nested(entry_lock, allow_null=True),
     "next": EntryId,
@@ -198,21 +206,6 @@ entry_changes = {
 }
 
 
-class FirstIfAny(fields.Raw):
-    def format(self, value):
-        if value:
-            return marshal(value[0], attachment)
-
-
-class ContentPreview(fields.Raw):
-    def format(self, value):
-        value = value.strip()
-        if value:
-            document = lxml.html.document_fromstring(value)
-            raw_text = document.text_content()
-            return raw_text[:200].strip().replace("\n", " ")
-
-
 class DateTimeFromStringField(fields.DateTime):
     def format(self, value):
         return super().format(parse(value))
@@ -224,27 +217,21 @@ logbook_very_short = {
 }
 
 
-class FollowupAuthorsField(fields.Raw):
-    def format(self, value):
-        all_authors = sum(json.loads(value), [])
-        d = OrderedDict((author["name"], None) for author in all_authors)
-        return list(d.keys())
-
-
 short_entry = {
     "id": fields.Integer,
     "logbook": fields.Nested(logbook_very_short),
     "title": fields.String,
-    "content": ContentPreview,
+    "content": fields.String(attribute="preview"),  # plain text
     "priority": fields.Integer,
     "created_at": fields.DateTime,
     "last_changed_at": fields.DateTime,
     "timestamp": DateTimeFromStringField,
     "authors": fields.List(fields.String(attribute="name")),
     "attributes": fields.Raw,
-    "followup_authors": FollowupAuthorsField(),
-    "attachment_preview": FirstIfAny(attribute="attachments"),
-    "n_attachments": NumberOf(attribute="attachments"),
+    "followup_authors": fields.List(fields.String),
+    # these must be looked up beforehand, see Entry.prefetch_related
+    "attachment_preview": fields.Nested(attachment, allow_null=True),
+    "n_attachments": fields.Integer,
     "n_followups": fields.Integer
 }
 
@@ -252,7 +239,72 @@ short_entry = {
 entries = {
     "logbook": fields.Nested(logbook),
     "entries": fields.List(fields.Nested(short_entry)),
-    "count": fields.Integer
+    "count": fields.Integer(default=None),
+    "next_cursor": fields.String
+}
+
+
+# the ids of entries created in a batch, in order
+entry_batch = {
+    "entries": fields.List(fields.Nested({
+        "id": fields.Integer,
+        "ref": fields.String
+    }))
+}
+
+
+# Used for keeping a copy of the database up to date. Only plain
+# values, so that the client doesn't need to parse anything.
+synced_logbook = {
+    "id": fields.Integer,
+    "parent_id": fields.Integer(default=None),
+    "name": fields.String,
+    "description": fields.String,
+    "template": fields.String,
+    "attributes": fields.Raw,
+    "metadata": fields.Raw,
+    "archived": fields.Boolean,
+    "created_at": fields.DateTime,
+    "last_changed_at": fields.DateTime,
+    "change_seq": fields.Integer
+}
+
+synced_entry = {
+    "id": fields.Integer,
+    "logbook_id": fields.Integer,
+    "follows_id": fields.Integer(default=None),
+    "title": fields.String,
+    "authors": fields.List(fields.Nested(authors)),
+    "content": fields.String,
+    "content_type": fields.String,
+    "attributes": fields.Raw,
+    "metadata": fields.Raw,
+    "priority": fields.Integer,
+    "archived": fields.Boolean,
+    "created_at": fields.DateTime,
+    "last_changed_at": fields.DateTime,
+    "change_seq": fields.Integer
+}
+
+synced_attachment = dict(attachment,
+                         entry_id=fields.Integer,
+                         archived=fields.Boolean,
+                         change_seq=fields.Integer)
+
+changes_since = {
+    "logbooks": fields.List(fields.Nested(synced_logbook)),
+    "entries": fields.List(fields.Nested(synced_entry)),
+    "attachments": fields.List(fields.Nested(synced_attachment)),
+    "last_seq": fields.Integer,
+    "more": fields.Boolean
+}
+
+
+export = {
+    "id": fields.String,
+    "status": fields.String,  # pending, running, done or failed
+    "error": fields.String,
+    "link": fields.String  # where to download it, when done
 }
 
 
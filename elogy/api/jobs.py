@@ -0,0 +1,10 @@
+from flask_restful import Resource
+
+from .. import jobs
+
+
+class JobsResource(Resource):
+
+    def get(self):
+        "Some statistics on the background jobs, for monitoring"
+        return jobs.queue.metrics()
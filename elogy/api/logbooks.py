@@ -4,7 +4,7 @@ from webargs.flaskparser import use_args
 
 from ..db import Logbook
 from ..actions import new_logbook, edit_logbook
-from . import fields, send_signal
+from . import fields, send_signal, cached
 
 
 logbook_args = {
@@ -28,10 +28,15 @@ logbook_args = {
 }
 
 
+def logbook_state(logbook_id=None, revision_n=None):
+    return Logbook.get_change_counts(logbook_id or None)
+
+
 class LogbooksResource(Resource):
 
     "Handle requests for logbooks"
 
+    @cached(logbook_state)
     @use_args({"parent": Integer()})
     @marshal_with(fields.logbook, envelope="logbook")
     def get(self, args, logbook_id=None, revision_n=None):
@@ -91,4 +96,4 @@ class LogbookChangesResource(Resource):
     @marshal_with(fields.logbook_changes)
     def get(self, logbook_id):
         logbook = Logbook.get(Logbook.id == logbook_id)
-        return {"logbook_changes": logbook.changes}
+        return {"logbook_changes": logbook.get_changes()}
@@ -0,0 +1,21 @@
+from flask_restful import Resource, marshal_with
+from webargs.fields import Integer
+from webargs.flaskparser import use_args
+
+from ..db import Logbook, get_changes_since
+from . import fields
+
+
+class SyncResource(Resource):
+
+    @use_args({"since": Integer(missing=0),
+               "n": Integer(missing=1000, validate=lambda n: n > 0)})
+    @marshal_with(fields.changes_since)
+    def get(self, args, logbook_id=None):
+        """Everything in the logbook (or all logbooks, for logbook 0) that
+        has changed since the given "last_seq" from a previous call.
+        Start from 0, and keep asking while "more" is true."""
+        if logbook_id:
+            Logbook.get(Logbook.id == logbook_id)  # must exist
+        return get_changes_since(args["since"], logbook_id or None,
+                                 n=args["n"])
@@ -2,6 +2,7 @@
 The main entrypoint of the Elogy web application
 """
 
+import os
 from time import time
 
 from flask import Flask, current_app, send_from_directory, g, request
@@ -11,11 +12,20 @@ import logging
 from .api.errors import errors as api_errors
 from .api.logbooks import LogbooksResource, LogbookChangesResource
 from .api.entries import (EntryResource, EntriesResource,
-                          EntryLockResource, EntryChangesResource)
+                          EntryBatchResource, EntryLockResource,
+                          EntryChangesResource)
 from .api.users import UsersResource
 from .api.attachments import AttachmentsResource
-from .db import setup_database
+from .api.jobs import JobsResource
+from .api.events import EventsResource
+from .api.sync import SyncResource
+from .api.exports import (PdfExportsResource, PdfExportResource,
+                          PdfExportFileResource)
+from .db import setup_database, db, Entry, EntryChange, Attachment
 from .admin import setup_admin
+from .migrations import migrate_database, get_version
+from .attachments import make_thumbnail
+from . import jobs
 
 
 # Configure the main application object
@@ -25,20 +35,30 @@ app = Flask(__name__,
 app.config.from_envvar('ELOGY_CONFIG_FILE')
 
 
-# add some hooks for debugging purposes
+# Each request gets its own database connection, opened before and
+# closed after. Also time the requests, for debugging purposes.
 @app.before_request
 def before_request():
     g.start = time()
+    if db.is_closed():
+        db.connect()
 
 
 @app.teardown_request
 def teardown_request(exception=None):
+    if not db.is_closed():
+        db.close()
     duration = time() - g.start
     current_app.logger.debug("Request took %f s", duration)
 
 
-setup_database(app.config["DATABASE"]["name"])
+db_config = app.config["DATABASE"]
+pragmas = dict(db_config.get("pragmas", {}))
+if "journal_mode" in db_config:
+    pragmas.setdefault("journal_mode", db_config["journal_mode"])
+setup_database(db_config["name"], pragmas=pragmas)
 setup_admin(app)
+jobs.queue.init_app(app)  # the workers are started when needed
 
 
 # Allow CORS requests. Maybe we should only enable this in debug mode?
@@ -69,6 +89,9 @@ api.add_resource(EntryResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/",
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/revisions/<int:revision_n>")
 
+api.add_resource(EntryBatchResource,
+                 "/logbooks/<int:logbook_id>/entries/batch")  # POST
+
 api.add_resource(EntryChangesResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/revisions/")
 
@@ -83,10 +106,65 @@ api.add_resource(AttachmentsResource,
                  "/logbooks/<int:logbook_id>/entries/<int:entry_id>/attachments/",
                  "/attachments/")
 
+api.add_resource(JobsResource,
+                 "/jobs/")
+
+api.add_resource(EventsResource,
+                 "/logbooks/<int:logbook_id>/events")
+
+api.add_resource(SyncResource,
+                 "/logbooks/<int:logbook_id>/sync/")
+
+api.add_resource(PdfExportsResource,
+                 "/logbooks/<int:logbook_id>/exports/pdf/")  # POST
+
+api.add_resource(PdfExportResource,
+                 "/exports/pdf/<key>/")
+
+api.add_resource(PdfExportFileResource,
+                 "/exports/pdf/<key>/file",
+                 endpoint="pdf_export_file")
+
+
+# command line tools, run e.g. "flask compress-revisions"
+@app.cli.command("migrate")
+def migrate():
+    "Bring the database schema up to date"
+    # Note: this has already happened when the app was set up, but
+    # it's convenient for running the migrations before deploying.
+    done = migrate_database()
+    print("Database schema is at version {} ({} migrations run)"
+          .format(get_version(), len(done)))
+
+
+@app.cli.command("compress-revisions")
+def compress_revisions():
+    "Convert the content stored in old entry changes into patches"
+    entry_ids = [entry.id for entry in (Entry.select(Entry.id)
+                                        .join(EntryChange)
+                                        .group_by(Entry.id))]
+    converted = 0
+    for entry_id in entry_ids:
+        with db.atomic():
+            entry = Entry.get(Entry.id == entry_id)
+            converted += entry.compress_changes()
+    print("Converted {} changes in {} entries".format(converted,
+                                                      len(entry_ids)))
+
 
 # other routes
 @app.route('/attachments/<path:path>')
 def get_attachment(path):
+    if path.endswith(".thumbnail"):
+        full_path = os.path.join(current_app.config["UPLOAD_FOLDER"], path)
+        if not os.path.exists(full_path):
+            # the thumbnail job has not run yet, let's not wait for it
+            try:
+                attachment = Attachment.get(
+                    Attachment.path == path[:-len(".thumbnail")])
+                make_thumbnail(attachment)
+            except Attachment.DoesNotExist:
+                pass
     return send_from_directory(current_app.config["UPLOAD_FOLDER"], path)
 
 
@@ -8,8 +8,10 @@ import binascii
 from datetime import datetime
 from dateutil.parser import parse
 import io
+import logging
 import mimetypes
 import os
+from threading import get_ident
 
 from flask import (Blueprint, abort, request, url_for, redirect,
                    current_app, jsonify, send_from_directory)
@@ -19,6 +21,7 @@ from PIL import Image
 from werkzeug import FileStorage
 
 from .db import Entry, Attachment
+from . import jobs
 
 
 def allowed_file(filename):
@@ -40,7 +43,8 @@ def get_content_type(file_):
 
 
 def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False):
-    "Store an attachment in the proper place"
+    """Store an attachment in the proper place. Thumbnails are made
+    later, see request_thumbnail."""
     # make up a path and unique filename using the timestamp
     # TODO: make this smarter, somehow
     today = timestamp.strftime("%Y/%m/%d")
@@ -54,13 +58,60 @@ def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False):
     path = os.path.join(upload_dir, prefixed_filename)
     # store the attachment at the unique path
     file_.save(path)
+
+    content_type = get_content_type(file_)
+    new_metadata = dict(metadata or {})
+    if content_type and content_type.startswith("image/"):
+        # Opening images can be slow, so the thumbnail is made in
+        # the background (or when it's first requested).
+        new_metadata["thumbnail_status"] = "pending"
+
+    if entry_id:
+        entry = Entry.get(Entry.id == entry_id)
+    else:
+        entry = None
+
+    attachment = Attachment(path="{}/{}".format(today, prefixed_filename),
+                            filename=sanitized_filename,
+                            timestamp=timestamp,
+                            content_type=content_type,
+                            entry=entry, embedded=embedded,
+                            metadata=new_metadata or None)
+    return attachment
+
+
+def remove_attachment_file(attachment):
+    "Remove the file of an attachment that will not be saved after all"
+    path = os.path.join(current_app.config["UPLOAD_FOLDER"], attachment.path)
     try:
-        # If it's an image file we create a thumbnail version for preview
-        image = Image.open(file_)
+        os.remove(path)
+    except OSError as e:
+        logging.warning("Could not remove attachment file %s: %s", path, e)
+
+
+def request_thumbnail(attachment):
+    "Queue up making a thumbnail for a saved attachment, if needed"
+    if (attachment.metadata or {}).get("thumbnail_status") == "pending":
+        jobs.queue.submit("thumbnail", attachment_id=attachment.id)
+
+
+def make_thumbnail(attachment):
+    """Create a thumbnail version of an image attachment for preview,
+    and store the image sizes in the metadata. Does nothing if it's
+    already been done."""
+    metadata = dict(attachment.metadata or {})
+    if metadata.get("thumbnail_status") in ("done", "failed"):
+        return
+    path = os.path.join(current_app.config["UPLOAD_FOLDER"], attachment.path)
+    thumbnail_path = path + ".thumbnail"
+    # write to a temporary file first, since the thumbnail may be made
+    # by a worker and a request at the same time
+    tmp_path = "{}.{}-{}.tmp".format(thumbnail_path, os.getpid(),
+                                     get_ident())
+    try:
+        image = Image.open(path)
         width, height = image.size
-        new_metadata = dict(size={"width": width, "height": height})
-        if metadata:
-            new_metadata.update(**metadata)
+        metadata["size"] = {"width": width, "height": height}
         if width > 100 or height > 100:
             # create a tiny version of the image
             image.convert("RGB")
@@ -73,35 +124,29 @@ def save_attachment(file_, timestamp, entry_id, metadata=None, embedded=False):
                 bg = Image.new("RGB", image.size, (255, 255, 255, 255))
                 bg.paste(image, mask=alpha)
                 image = bg
-            try:
-                image.save(path + ".thumbnail", "JPEG")
-                width, height = image.size
-                new_metadata["thumbnail_size"] = {"width": width,
-                                                  "height": height}
-            except IOError as e:
-                print("Error making thumbnail", e)
+            image.save(tmp_path, "JPEG")
+            width, height = image.size
         else:
             # small image, re-use it as its own thumbnail
-            os.link(path, path + ".thumbnail")
-    except IOError as e:
-        # Not a recognized image, no thumbnail
+            os.link(path, tmp_path)
+        os.replace(tmp_path, thumbnail_path)
+        metadata["thumbnail_size"] = {"width": width, "height": height}
+        metadata["thumbnail_status"] = "done"
+    except Exception as e:
+        # Not a recognized image (or a broken one), no thumbnail
         # TODO: thumbnails of PDF:s and maybe some other formats might be nice
-        new_metadata = metadata
-
-    if entry_id:
-        entry = Entry.get(Entry.id == entry_id)
-    else:
-        entry = None
-
-    content_type = get_content_type(file_)
-
-    attachment = Attachment(path="{}/{}".format(today, prefixed_filename),
-                            filename=sanitized_filename,
-                            timestamp=timestamp,
-                            content_type=content_type,
-                            entry=entry, embedded=embedded,
-                            metadata=new_metadata)
-    return attachment
+        logging.warning("Could not make a thumbnail of %s: %r",
+                        attachment.path, e)
+        metadata["thumbnail_status"] = "failed"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    attachment.metadata = metadata
+    attachment.save()
+
+
+@jobs.handler("thumbnail")
+def thumbnail_job(attachment_id):
+    make_thumbnail(Attachment.get(Attachment.id == attachment_id))
 
 
 html_clean = Cleaner(style=True, inline_style=False,
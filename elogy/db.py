@@ -1,31 +1,67 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 from html.parser import HTMLParser
+import re
 import sys
 import logging
 
 
 from flask import url_for
-from playhouse.sqlite_ext import SqliteExtDatabase, JSONField
+from playhouse.sqlite_ext import (SqliteExtDatabase, JSONField,
+                                  FTS5Model, SearchField)
 from peewee import (IntegerField, CharField, TextField, BooleanField,
                     DateTimeField, ForeignKeyField, sqlite3)
-from peewee import Model, DoesNotExist, DeferredRelation, fn
+from peewee import Model, DoesNotExist, DeferredRelation, fn, CompositeKey
+
+from .patch import make_patch, apply_patch
 
 
 # defer the actual db setup to later, when we have read the config
 db = SqliteExtDatabase(None)
 
 
-def setup_database(db_name, close=True):
-    "Configure the database and make sure all the tables exist"
-    # TODO: support further configuration options, see FlaskDB
+@lru_cache(maxsize=256)
+def compile_regexp(pattern, flags=re.IGNORECASE):
+    return re.compile(pattern, flags)
+
+
+def regexp(pattern, value):
+    """Used by SQLite for "value REGEXP pattern". Like the one peewee
+    provides, it's case insensitive, but the compiled patterns are
+    kept since the same one is usually checked against lots of rows."""
+    if value is None:
+        return False
+    return compile_regexp(pattern).search(value) is not None
+
+
+db.register_function(regexp, "regexp", 2)  # replaces peewee's
+
+
+# SQLite settings applied to each connection, see setup_database.
+PRAGMAS = {
+    # readers and the writer don't block each other
+    "journal_mode": "wal",
+    # with WAL, this is still safe against corruption, and much faster
+    "synchronous": "normal",
+    "cache_size": -64000,  # negative means KiB, i.e. 64 MB
+    "mmap_size": 256 * 1024 * 1024,  # bytes
+    "temp_store": "memory",
+    # wait this long (ms) for other writers, instead of failing
+    # with "database is locked"
+    "busy_timeout": 10000,
+}
+
+
+def setup_database(db_name, close=True, pragmas=None):
+    """Configure the database and make sure the schema is up to date.
+    The given pragmas override the default PRAGMAS."""
     db_dependencies_installed()
     db.init(db_name)
-    Logbook.create_table(fail_silently=True)
-    LogbookChange.create_table(fail_silently=True)
-    Entry.create_table(fail_silently=True)
-    EntryChange.create_table(fail_silently=True)
-    EntryLock.create_table(fail_silently=True)
-    Attachment.create_table(fail_silently=True)
+    # peewee only takes pragmas when creating the database object
+    db._pragmas = list(dict(PRAGMAS, **(pragmas or {})).items())
+    from .migrations import migrate_database  # avoid circular import
+    migrate_database()
+    EntrySearch.enabled = fts_installed() and EntrySearch.table_exists()
     if close:
         db.close()  # important
 
@@ -49,6 +85,25 @@ def db_dependencies_installed(type='SQLite'):
             tmp_db.close()
 
 
+# Window functions are needed to count the total number of search
+# results in the same query as we get the results.
+WINDOW_FUNCTIONS = sqlite3.sqlite_version_info[:3] >= (3, 25, 0)
+
+
+def fts_installed():
+    """Check if SQLite has FTS5 with the 'trigram' tokenizer, which we
+    need in order to do substring searches (requires 3.34.0 or later)."""
+    tmp_db = sqlite3.connect(':memory:')
+    try:
+        tmp_db.execute("CREATE VIRTUAL TABLE ftstest "
+                       "USING fts5(data, tokenize='trigram')")
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        tmp_db.close()
+    return True
+
+
 class UTCDateTimeField(DateTimeField):
 
     """
@@ -67,6 +122,56 @@ class UTCDateTimeField(DateTimeField):
         return super().db_value(value.replace(tzinfo=None))
 
 
+def reconstruct_entry_values(current, changes):
+    """
+    The values of an entry before the first of the given changes
+    (oldest first), given a dict of its current values.
+
+    This gives the same result as reconstruct_revisions, but only the
+    content patches up to the first full copy of the content (see
+    store_content) after the revision are applied, instead of all the
+    patches since then.
+    """
+    values = dict(current)
+    for change in reversed(changes):
+        values.update((attr, value) for attr, value in change.changed.items()
+                      if attr in current and attr != "content")
+    content = current["content"]
+    patched = changes
+    for i, change in enumerate(changes):
+        if ("content" in change.changed and
+                not isinstance(change.changed["content"], dict)):
+            content = change.changed["content"]  # a snapshot
+            patched = changes[:i]
+            break
+    for change in reversed(patched):
+        if "content" in change.changed:
+            content = change.get_changed({"content": content})["content"]
+    values["content"] = content
+    return values
+
+
+def reconstruct_revisions(current, changes):
+    """
+    Rebuild the full historical values of an object, given a dict
+    of its current values and its changes, oldest first. Returns a
+    list with a dict of values for each revision, the last one being
+    the current values.
+
+    Since each change stores the old values of the attributes it
+    changed, we get there by applying them backwards, starting from
+    the current values. Only the attributes in "current" are included.
+    """
+    revisions = [current]
+    for change in reversed(changes):
+        old_values = {attr: value
+                      for attr, value in change.get_changed(revisions[-1]).items()
+                      if attr in current}
+        revisions.append(dict(revisions[-1], **old_values))
+    revisions.reverse()
+    return revisions
+
+
 class Logbook(Model):
 
     """
@@ -86,6 +191,9 @@ class Logbook(Model):
     attributes = JSONField(default=[])
     metadata = JSONField(default={})
     archived = BooleanField(default=False)
+    # increased whenever anything in the logbook changes, see touch()
+    change_count = IntegerField(default=0)
+    change_seq = IntegerField(null=True, index=True)  # see ChangeSequence
 
     def __str__(self):
         return "[{}] {}".format(self.id, self.name)
@@ -94,20 +202,68 @@ class Logbook(Model):
         "Convenient way to query for entries in this logbook"
         return Entry.search(logbook=self, **kwargs)
 
+    def save(self, *args, **kwargs):
+        if self.id is not None and not kwargs.get("only"):
+            # the change count may have been changed since we got it
+            kwargs["only"] = [field for field in self._meta.sorted_fields
+                              if field is not Logbook.change_count]
+        with db.atomic():
+            self.change_seq = ChangeSequence.next()
+            result = super().save(*args, **kwargs)
+            Logbook.touch([self.id])  # the old ancestors, if moved
+            LogbookClosure.link(self)
+            # the descendants show our name, so they are also affected
+            Logbook.touch([self.id], descendants=True)
+        return result
+
+    @classmethod
+    def touch(cls, logbook_ids, descendants=False):
+        """Note that something has changed in the given logbooks, by
+        increasing the change count of them and their ancestors (whose
+        listings include their entries). The ids may be a query."""
+        affected = (Logbook.id << (
+            LogbookClosure.select(LogbookClosure.ancestor)
+            .where(LogbookClosure.descendant << logbook_ids)))
+        if descendants:
+            affected |= (Logbook.id << (
+                LogbookClosure.select(LogbookClosure.descendant)
+                .where(LogbookClosure.ancestor << logbook_ids)))
+        (Logbook.update(change_count=Logbook.change_count + 1)
+         .where(affected)
+         .execute())
+
+    @classmethod
+    def get_change_counts(cls, logbook_id=None):
+        """The change counts of the logbook and its ancestors, or of all
+        logbooks if none is given. Anything that could show up when
+        looking at the logbook changes at least one of them."""
+        query = Logbook.select(Logbook.id, Logbook.change_count)
+        if logbook_id is not None:
+            query = (query
+                     .join(LogbookClosure,
+                           on=(LogbookClosure.ancestor == Logbook.id))
+                     .where(LogbookClosure.descendant == logbook_id))
+        return list(query.order_by(Logbook.id).tuples())
+
     @property
     def ancestors(self):
-        "The list of parent, grandparent, ..."
-        parents = []
-        # TODO: maybe this can be done with a recursive query?
-        if self.parent:
-            parent = Logbook.get(Logbook == self.parent)
-            while True:
-                parents.append(parent)
-                try:
-                    parent = Logbook.get(Logbook == parent.parent)
-                except DoesNotExist:
-                    break
-        return list(reversed(parents))
+        "The list of ..., grandparent, parent"
+        return list(Logbook.select()
+                    .join(LogbookClosure,
+                          on=(LogbookClosure.ancestor == Logbook.id))
+                    .where((LogbookClosure.descendant == self.id) &
+                           (LogbookClosure.depth > 0))
+                    .order_by(LogbookClosure.depth.desc()))
+
+    @property
+    def descendants(self):
+        "All children, grandchildren, ..."
+        return (Logbook.select()
+                .join(LogbookClosure,
+                      on=(LogbookClosure.descendant == Logbook.id))
+                .where((LogbookClosure.ancestor == self.id) &
+                       (LogbookClosure.depth > 0))
+                .order_by(LogbookClosure.depth, Logbook.id))
 
     def make_change(self, **values):
         "Change the logbook, storing the old values as a revision"
@@ -124,23 +280,44 @@ class Logbook(Model):
 
     @property
     def revision_n(self):
-        return len(self.changes)
+        return self.changes.count()
+
+    @property
+    def revision_values(self):
+        "The current values of the attributes that are kept in revisions"
+        return {attr: getattr(self, attr)
+                for attr in LogbookRevision.attributes}
+
+    def get_changes(self):
+        """Return all changes to the logbook, oldest first, with
+        their old and new values filled in"""
+        changes = list(self.changes.order_by(LogbookChange.id))
+        revisions = reconstruct_revisions(self.revision_values, changes)
+        for change, old, new in zip(changes, revisions, revisions[1:]):
+            change.old_values = old
+            change.new_values = new
+        return changes
 
     def get_revision(self, version):
-        if version == self.revision_n:
-            return self
-        if 0 <= version < self.revision_n:
-            return LogbookRevision(self.changes[version])
+        if version >= 0:
+            # we only need the changes since the revision
+            first_change = (LogbookChange.select(LogbookChange.id)
+                            .where(LogbookChange.logbook == self)
+                            .order_by(LogbookChange.id)
+                            .limit(1)
+                            .offset(version))
+            changes = list(LogbookChange.select()
+                           .where((LogbookChange.logbook == self) &
+                                  (LogbookChange.id >= first_change))
+                           .order_by(LogbookChange.id))
+            if changes:
+                old_values, *_ = reconstruct_revisions(self.revision_values,
+                                                       changes)
+                return LogbookRevision(changes[0], version, old_values)
+            if version == self.revision_n:
+                return self
         raise(LogbookChange.DoesNotExist)
 
-        # changes = (LogbookChange.select()
-        #            .where(LogbookChange.logbook == self)
-        #            .order_by(LogbookChange.id)
-        #            .offset(version or None))
-        # if changes.count() == 0:
-        #     raise(LogbookChange.DoesNotExist)
-        # return LogbookRevision(list(changes)[0])
-
     @property
     def entry_histogram(self):
         "Return a list of the number of entries per day"
@@ -215,69 +392,69 @@ class LogbookChange(Model):
     change_comment = TextField(null=True)
     change_ip = CharField(null=True)
 
+    # Filled in by Logbook.get_changes, if used. Otherwise the database
+    # is queried for them when needed.
+    old_values = None
+    new_values = None
+
+    def get_changed(self, new_values):
+        "The old values of the changed attributes"
+        return self.changed
+
+    def _reconstruct_values(self):
+        "Rebuild the values before and after this change"
+        changes = list(LogbookChange.select()
+                       .where((LogbookChange.logbook == self.logbook_id) &
+                              (LogbookChange.id >= self.id))
+                       .order_by(LogbookChange.id))
+        self.old_values, self.new_values, *_ = reconstruct_revisions(
+            self.logbook.revision_values, changes)
+
     def get_old_value(self, attr):
 
         """Get the value of the attribute at the time of this revision.
         That is, *before* the change happened."""
 
-        # First check if the attribute was changed in this revision,
-        # in that case we return that.
-        if attr in self.changed:
-            return self.changed[attr]
-        # Otherwise, check for the next revision where this attribute
-        # changed; the value from there must be the current value
-        # at this revision.
-        try:
-            change = (LogbookChange.select()
-                      .where((LogbookChange.logbook == self.logbook) &
-                             (LogbookChange.changed.extract(attr) != None) &
-                             (LogbookChange.id > self.id))
-                      .order_by(LogbookChange.id)
-                      .get())
-            return change.changed[attr]
-        except DoesNotExist:
-            # No later revisions changed the attribute either, so we can just
-            # take the value from the current logbook
-            return getattr(self.logbook, attr)
+        if self.old_values is None:
+            self._reconstruct_values()
+        return self.old_values[attr]
 
     def get_new_value(self, attr):
 
-        """Get the value of the attribute at the time of this revision.
-        That is, *before* the change happened."""
+        """Get the value of the attribute after this revision happened.
+        If it was not changed, it'll just be the same as before."""
 
-        # check for the next revision where this attribute
-        # changed; the value from there must be the current value
-        # at this revision.
-        try:
-            change = (LogbookChange.select()
-                      .where((LogbookChange.logbook == self.logbook) &
-                             (LogbookChange.changed.extract(attr) != None) &
-                             (LogbookChange.id > self.id))
-                      .order_by(LogbookChange.id)
-                      .get())
-            return change.changed[attr]
-        except DoesNotExist:
-            # No later revisions changed the attribute, so we can just
-            # take the value from the current logbook
-            return getattr(self.logbook, attr)
+        if self.new_values is None:
+            self._reconstruct_values()
+        return self.new_values[attr]
 
 
 class LogbookRevision:
 
     """Represents a historical version of a Logbook."""
 
-    def __init__(self, change):
+    attributes = ("name", "description", "template", "attributes",
+                  "archived", "parent_id")
+
+    def __init__(self, change, revision_n=None, values=None):
         self.change = change
+        if revision_n is None:
+            revision_n = (LogbookChange.select()
+                          .where((LogbookChange.logbook == change.logbook_id) &
+                                 (LogbookChange.id < change.id))
+                          .count())
+        self.revision_n = revision_n
+        if values is None:
+            change._reconstruct_values()
+            values = change.old_values
+        self.values = values
 
     def __getattr__(self, attr):
         if attr == "id":
             return self.change.logbook.id
-        if attr == "revision_n":
-            return list(self.change.logbook.changes).index(self.change)
 
-        if attr in ("name", "description", "template", "attributes",
-                    "archived", "parent_id"):
-            return self.change.get_old_value(attr)
+        if attr in self.attributes:
+            return self.values[attr]
 
         return getattr(self.change.logbook, attr)
 
@@ -285,9 +462,74 @@ class LogbookRevision:
 DeferredEntry = DeferredRelation()
 
 
-# class EntrySearch(FTS5Model):
-#     entry = ForeignKeyField(DeferredEntry)
-#     content = SearchField()
+class LogbookClosure(Model):
+
+    """
+    The logbook hierarchy, stored as one row for each pair of a logbook
+    and one of its ancestors (including itself, at depth 0). This way
+    all descendants or ancestors of a logbook can be found without
+    recursive queries. Kept up to date in Logbook.save.
+    """
+
+    class Meta:
+        database = db
+        primary_key = CompositeKey("ancestor", "descendant")
+        indexes = (
+            (("descendant", "depth"), False),
+        )
+
+    ancestor = ForeignKeyField(Logbook, related_name="descendant_links")
+    descendant = ForeignKeyField(Logbook, related_name="ancestor_links")
+    depth = IntegerField()
+
+    @classmethod
+    def link(cls, logbook):
+        "Make sure the logbook is placed under its current parent"
+        current = {ancestor: depth for ancestor, depth in
+                   (cls.select(cls.ancestor, cls.depth)
+                    .where((cls.descendant == logbook.id) & (cls.depth <= 1))
+                    .tuples())}
+        parent_id = logbook.parent_id
+        if (current.get(logbook.id) == 0 and
+                (parent_id is None and len(current) == 1 or
+                 current.get(parent_id) == 1)):
+            return  # nothing has changed
+        cls.insert(ancestor=logbook.id, descendant=logbook.id,
+                   depth=0).upsert().execute()
+        # Detach the logbook, and its whole subtree, from the old ancestors
+        db.execute_sql("""
+            DELETE FROM logbookclosure
+            WHERE descendant_id IN (SELECT descendant_id FROM logbookclosure
+                                    WHERE ancestor_id = ?)
+              AND ancestor_id NOT IN (SELECT descendant_id FROM logbookclosure
+                                      WHERE ancestor_id = ?)""",
+                       (logbook.id, logbook.id))
+        # ...and attach it to the new ones
+        if parent_id is not None:
+            db.execute_sql("""
+                INSERT INTO logbookclosure (ancestor_id, descendant_id, depth)
+                SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM logbookclosure AS a, logbookclosure AS d
+                WHERE a.descendant_id = ? AND d.ancestor_id = ?""",
+                           (parent_id, logbook.id))
+
+    @classmethod
+    def rebuild(cls):
+        "Throw away the table and recreate it from the logbooks"
+        with db.atomic():
+            cls.delete().execute()
+            db.execute_sql("""
+                INSERT INTO logbookclosure (ancestor_id, descendant_id, depth)
+                WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+                    SELECT id, id, 0 FROM logbook
+                    UNION ALL
+                    SELECT logbook.parent_id, closure.descendant_id,
+                           closure.depth + 1
+                    FROM logbook JOIN closure
+                      ON logbook.id = closure.ancestor_id
+                    WHERE logbook.parent_id IS NOT NULL
+                )
+                SELECT ancestor_id, descendant_id, depth FROM closure""")
 
 
 class MLStripper(HTMLParser):
@@ -311,6 +553,134 @@ def strip_tags(html):
     return s.get_data()
 
 
+class EntrySearch(FTS5Model):
+
+    """
+    Full text index of entry titles and contents. The rowid is the
+    same as the id of the indexed entry.
+
+    The "trigram" tokenizer means that we can use the index for
+    (case insensitive) substring matching, just like the REGEXP
+    searches do for plain words. Terms shorter than three characters
+    can't be matched this way though.
+    """
+
+    class Meta:
+        database = db
+        extension_options = {"tokenize": "trigram"}
+
+    title = SearchField()
+    content = SearchField()
+
+    # Set in setup_database, depending on what the SQLite library supports
+    enabled = False
+
+    @classmethod
+    def index_entry(cls, entry, text=None):
+        """Add the entry to the index, replacing any previous version.
+        The plain text content is computed unless given."""
+        if text is None:
+            text = entry.text_content
+        (cls.insert(rowid=entry.id, title=entry.title or "",
+                    content=text)
+         .upsert()
+         .execute())
+
+    @classmethod
+    def rebuild(cls, chunk_size=1000):
+        "Throw away the index and recreate it from the entries"
+        with db.atomic():
+            cls.delete().execute()
+            last_id = 0
+            while True:
+                entries = list(Entry.select()
+                               .where(Entry.id > last_id)
+                               .order_by(Entry.id)
+                               .limit(chunk_size))
+                if not entries:
+                    break
+                for entry in entries:
+                    cls.index_entry(entry)
+                last_id = entries[-1].id
+
+
+# Characters that have a special meaning in a regular expression. If a
+# search term contains none of them, it's just a plain string.
+REGEXP_SPECIAL_CHARACTERS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+
+def is_literal(term):
+    "Check if a search term is a plain string, as opposed to a regexp"
+    return not REGEXP_SPECIAL_CHARACTERS.search(term)
+
+
+def fts_term(term):
+    """Return a FTS5 query string equivalent to searching for the given
+    term, or None if the full text index can't be used for it."""
+    if not EntrySearch.enabled:
+        return None
+    if len(term) < 3 or not is_literal(term):
+        return None
+    # a quoted string is matched as-is, escape any quotes inside it
+    return '"{}"'.format(term.replace('"', '""'))
+
+
+# Every so often we store the full content in a change, instead of a
+# patch. Otherwise, getting to a very old revision of an often
+# edited entry would mean applying lots of patches. This is the number
+# of changes to the content between each full copy.
+CONTENT_SNAPSHOT_INTERVAL = 10
+
+
+PREVIEW_LENGTH = 200
+
+# SQLite may not allow more than 999 variables in one statement, which
+# limits the number of rows per insert, and ids per update.
+INSERT_CHUNK_SIZE = 50
+UPDATE_CHUNK_SIZE = 500
+
+
+def chunks(items, size):
+    "Split the list into lists of at most the given size"
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def make_preview(text):
+    "The beginning of the text, on one line"
+    preview = text.strip()[:PREVIEW_LENGTH].strip().replace("\n", " ")
+    return preview or None
+
+
+def text_condition(column, term):
+    """Return SQL that matches the column against the search term (a
+    case insensitive regexp), and the parameter to go with it."""
+    try:
+        term.encode("ascii")
+        ascii = True
+    except UnicodeEncodeError:
+        ascii = False
+    # SQLite's lower() only knows about ASCII
+    if is_literal(term) and ascii:
+        # plain substring search, no need to involve python
+        return "instr(lower({}), ?) > 0".format(column), term.lower()
+    return "{} REGEXP ?".format(column), term
+
+
+def store_content(old_content, new_content, snapshot=False):
+    """Return the way to store the old content in a change. To save
+    space it's normally stored as a (reverse) patch against the new
+    content, see EntryChange.get_changed, unless a snapshot (i.e. the
+    full content) is asked for."""
+    if (snapshot or
+            not isinstance(old_content, str) or
+            not isinstance(new_content, str)):
+        return old_content
+    patch = make_patch(new_content, old_content)
+    if len(patch) >= len(old_content):
+        return old_content  # no point
+    return {"patch": patch}
+
+
 def convert_attributes(logbook, attributes):
     converted = {}
     for name, value in attributes.items():
@@ -349,6 +719,15 @@ class Entry(Model):
     last_changed_at = UTCDateTimeField(null=True)
     follows = ForeignKeyField("self", null=True, related_name="followups")
     archived = BooleanField(default=False)
+    # Summary of the entry and its followups, used when listing threads.
+    # They are kept up to date in save, see update_thread_summaries.
+    thread_last_activity = UTCDateTimeField(null=True)
+    n_followups = IntegerField(default=0)
+    followup_authors = JSONField(default=[])  # names, without duplicates
+    # The content as plain text, and the beginning of it. Set in save.
+    content_text = TextField(null=True)
+    preview = TextField(null=True)
+    change_seq = IntegerField(null=True, index=True)  # see ChangeSequence
 
     def __str__(self):
         return "[{}] {}".format(self.id, self.title)
@@ -356,24 +735,152 @@ class Entry(Model):
     class Locked(Exception):
         pass
 
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            # store the plain text, so that we don't need to parse
+            # the HTML when listing or searching
+            self.content_text = self.text_content
+            self.preview = make_preview(self.content_text)
+            self.change_seq = ChangeSequence.next()
+            result = super().save(*args, **kwargs)
+            # keep the thread summaries in sync
+            Entry.update_thread_summaries(
+                [self.id] + ([self.follows_id] if self.follows_id else []))
+            Logbook.touch([self.logbook_id])
+            # keep the full text index in sync
+            if EntrySearch.enabled:
+                EntrySearch.index_entry(self, self.content_text)
+        return result
+
+    @classmethod
+    def create_many(cls, entries):
+        """Create lots of entries at once, which is much faster than
+        saving them one by one. Each entry is a dict of field values,
+        where "follows" may also be one of the other dicts, if it comes
+        earlier in the list. Returns the ids of the new entries, in the
+        same order. Note that no signals are sent."""
+        if not entries:
+            return []
+        with db.atomic():
+            # this gets us the write lock, so from here on nobody else
+            # can take the ids we are about to use
+            first_seq = ChangeSequence.next(len(entries)) - len(entries) + 1
+            first_id = (Entry.select(fn.max(Entry.id)).scalar() or 0) + 1
+            ids = {}  # python id of the dict -> entry id
+            rows = []
+            for i, values in enumerate(entries):
+                follows = values.get("follows")
+                if isinstance(follows, dict):
+                    if id(follows) not in ids:
+                        raise ValueError(
+                            "Entry {} follows an entry that does not come"
+                            " before it".format(i))
+                    values = dict(values, follows=ids[id(follows)])
+                entry = Entry(**values)
+                entry.id = ids[id(entries[i])] = first_id + i
+                entry.content_text = entry.text_content
+                entry.preview = make_preview(entry.content_text)
+                entry.change_seq = first_seq + i
+                rows.append(entry)
+            for chunk in chunks(rows, INSERT_CHUNK_SIZE):
+                # the rows must all have the same fields
+                (Entry.insert_many([{field: entry._data.get(field.name)
+                                     for field in Entry._meta.sorted_fields}
+                                    for entry in chunk])
+                 .execute())
+                if EntrySearch.enabled:
+                    (EntrySearch
+                     .insert_many([dict(rowid=entry.id,
+                                        title=entry.title or "",
+                                        content=entry.content_text)
+                                   for entry in chunk])
+                     .execute())
+            thread_ids = set(entry.id for entry in rows)
+            thread_ids.update(entry.follows_id for entry in rows
+                              if entry.follows_id)
+            for chunk in chunks(sorted(thread_ids), UPDATE_CHUNK_SIZE):
+                Entry.update_thread_summaries(chunk)
+            Logbook.touch(list(set(entry.logbook_id for entry in rows)))
+        return [entry.id for entry in rows]
+
+    @classmethod
+    def update_thread_summaries(cls, entry_ids=None):
+        """Recalculate the thread summary columns of the given entries,
+        from their direct followups. Default is all entries."""
+        query = """
+        UPDATE entry SET
+            thread_last_activity = (
+                SELECT max(coalesce(e.last_changed_at, e.created_at))
+                FROM entry AS e
+                WHERE e.id = entry.id OR e.follows_id = entry.id),
+            n_followups = (
+                SELECT count(*) FROM entry AS followup
+                WHERE followup.follows_id = entry.id),
+            followup_authors = (
+                SELECT json_group_array(name) FROM (
+                    SELECT json_extract(author.value, '$.name') AS name
+                    FROM entry AS followup, json_each(followup.authors) AS author
+                    WHERE followup.follows_id = entry.id
+                    GROUP BY name
+                    -- in order of appearance
+                    ORDER BY min(followup.id * 10000 + author.key)))
+        """
+        if entry_ids is None:
+            db.execute_sql(query)
+        else:
+            query += " WHERE entry.id IN ({})".format(
+                ", ".join("?" for _ in entry_ids))
+            db.execute_sql(query, entry_ids)
+
     @property
     def _thread(self):
-        entries = []
-        if self.follows:
-            entry = Entry.get(Entry.id == self.follows_id)
-            while True:
-                entries.append(entry)
-                if entry.follows_id:
-                    try:
-                        entry = Entry.get(Entry.id == entry.follows_id)
-                    except DoesNotExist:
-                        break
-                else:
-                    break
-        if entries:
-            return entries[-1]
+        "The main entry of the thread this entry belongs to"
+        if not self.follows_id:
+            return self
+        # walk up the chain of followed entries, in one query
+        query = """
+        WITH RECURSIVE thread(id, follows_id, depth) AS (
+            SELECT id, follows_id, 1 FROM entry WHERE id = ?
+            UNION ALL
+            SELECT entry.id, entry.follows_id, thread.depth + 1
+            FROM entry, thread
+            WHERE entry.id = thread.follows_id
+        )
+        SELECT entry.* FROM entry JOIN thread ON entry.id == thread.id
+        ORDER BY thread.depth DESC LIMIT 1
+        """
+        for entry in Entry.raw(query, self.follows_id):
+            return entry
         return self
 
+    def prefetch_followups(self):
+        """Load all followups of the entry, to any depth, along with
+        their attachments, using a fixed number of queries. The result
+        is stored in the "_prefetched_followups" and
+        "_prefetched_attachments" attributes of each entry in the
+        thread, as lists, leaving the relations themselves alone."""
+        query = """
+        WITH RECURSIVE thread(id) AS (
+            SELECT id FROM entry WHERE follows_id = ?
+            UNION ALL
+            SELECT entry.id FROM entry, thread
+            WHERE entry.follows_id = thread.id
+        )
+        SELECT entry.* FROM entry JOIN thread ON entry.id == thread.id
+        ORDER BY entry.id
+        """
+        entries = [self] + list(Entry.raw(query, self.id))
+        followups = {entry.id: [] for entry in entries}
+        attachments = {entry.id: [] for entry in entries}
+        for entry in entries[1:]:
+            followups[entry.follows_id].append(entry)
+        for attachment in Attachment.select().where(
+                Attachment.entry << list(attachments)):
+            attachments[attachment.entry_id].append(attachment)
+        for entry in entries:
+            entry._prefetched_followups = followups[entry.id]
+            entry._prefetched_attachments = attachments[entry.id]
+
     @property
     def next(self):
         "Next entry (order by id)"
@@ -415,6 +922,10 @@ class Entry(Model):
             if hasattr(self, attr) and getattr(self, attr) != value
         }
         # TODO: what should we do if the new data is the same as the old?
+        if "content" in original_values:
+            original_values["content"] = store_content(
+                original_values["content"], data["content"],
+                snapshot=self._needs_content_snapshot())
         change = EntryChange(entry=self, changed=original_values)
         for attr in original_values:
             value = data[attr]
@@ -427,35 +938,93 @@ class Entry(Model):
             self.last_changed_at = change.timestamp
         return change
 
+    def _needs_content_snapshot(self):
+        """Whether the next change to the content should store all of
+        it, i.e. if none of the latest changes to it did."""
+        if self.id is None:
+            return True
+        stored_as = [row[0] for row in db.execute_sql(
+            "SELECT json_type(changed, '$.content') FROM entrychange"
+            " WHERE entry_id = ? AND json_type(changed, '$.content')"
+            " IS NOT NULL ORDER BY id DESC LIMIT ?",
+            (self.id, CONTENT_SNAPSHOT_INTERVAL - 1))]
+        return all(how == "object" for how in stored_as)  # all patches
+
     @property
     def revision_n(self):
-        return len(self.changes)
+        return self.changes.count()
+
+    @property
+    def revision_values(self):
+        "The current values of the attributes that are kept in revisions"
+        return {attr: getattr(self, attr)
+                for attr in EntryRevision.attributes}
+
+    def get_changes(self):
+        """Return all changes to the entry, oldest first, with their
+        old and new values filled in"""
+        changes = list(self.changes.order_by(EntryChange.id))
+        revisions = reconstruct_revisions(self.revision_values, changes)
+        for change, old, new in zip(changes, revisions, revisions[1:]):
+            change.old_values = old
+            change.new_values = new
+        return changes
 
     def get_revision(self, version):
-        if version == self.revision_n:
-            return self
-        if 0 <= version < self.revision_n:
-            return EntryRevision(self.changes[version])
+        if version >= 0:
+            # we only need the changes since the revision
+            first_change = (EntryChange.select(EntryChange.id)
+                            .where(EntryChange.entry == self)
+                            .order_by(EntryChange.id)
+                            .limit(1)
+                            .offset(version))
+            changes = list(EntryChange.select()
+                           .where((EntryChange.entry == self) &
+                                  (EntryChange.id >= first_change))
+                           .order_by(EntryChange.id))
+            if changes:
+                old_values = reconstruct_entry_values(self.revision_values,
+                                                      changes)
+                return EntryRevision(changes[0], version, old_values)
+            if version == self.revision_n:
+                return self
         raise(EntryChange.DoesNotExist)
 
-    # def get_old_version(self, revision_id):
-    #     revisions = (EntryChange.select()
-    #                  .where(EntryChange.entry == self
-    #                         and EntryChange.id >= revision_id)
-    #                  .order_by(EntryChange.id.desc()))
-    #     content = self.content
-    #     print(content)
-    #     print("---")
-    #     for revision in revisions:
-    #         print(revision.content)
-    #         if revision.content:
-    #             content = apply_patch(content, revision.content)
-    #     return content
+    def compress_changes(self):
+        """Convert the content of all stored changes to the format used
+        by store_content. Returns the number of changes converted."""
+        changes = self.get_changes()
+        converted = 0
+        patches = None  # since the last snapshot
+        for change in changes:
+            if "content" not in change.changed:
+                continue
+            snapshot = (patches is None or
+                        patches >= CONTENT_SNAPSHOT_INTERVAL - 1)
+            content = store_content(change.old_values["content"],
+                                    change.new_values["content"],
+                                    snapshot=snapshot)
+            patches = (patches or 0) + 1 if isinstance(content, dict) else 0
+            if content != change.changed["content"]:
+                change.changed = dict(change.changed, content=content)
+                change.save()
+                converted += 1
+        return converted
 
     @property
     def stripped_content(self):
         return strip_tags(self.content)
 
+    @property
+    def text_content(self):
+        """The content as plain text, without any markup. Note that
+        this is computed, use content_text if the entry is saved."""
+        if not self.content:
+            return ""
+        if self.content_type.startswith("text/html"):
+            return self.stripped_content
+        return self.content
+
     def get_attachments(self, embedded=False):
         return self.attachments.filter((Attachment.embedded == embedded) &
                                        ~Attachment.archived)
@@ -489,16 +1058,56 @@ class Entry(Model):
     @classmethod
     def search(cls, logbook=None, followups=False,
                child_logbooks=False, archived=False,
-               n=None, offset=0, count=False,
+               n=None, offset=0, count=False, total_count=False,
+               after=None, ranked=True, ordered=True,
                attribute_filter=None, content_filter=None,
                title_filter=None, author_filter=None,
                attachment_filter=None):
 
+        # The results are sorted on (priority, timestamp, id), in
+        # descending order. "after" may be such a tuple, taken from the
+        # last result of a previous page. Then only results that come
+        # after it are returned; a more efficient way of paging than
+        # using "offset". Ordering by how well the entries match a text
+        # search is incompatible with this, see "ranked". If "ordered" is
+        # False, the results come in whatever order is quickest.
+
         # Note: this is all pretty messy. The reason we're building
-        # the query as a raw string is that peewee does not (currently)
-        # support recursive queries, which we need in order to search
+        # the query as a raw string is that peewee did not support
+        # recursive queries, which we used to need in order to search
         # through nested logbooks. Cleanup needed!
 
+        searching = any([title_filter, content_filter, author_filter])
+        variables = []
+
+        if count:
+            what = "count(DISTINCT entry.id)"
+        elif total_count:
+            # include the total number of results (disregarding n and
+            # offset) in each row, saving a separate count query
+            what = "entry.*, count(*) OVER () AS total_count"
+        else:
+            what = "entry.*"
+
+        # Plain text filters on title and content can be looked up
+        # in the full text index instead of running REGEXP on each entry.
+        fts_terms = []
+        if title_filter and fts_term(title_filter):
+            fts_terms.append("title : {}".format(fts_term(title_filter)))
+            title_filter = None
+        if content_filter and fts_term(content_filter):
+            fts_terms.append("content : {}".format(fts_term(content_filter)))
+            content_filter = None
+        if fts_terms:
+            # The "rank" column is the bm25 score of the match
+            join_search = """
+            JOIN (SELECT rowid AS entry_id, rank AS search_rank
+                  FROM entrysearch WHERE entrysearch MATCH ?) AS hits
+              ON hits.entry_id == entry.id"""
+            variables.append(" AND ".join(fts_terms))
+        else:
+            join_search = ""
+
         if author_filter:
             # extract the author names as a separate table, so that
             # they can be searched
@@ -519,139 +1128,87 @@ class Entry(Model):
         else:
             attributes = ""
 
-        if logbook:
-            if child_logbooks:
-                # recursive query to find all entries in the given logbook
-                # or any of its descendants, to arbitrary depth, and also
-                # any high priority ("important") entries in ancestors
-                query = """
-                -- recursively add all 'descentant' logbooks (children, grandchilren, ...)
-                WITH RECURSIVE logbook1(id,parent_id) AS (
-                    values({logbook}, NULL)  -- parent logbook
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook1
-                    WHERE logbook.parent_id=logbook1.id
-                ),
-                -- recursively add all 'ancestor' logbooks (parent, grandparent, ...)
-                logbook2(id,parent_id) AS (
-                    SELECT id, parent_id from logbook WHERE id = {logbook}
-                    UNION ALL
-                    SELECT logbook.id, logbook.parent_id FROM logbook,logbook2
-                    WHERE logbook2.parent_id=logbook.id
-                )
-                SELECT {what}{attributes},
-                    {attachment}
-                    -- 'thread' is the id of the main entry, ignoring followups
-                    coalesce(followup.follows_id, entry.id) AS thread,
-                    count(distinct(followup.id)) AS n_followups,
-                    -- 'timestamp' is the latest modification time in the thread
-                    max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                    -- collect authors from all followups
-                    json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                FROM entry{authors}
-                JOIN logbook1
-                JOIN logbook2
-                {join_attachment}
-                LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                WHERE (entry.logbook_id=logbook1.id
-                       OR (entry.priority>100 AND entry.logbook_id=logbook2.id))
-                """.format(what=("COUNT(distinct(coalesce(followup.follows_id, entry.id))) AS count"
-                                 if count else "entry.*"),
-                           attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                           authors=authors, logbook=logbook.id,
-                           attributes=attributes,
-                           join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                            if attachment_filter else ""))
-            else:
-                # In this case we're not searching recursively
-                query = (
-                    """
-                    SELECT {what}{attributes},
-                      {attachment}
-                      coalesce(followup.follows_id, entry.id) AS thread,
-                      count(followup.id) AS n_followups,
-                      max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                        coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                      json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-                    FROM entry{authors}
-                    {join_attachment}
-                    LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-                    WHERE entry.logbook_id = {logbook}"""
-                    .format(what="count()" if count else "entry.*",
-                            attachment=("attachment.path as attachment_path,"
-                                       if attachment_filter else ""),
-                            authors=authors,
-                            attributes=attributes,
-                            logbook=logbook.id,
-                            join_attachment=("JOIN attachment ON attachment.entry_id == entry.id"
-                                             if attachment_filter else "")))
-
+        if logbook and child_logbooks:
+            # all entries in the given logbook or any of its descendants,
+            # to arbitrary depth, and also any high priority ("important")
+            # entries in ancestors (see LogbookClosure)
+            logbook_filter = """(
+                entry.logbook_id IN (
+                    SELECT descendant_id FROM logbookclosure
+                    WHERE ancestor_id = {logbook})
+                OR (entry.priority>100 AND entry.logbook_id IN (
+                    SELECT ancestor_id FROM logbookclosure
+                    WHERE descendant_id = {logbook})))""".format(
+                        logbook=logbook.id)
+        elif logbook:
+            logbook_filter = "entry.logbook_id = {}".format(logbook.id)
         else:
             # In this case we're searching all entries and don't need
-            # the recursive logbook filtering. This always includes
-            # child logbooks.
-            query = """
-            SELECT {what}{attributes},
-                {attachment}
-                coalesce(followup.follows_id, entry.id) AS thread,
-                count(followup.id) AS n_followups,
-                max(datetime(coalesce(coalesce(followup.last_changed_at,followup.created_at),
-                    coalesce(entry.last_changed_at,entry.created_at)))) AS timestamp,
-                json_group_array(json(ifnull(followup.authors, "[]"))) as followup_authors
-            FROM entry{authors}
-            {join_attachment}
-            LEFT JOIN entry AS followup ON entry.id == followup.follows_id
-            WHERE 1
-            """.format(what="count()" if count else "entry.*",
-                       attributes=attributes,
-                       attachment=("path as attachment_path,"
-                                   if attachment_filter else ""),
-                       authors=authors,
-                       join_attachment=(
-                           "JOIN attachment ON attachment.entry_id == entry.id"
-                           if attachment_filter else ""))
+            # the logbook filtering. This always includes child logbooks.
+            logbook_filter = "1"
+
+        # The thread summary ('timestamp' being the latest modification
+        # in the thread, n_followups and followup_authors) is stored on
+        # each entry, see update_thread_summaries.
+        query = """
+        SELECT {what}{attributes}{attachment}
+        FROM entry{authors}
+        {join_attachment}{join_search}
+        WHERE {logbook_filter}
+        """.format(what=(what if count else
+                         what + ", entry.thread_last_activity AS timestamp"),
+                   attributes=attributes,
+                   attachment=(", attachment.path AS attachment_path"
+                               if attachment_filter else ""),
+                   authors=authors,
+                   join_attachment=(
+                       "JOIN attachment ON attachment.entry_id == entry.id"
+                       if attachment_filter else ""),
+                   join_search=join_search,
+                   logbook_filter=logbook_filter)
 
         if not archived:
             query += " AND NOT entry.archived\n"
 
-        variables = []
-
-        # if not followups:
-        #     query += " AND entry.follows_id IS NULL"
+        # When we're searching, we want to find individual followups too,
+        # otherwise only the main entries of the threads (unless asked).
+        if not (searching or followups):
+            query += " AND entry.follows_id IS NULL\n"
 
         # further filters on the results, depending on search criteria
-        if content_filter:
-            # need to filter out null or REGEX will explode on them
-            query += " AND entry.content IS NOT NULL AND entry.content REGEXP ?\n"
-            variables.append(content_filter)
-        if title_filter:
-            query += " AND entry.title IS NOT NULL AND entry.title REGEXP ?\n"
-            variables.append(title_filter)
-        if author_filter:
-            query += " AND json_extract(authors2.value, '$.name') REGEXP ?\n"
-            variables.append(author_filter)
-        if attachment_filter:
-            query += " AND attachment_path REGEXP ?\n"
-            variables.append(attachment_filter)
+        for column, term in [("entry.content_text", content_filter),
+                             ("entry.title", title_filter),
+                             ("json_extract(authors2.value, '$.name')",
+                              author_filter),
+                             ("attachment_path", attachment_filter)]:
+            if term:
+                condition, variable = text_condition(column, term)
+                query += " AND {}\n".format(condition)
+                variables.append(variable)
         if attribute_filter:
             for i, (attr, value) in enumerate(attribute_filter):
                 query += " AND attr{} LIKE ?".format(i)
                 variables.append('%{}%'.format(value))
-
-        # Here we're getting into deep water...
-        # If we just want the total count of results, we can't group
-        # because then the count would be per group. So that makes sense.
-        # However, when we're searching, we also don't want the grouping
-        # because it means we won't find individual followups
-        if not count:
+        if after and not count:
+            query += (" AND (entry.priority, entry.thread_last_activity,"
+                      " entry.id) < (?, ?, ?)\n")
+            variables.extend(after)
+
+        # Matching several authors or attachments gives several rows
+        # for the same entry.
+        if (author_filter or attachment_filter) and not count:
             query += " GROUP BY entry.id"
-            if not any([title_filter, content_filter, author_filter]):
-                query += " HAVING entry.follows_id IS NULL"
+
         # sort newest first, taking into account the last edit if any
         # TODO: does this make sense? Should we only consider creation date?
-        query += " ORDER BY entry.priority DESC, timestamp DESC"
+        if ordered and not count:
+            if fts_terms and ranked:
+                # best text matches first
+                query += (" ORDER BY entry.priority DESC, hits.search_rank,"
+                          " entry.thread_last_activity DESC, entry.id DESC")
+            else:
+                query += (" ORDER BY entry.priority DESC,"
+                          " entry.thread_last_activity DESC, entry.id DESC")
         if n:
             query += " LIMIT {}".format(n)
             if offset:
@@ -659,6 +1216,60 @@ class Entry(Model):
         logging.debug("query=%r, variables=%r" % (query, variables))
         return Entry.raw(query, *variables)
 
+    @classmethod
+    def prefetch_related(cls, entries):
+        """Look up the logbooks and attachments of the given entries in
+        bulk, instead of doing several queries for each entry. Sets
+        "logbook", "n_attachments" and "attachment_preview" (the first
+        attachment, if any) on each entry."""
+        if not entries:
+            return
+        logbooks = {
+            logbook.id: logbook
+            for logbook in Logbook.select().where(
+                Logbook.id << set(e.logbook_id for e in entries))
+        }
+        attachment_counts = {
+            entry_id: (n, first_id)
+            for entry_id, n, first_id in (
+                Attachment.select(Attachment.entry,
+                                  fn.count(Attachment.id),
+                                  fn.min(Attachment.id))
+                .where(Attachment.entry << [e.id for e in entries])
+                .group_by(Attachment.entry)
+                .order_by()
+                .tuples())
+        }
+        first_ids = [first_id for _, first_id in attachment_counts.values()]
+        first_attachments = {
+            attachment.id: attachment
+            for attachment in Attachment.select().where(
+                Attachment.id << first_ids)
+        } if first_ids else {}
+        for entry in entries:
+            entry.logbook = logbooks[entry.logbook_id]
+            n, first_id = attachment_counts.get(entry.id, (0, None))
+            entry.n_attachments = n
+            entry.attachment_preview = first_attachments.get(first_id)
+
+    @classmethod
+    def search_with_count(cls, **kwargs):
+        """Like search, but returns a list of the resulting entries and
+        the total number of hits, ignoring n and offset. If SQLite
+        supports window functions, it only takes one query."""
+        if WINDOW_FUNCTIONS:
+            entries = list(cls.search(total_count=True, **kwargs))
+            if entries:
+                return entries, entries[0].total_count
+            if not kwargs.get("offset"):
+                return entries, 0
+            # we're past the last page, so we don't know the count
+        else:
+            entries = list(cls.search(**kwargs))
+        result = list(cls.search(count=True, **kwargs).tuples())
+        count = result[0][0] if result else 0
+        return entries, count
+
 
 DeferredEntry.set_model(Entry)
 
@@ -690,51 +1301,48 @@ class EntryChange(Model):
     change_comment = TextField(null=True)
     change_ip = CharField(null=True)
 
+    # Filled in by Entry.get_changes, if used. Otherwise the database
+    # is queried for them when needed.
+    old_values = None
+    new_values = None
+
+    def get_changed(self, new_values):
+        """The old values of the changed attributes. The content may be
+        stored as a patch, so we need the new values to get at it."""
+        changed = dict(self.changed)
+        content = changed.get("content")
+        if isinstance(content, dict):
+            changed["content"] = apply_patch(new_values["content"],
+                                             content["patch"])
+        return changed
+
+    def _reconstruct_values(self):
+        "Rebuild the values before and after this change"
+        changes = list(EntryChange.select()
+                       .where((EntryChange.entry == self.entry_id) &
+                              (EntryChange.id >= self.id))
+                       .order_by(EntryChange.id))
+        current = self.entry.revision_values
+        self.old_values = reconstruct_entry_values(current, changes)
+        self.new_values = reconstruct_entry_values(current, changes[1:])
+
     def get_old_value(self, attr):
 
         """Get the value of the attribute at the time of this revision.
         That is, *before* the change happened."""
 
-        # First check if the attribute was changed in this revision,
-        # in that case we return the stored value.
-        if attr in self.changed:
-            return self.changed[attr]
-        # Otherwise, check for the next revision where this attribute
-        # changed; the value from there must be the current value
-        # at this revision.
-        try:
-            change = (EntryChange.select()
-                      .where((EntryChange.entry == self.entry) &
-                             (EntryChange.changed.extract(attr) != None) &
-                             (EntryChange.id > self.id))
-                      .order_by(EntryChange.id)
-                      .get())
-            return change.changed[attr]
-        except DoesNotExist:
-            # No later revisions changed the attribute either, so we can just
-            # take the value from the entry
-            return getattr(self.entry, attr)
+        if self.old_values is None:
+            self._reconstruct_values()
+        return self.old_values[attr]
 
     def get_new_value(self, attr):
 
         """Get the value of the attribute after this revision happened.
         If it was not changed, it'll just be the same as before."""
 
-        # Check for the next revision where this attribute changed;
-        # the value from there must also be the value after this
-        # revision.
-        try:
-            change = (EntryChange.select()
-                        .where((EntryChange.entry == self.entry) &
-                               (EntryChange.changed.extract(attr) != None) &
-                               (EntryChange.id > self.id))
-                        .order_by(EntryChange.id)
-                        .get())
-            return change.changed[attr]
-        except DoesNotExist:
-            # No later revisions changed the attribute, so we can just
-            # take the value from the entry
-            return getattr(self.entry, attr)
+        if self.new_values is None:
+            self._reconstruct_values()
+        return self.new_values[attr]
 
 
 class EntryRevision:
@@ -742,20 +1350,30 @@ class EntryRevision:
     """An object that represents a historical version of an entry. It
     can (basically) be used like an Entry object."""
 
-    def __init__(self, change):
+    attributes = ("logbook", "title", "authors", "content", "attributes",
+                  "metadata", "follows_id", "archived")
+
+    def __init__(self, change, revision_n=None, values=None):
         self.change = change
+        if revision_n is None:
+            revision_n = (EntryChange.select()
+                          .where((EntryChange.entry == change.entry_id) &
+                                 (EntryChange.id < change.id))
+                          .count())
+        self.revision_n = revision_n
+        if values is None:
+            change._reconstruct_values()
+            values = change.old_values
+        self.values = values
 
     def __getattr__(self, attr):
         if attr == "id":
             return self.change.entry.id
-        if attr == "revision_n":
-            return list(self.change.entry.changes).index(self.change)
-        if attr in ("logbook", "title", "authors", "content", "attributes",
-                    "metadata", "follows_id", "tags", "archived"):
-            return self.change.get_old_value(attr)
+        if attr in self.attributes:
+            return self.values[attr]
         if attr == "converted_attributes":
             return convert_attributes(self.change.entry.logbook,
-                                      self.change.get_old_value("attributes"))
+                                      self.values["attributes"])
         return getattr(self.change.entry, attr)
 
 
@@ -834,6 +1452,16 @@ class Attachment(Model):
     embedded = BooleanField(default=False)  # i.e. an image in the content
     metadata = JSONField(null=True)  # may contain image size, etc
     archived = BooleanField(default=False)
+    change_seq = IntegerField(null=True, index=True)  # see ChangeSequence
+
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            self.change_seq = ChangeSequence.next()
+            result = super().save(*args, **kwargs)
+            if self.entry_id is not None:
+                Logbook.touch(Entry.select(Entry.logbook)
+                              .where(Entry.id == self.entry_id))
+        return result
 
     @property
     def link(self):
@@ -842,3 +1470,129 @@ class Attachment(Model):
     @property
     def thumbnail_link(self):
         return url_for("get_attachment", path=self.path) + ".thumbnail"
+
+
+class Job(Model):
+    """A piece of work to be done in the background, see jobs.py.
+    Jobs are kept in the database so that they don't get lost if
+    the server is restarted before they have run."""
+
+    class Meta:
+        database = db
+
+    kind = CharField()  # decides which function will do the work
+    args = JSONField(default={})  # passed to the function
+    status = CharField(default="pending", index=True)
+    # pending -> running -> done/failed
+    attempts = IntegerField(default=0)
+    created_at = UTCDateTimeField(default=datetime.utcnow)
+    run_after = UTCDateTimeField(null=True)  # used for retrying later
+    started_at = UTCDateTimeField(null=True)
+    finished_at = UTCDateTimeField(null=True)
+    error = TextField(null=True)
+
+
+class Event(Model):
+    """A note that something has changed, e.g. a new entry has been
+    created, used to notify clients (see events.py). The ids are
+    increasing, so they can be used to keep track of what has been
+    seen. Events are only kept for a while."""
+
+    class Meta:
+        database = db
+
+    timestamp = UTCDateTimeField(default=datetime.utcnow, index=True)
+    kind = CharField()  # the name of the signal, e.g. "new_entry"
+    logbook = ForeignKeyField(Logbook)
+    entry = ForeignKeyField(Entry, null=True)
+
+    @classmethod
+    def since(cls, last_id, logbook=None, n=100):
+        """The events after the given id, oldest first. If a logbook
+        is given, only events in it or its descendants."""
+        query = (Event.select()
+                 .where(Event.id > last_id)
+                 .order_by(Event.id)
+                 .limit(n))
+        if logbook is not None:
+            query = query.where(Event.logbook << (
+                LogbookClosure.select(LogbookClosure.descendant)
+                .where(LogbookClosure.ancestor == logbook)))
+        return list(query)
+
+    @classmethod
+    def last_id(cls):
+        return Event.select(fn.max(Event.id)).scalar() or 0
+
+
+class ChangeSequence(Model):
+    """A counter that goes up each time a logbook, entry or attachment
+    is saved, and they get the new value as their "change_seq". Since
+    SQLite only allows one writer at a time, anything with a lower
+    number has been committed before anything with a higher one, which
+    makes it possible to keep a copy up to date, see get_changes_since.
+    """
+
+    class Meta:
+        database = db
+
+    value = IntegerField()
+
+    ID = 1  # there is only one row
+
+    @classmethod
+    def next(cls, n=1):
+        """Increase the counter, by n if several numbers are needed at
+        once. Returns the (last) new value. Must be done inside a
+        transaction."""
+        # writing first means that we get the write lock right away
+        if not (ChangeSequence.update(value=ChangeSequence.value + n)
+                .where(ChangeSequence.id == cls.ID)
+                .execute()):
+            ChangeSequence.create(id=cls.ID, value=n)
+        return cls.current()
+
+    @classmethod
+    def current(cls):
+        return (ChangeSequence.select(ChangeSequence.value)
+                .where(ChangeSequence.id == cls.ID)
+                .scalar()) or 0
+
+
+def get_changes_since(change_seq, logbook=None, n=1000):
+    """The logbooks, entries (including followups) and attachments that
+    have been created or changed after the given change_seq, at most n
+    in total. If a logbook is given, only things in it, or its
+    descendants, are included. Also returns the change_seq to ask
+    for next time."""
+    with db.atomic():  # everything from the same snapshot
+        logbooks = Logbook.select().where(Logbook.change_seq > change_seq)
+        entries = Entry.select().where(Entry.change_seq > change_seq)
+        # attachments are not interesting until they belong to an entry
+        attachments = (Attachment.select(Attachment, Entry.logbook)
+                       .join(Entry)
+                       .where(Attachment.change_seq > change_seq))
+        if logbook is not None:
+            subtree = (LogbookClosure.select(LogbookClosure.descendant)
+                       .where(LogbookClosure.ancestor == logbook))
+            logbooks = logbooks.where(Logbook.id << subtree)
+            entries = entries.where(Entry.logbook << subtree)
+            attachments = attachments.where(Entry.logbook << subtree)
+        results = {}
+        for name, query, model in [("logbooks", logbooks, Logbook),
+                                   ("entries", entries, Entry),
+                                   ("attachments", attachments, Attachment)]:
+            results[name] = list(query.order_by(model.change_seq).limit(n))
+        # Of course, we only return n changes in total. If there are
+        # more, the client has to come back for the rest.
+        seqs = sorted(item.change_seq for items in results.values()
+                      for item in items)
+        more = len(seqs) > n
+        if more:
+            last_seq = seqs[n - 1]
+            for name, items in results.items():
+                results[name] = [item for item in items
+                                 if item.change_seq <= last_seq]
+        else:
+            last_seq = max(change_seq, ChangeSequence.current())
+    return dict(results, last_seq=last_seq, more=more)
@@ -0,0 +1,61 @@
+"""
+Keep a log of changes, e.g. new entries, that clients can follow
+instead of repeatedly fetching the entry lists (see api/events.py).
+
+The log is a table in the database, so it works even if there are
+several server processes; each client just looks for new rows. The
+events are recorded when the same signals as the actions are sent.
+"""
+
+from datetime import datetime, timedelta
+from functools import partial
+import logging
+
+from .actions import signals
+from .db import db, Event, chunks, INSERT_CHUNK_SIZE
+
+
+# events older than this are removed
+KEEP_EVENTS = timedelta(hours=1)
+
+
+def record_event(kind, data):
+    "Store an event, given the result of an API call"
+    try:
+        if "entry" in data:
+            logbook_id = data["entry"]["logbook"]["id"]
+            entry_id = data["entry"]["id"]
+        else:
+            logbook_id, entry_id = data["logbook"]["id"], None
+        with db.atomic():
+            Event.create(kind=kind, logbook=logbook_id, entry=entry_id)
+            remove_old_events()
+    except Exception as e:
+        # the change itself has already been made
+        logging.error("Could not record event '%s': %s", kind, e)
+
+
+def record_entry_events(kind, logbook_id, entry_ids):
+    """Store an event for each of the entries in the logbook. Used when
+    there is no signal, e.g. when creating lots of entries at once."""
+    try:
+        with db.atomic():
+            for chunk in chunks(entry_ids, INSERT_CHUNK_SIZE):
+                (Event.insert_many([dict(kind=kind, logbook=logbook_id,
+                                         entry=entry_id,
+                                         timestamp=datetime.utcnow())
+                                    for entry_id in chunk])
+                 .execute())
+            remove_old_events()
+    except Exception as e:
+        logging.error("Could not record events '%s': %s", kind, e)
+
+
+def remove_old_events():
+    (Event.delete()
+     .where(Event.timestamp < datetime.utcnow() - KEEP_EVENTS)
+     .execute())
+
+
+for name, signal in signals.items():
+    signal.connect(partial(record_event, name), weak=False)
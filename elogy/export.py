@@ -1,15 +1,134 @@
-from tempfile import NamedTemporaryFile
+import csv
+from hashlib import sha1
+from io import StringIO
+import json
+import logging
+from multiprocessing import get_context
+import os
+from queue import Full
+from threading import get_ident, BoundedSemaphore, Lock
+from time import time
+
+from flask import current_app
+from peewee import fn
 
 try:
     import pdfkit
 except ImportError:
     pdfkit = None
 
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import cm
+    from reportlab.pdfgen.canvas import Canvas
+    from reportlab.platypus import Frame, Image, Paragraph, Spacer
+    from reportlab.platypus.flowables import HRFlowable
+except ImportError:
+    Canvas = None
+
+from .db import Entry, Logbook, Job, Attachment
+from . import jobs
+
+
+# Output is sent in pieces of about this size (characters)
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+EXPORT_FIELDS = ["id", "logbook_id", "follows_id", "created_at",
+                 "last_changed_at", "title", "authors", "priority",
+                 "archived", "content_type", "content"]
+
+
+def iter_entries(**search_args):
+    """Go through all the results of Entry.search, including followups,
+    in a single query. The results are not sorted, and not kept in
+    memory, so this works for any number of entries."""
+    results = Entry.search(followups=True, ordered=False,
+                           **search_args).execute()
+    while True:
+        try:
+            yield results.iterate()  # unlike iterating, this doesn't cache
+        except StopIteration:
+            return
+
+
+def entry_as_dict(entry):
+    return {
+        "id": entry.id,
+        "logbook_id": entry.logbook_id,
+        "follows_id": entry.follows_id,
+        "created_at": entry.created_at.isoformat(),
+        "last_changed_at": (entry.last_changed_at and
+                            entry.last_changed_at.isoformat()),
+        "title": entry.title,
+        "authors": entry.authors,
+        "priority": entry.priority,
+        "archived": entry.archived,
+        "content_type": entry.content_type,
+        "content": entry.content,
+        "attributes": entry.attributes or {}
+    }
+
+
+def export_entries_as_ndjson(entries):
+    "Generate JSON for the entries, one line each"
+    buffer = []
+    size = 0
+    for entry in entries:
+        line = json.dumps(entry_as_dict(entry)) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    yield "".join(buffer)
+
+
+def export_entries_as_csv(entries, attribute_names):
+    """Generate CSV for the entries, one row each. Each of the given
+    attributes gets a column, and author names are comma separated."""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_FIELDS + attribute_names)
+    for entry in entries:
+        data = entry_as_dict(entry)
+        data["authors"] = ", ".join(author["name"]
+                                    for author in entry.authors)
+        attributes = data["attributes"]
+        writer.writerow(
+            [data[field] for field in EXPORT_FIELDS] +
+            [format_attribute(attributes.get(name))
+             for name in attribute_names])
+        if output.tell() >= EXPORT_BUFFER_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
+def format_attribute(value):
+    if isinstance(value, list):  # multioption
+        return "; ".join(str(v) for v in value)
+    return value
 
-def export_entries_as_pdf(logbook, entries):
+
+def export_entries_as_pdf(logbook, entries, filename):
+    """Write a PDF of the entries to the given file, using the backend
+    chosen by the PDF_EXPORT_BACKEND setting ("reportlab" or "pdfkit").
+    By default reportlab is used, if installed. Returns False if the
+    backend is not available."""
+    backend = (current_app.config.get("PDF_EXPORT_BACKEND") or
+               ("reportlab" if Canvas else "pdfkit"))
+    if backend == "reportlab":
+        return export_entries_as_pdf_reportlab(logbook, entries, filename)
+    return export_entries_as_pdf_pdfkit(logbook, entries, filename)
+
+
+def export_entries_as_pdf_pdfkit(logbook, entries, filename):
 
     """
-    Super basic "proof-of-concept" PDF export
+    Super basic "proof-of-concept" PDF export, written to the given file.
+    Returns False if it's not possible.
     No proper formatting, and does not embed images.
     Note that pdfkit relies on the external library "wkhtmltopdf".
     TODO: pdfkit seems a bit limited, look for a more flexible alternative.
@@ -17,7 +136,7 @@ def export_entries_as_pdf(logbook, entries):
     """
 
     if pdfkit is None:
-        return None
+        return False
 
     entries_html = [
         """
@@ -32,23 +151,314 @@ def export_entries_as_pdf(logbook, entries):
         for entry in entries
     ]
 
-    with NamedTemporaryFile(prefix=logbook.name,
-                            suffix=".pdf",
-                            delete=False) as f:
-        options = {
-            "load-error-handling": "ignore",
-            "load-media-error-handling": "ignore",
-            'margin-top': '0.75in',
-            'margin-right': '0.75in',
-            'margin-bottom': '0.75in',
-            'margin-left': '0.75in',
-            'encoding': "UTF-8",
-        }
+    options = {
+        "load-error-handling": "ignore",
+        "load-media-error-handling": "ignore",
+        'margin-top': '0.75in',
+        'margin-right': '0.75in',
+        'margin-bottom': '0.75in',
+        'margin-left': '0.75in',
+        'encoding': "UTF-8",
+    }
+    try:
+        pdfkit.from_string("<hr>".join(entries_html), filename, options)
+    except OSError:
+        # Apparently there's some issue with wkhtmltopdf which produces
+        # errors, but it works anyway. See
+        # https://github.com/wkhtmltopdf/wkhtmltopdf/issues/2051
+        pass
+    return True
+
+
+def export_entries_as_pdf_reportlab(logbook, entries, filename):
+    """
+    PDF export that is done in python, using "reportlab". Laying out
+    the pages takes a lot of CPU, so it's done in a separate process
+    (see render_pdf); here we only look up what goes into the PDF, and
+    send it over a batch of entries at a time. The content is included
+    as plain text, followed by thumbnails of any attached images.
+    Returns False if reportlab is not installed.
+    """
+
+    if Canvas is None:
+        return False
+
+    deadline = time() + PDF_RENDER_TIMEOUT
+    slots = get_pdf_render_slots()
+    if not slots.acquire(timeout=PDF_RENDER_TIMEOUT):
+        raise jobs.JobTimeout("Waited too long for other PDF exports")
+    try:
+        # forking a process with threads running is asking for it
+        context = get_context("spawn")
+        batches = context.Queue(maxsize=2)
+        renderer = context.Process(
+            target=render_pdf, daemon=True,
+            args=(logbook.name if logbook else "elogy", batches, filename))
+        renderer.start()
         try:
-            pdfkit.from_string("<hr>".join(entries_html), f.name, options)
-        except OSError:
-            # Apparently there's some issue with wkhtmltopdf which produces
-            # errors, but it works anyway. See
-            # https://github.com/wkhtmltopdf/wkhtmltopdf/issues/2051
+            for batch in iter_pdf_entries(entries):
+                send_pdf_batch(renderer, batches, batch, deadline)
+            send_pdf_batch(renderer, batches, None, deadline)  # the end
+            renderer.join(max(deadline - time(), 0))
+            if renderer.is_alive():
+                raise jobs.JobTimeout("PDF rendering timed out after {} s"
+                                      .format(PDF_RENDER_TIMEOUT))
+            if renderer.exitcode != 0:
+                raise RuntimeError("PDF rendering failed")
+        finally:
+            if renderer.is_alive():
+                renderer.terminate()
+                renderer.join()
+            batches.cancel_join_thread()  # nobody may be reading
+            batches.close()
+    finally:
+        slots.release()
+    return True
+
+
+_pdf_render_slots = None
+_pdf_render_slots_lock = Lock()
+
+
+def get_pdf_render_slots():
+    """Limits the number of PDFs rendered at the same time to
+    PDF_EXPORT_PROCESSES (default 2), and thereby how much of the CPU
+    exports can take from the web server."""
+    global _pdf_render_slots
+    with _pdf_render_slots_lock:
+        if _pdf_render_slots is None:
+            _pdf_render_slots = BoundedSemaphore(
+                current_app.config.get("PDF_EXPORT_PROCESSES", 2))
+        return _pdf_render_slots
+
+
+def send_pdf_batch(renderer, batches, batch, deadline):
+    "Wait until the rendering process can take the batch"
+    while True:
+        if not renderer.is_alive():
+            raise RuntimeError("PDF rendering failed")
+        if time() > deadline:
+            raise jobs.JobTimeout("PDF rendering timed out after {} s"
+                                  .format(PDF_RENDER_TIMEOUT))
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except Full:
             pass
-        return f.name
+
+
+def iter_pdf_entries(entries):
+    """Go through the entries (a query), generating lists of what to put
+    in the PDF about them (see get_pdf_entries). Only one batch at a
+    time is kept in memory."""
+    results = entries.execute()
+    batch = []
+    while True:
+        try:
+            batch.append(results.iterate())  # unlike iterating, no caching
+        except StopIteration:
+            break
+        if len(batch) == PDF_BATCH_SIZE:
+            yield get_pdf_entries(batch)
+            batch = []
+    if batch:
+        yield get_pdf_entries(batch)
+
+
+def get_pdf_entries(entries):
+    """What to put in the PDF about each of the entries, as plain data
+    that can be sent to the rendering process. The attachments of all
+    the entries are looked up in one query."""
+    upload_folder = current_app.config["UPLOAD_FOLDER"]
+    images = {entry.id: [] for entry in entries}
+    attachments = (Attachment.select()
+                   .where((Attachment.entry << list(images)) &
+                          (Attachment.archived == False))
+                   .order_by(Attachment.id))
+    for attachment in attachments:
+        # images are embedded from the files, at thumbnail size
+        metadata = attachment.metadata or {}
+        if metadata.get("thumbnail_status") != "done":
+            continue
+        size = metadata["thumbnail_size"]
+        path = os.path.join(upload_folder, attachment.path + ".thumbnail")
+        if os.path.exists(path):
+            images[attachment.entry_id].append(
+                (path, size["width"], size["height"]))
+    return [{
+        "id": entry.id,
+        "title": entry.title,
+        "created_at": str(entry.created_at),
+        "authors": ", ".join(a["name"] for a in entry.authors),
+        "text": entry.content_text,
+        "images": images[entry.id]
+    } for entry in entries]
+
+
+def render_pdf(title, batches, filename):
+    """Write a PDF file of the entries, which come in lists (from
+    get_pdf_entries) through the "batches" queue, until None. This
+    runs in a separate process.
+
+    The entries are laid out one at a time, and only the current batch
+    is kept around. Note that reportlab can't write a PDF as it goes;
+    the finished pages are kept in memory until the end."""
+
+    canvas = Canvas(filename, pagesize=A4)
+    canvas.setTitle(title)
+    width, height = A4
+    margin = 2 * cm
+
+    def new_frame():
+        return Frame(margin, margin, width - 2 * margin, height - 2 * margin)
+
+    styles = getSampleStyleSheet()
+    frame = new_frame()
+    empty = True  # nothing on the current page yet
+    for batch in iter(batches.get, None):
+        for entry in batch:
+            flowables = get_entry_flowables(entry, styles)
+            while flowables:
+                flowable = flowables.pop(0)
+                if frame.add(flowable, canvas):
+                    empty = False
+                    continue
+                # it doesn't fit on the page, but maybe a part of it does
+                parts = frame.split(flowable, canvas)
+                if parts and frame.add(parts[0], canvas):
+                    empty = False
+                    flowables[:0] = parts[1:]
+                elif empty:
+                    # too large for any page; give up on it
+                    logging.warning(
+                        "Skipping a part of entry %d in PDF export",
+                        entry["id"])
+                else:
+                    canvas.showPage()
+                    frame = new_frame()
+                    empty = True
+                    flowables.insert(0, flowable)
+    canvas.save()
+
+
+def get_entry_flowables(entry, styles):
+    "The things to draw for an entry in a PDF"
+    flowables = [
+        Paragraph(escape_paragraph(entry["title"] or "(No title)"),
+                  styles["Heading2"]),
+        Paragraph("<b>Created at:</b> {}".format(entry["created_at"]),
+                  styles["Normal"]),
+        Paragraph("<b>Authors:</b> {}".format(
+            escape_paragraph(entry["authors"])), styles["Normal"]),
+        Spacer(0, 0.3 * cm)
+    ]
+    for line in (entry["text"] or "---").splitlines():
+        flowables.append(Paragraph(escape_paragraph(line) or "&nbsp;",
+                                   styles["Normal"]))
+    for path, width, height in entry["images"]:
+        flowables.append(Image(path, width=width, height=height,
+                               hAlign="LEFT"))
+    flowables.append(HRFlowable(width="100%", spaceBefore=0.3 * cm,
+                                spaceAfter=0.3 * cm))
+    return flowables
+
+
+def escape_paragraph(text):
+    "Paragraphs in reportlab are written in a kind of XML"
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+# PDF exports are made in the background, since they may take a while,
+# and kept for a while in case someone asks for the same thing again.
+# Either way, the job workers mostly wait for the rendering; pdfkit runs
+# an external program, and reportlab runs in a separate process. Only
+# reportlab renders are stopped when they take too long, though; a
+# pdfkit export that hangs keeps its thread (see jobs.call_with_timeout).
+# The file is only put in place by the job itself, so an abandoned
+# render never shows up as a finished export.
+PDF_EXPORT_TIMEOUT = 300  # seconds
+PDF_RENDER_TIMEOUT = 240  # the rest is for getting started
+PDF_BATCH_SIZE = 100  # entries sent to the rendering process at a time
+PDF_EXPORT_TTL = 24 * 3600  # seconds
+
+
+def get_export_folder():
+    folder = current_app.config.get("EXPORT_FOLDER")
+    if not folder:
+        folder = os.path.join(current_app.config["UPLOAD_FOLDER"], "exports")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def get_pdf_export_path(key):
+    return os.path.join(get_export_folder(), "{}.pdf".format(key))
+
+
+def get_pdf_export_key(logbook_id, search_args):
+    """Identifies an export. Since it includes the change counts of
+    the logbook, any change that could affect the result gives a new
+    key, so a finished export never needs to be updated."""
+    state = [logbook_id, search_args, Logbook.get_change_counts(logbook_id)]
+    return sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def get_pdf_export_job(key):
+    "The latest job making the given export, if any"
+    return (Job.select()
+            .where((Job.kind == "pdf_export") &
+                   (fn.json_extract(Job.args, "$.key") == key))
+            .order_by(Job.id.desc())
+            .first())
+
+
+def request_pdf_export(logbook_id, search_args):
+    """Start making a PDF of the entries found by Entry.search, unless
+    it's already done, or in progress. Returns the key of the export."""
+    key = get_pdf_export_key(logbook_id, search_args)
+    if not os.path.exists(get_pdf_export_path(key)):
+        job = get_pdf_export_job(key)
+        if job is None or job.status not in ("pending", "running"):
+            jobs.queue.submit("pdf_export", key=key, logbook_id=logbook_id,
+                              search_args=search_args)
+    return key
+
+
+def get_pdf_export_status(key):
+    """Returns "done" and the path to the file, or the status and any
+    error of the job. Both are None if there's no such export."""
+    path = get_pdf_export_path(key)
+    if os.path.exists(path):
+        return "done", path
+    job = get_pdf_export_job(key)
+    if job is None or job.status == "done":
+        return None, None  # never made, or expired
+    return job.status, job.error
+
+
+def remove_old_exports():
+    folder = get_export_folder()
+    oldest = time() - PDF_EXPORT_TTL
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        try:
+            if os.path.getmtime(path) < oldest:
+                os.remove(path)
+        except OSError as e:
+            logging.warning("Could not remove old export %s: %s", path, e)
+
+
+@jobs.handler("pdf_export", timeout=PDF_EXPORT_TIMEOUT)
+def pdf_export_job(key, logbook_id, search_args):
+    remove_old_exports()
+    logbook = Logbook.get(Logbook.id == logbook_id) if logbook_id else None
+    entries = Entry.search(logbook=logbook, **search_args)
+    path = get_pdf_export_path(key)
+    # write to a temporary file first, so that nobody sees half of it
+    tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), get_ident())
+    try:
+        if not export_entries_as_pdf(logbook, entries, tmp_path):
+            raise RuntimeError("PDF export is not available")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
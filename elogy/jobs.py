@@ -0,0 +1,298 @@
+"""
+Run things in the background, in a fixed number of worker threads.
+
+Jobs are stored in the database (see db.Job) before they are queued,
+and the workers periodically check the database for pending jobs that
+are not in the queue, e.g. because the server was restarted, the
+queue was full or the job is to be retried. This also means that
+several server processes can share the work.
+
+Work is done by functions registered for each "kind" of job, using
+the "handler" decorator. They get the arguments of the job as keyword
+arguments, and run inside an app context.
+
+The workers are started in each process the first time they are
+needed, since some servers load the app and then fork. With uWSGI,
+threads must also be enabled ("enable-threads"), and "lazy-apps" is
+recommended, or no jobs will be run.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import os
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+from flask import current_app
+from peewee import fn
+
+from .db import db, Job
+
+
+# finished jobs are removed from the database after this time
+KEEP_FINISHED = timedelta(days=1)
+# A job that has been running for this much longer than its timeout (or
+# this long, if it has none) was probably interrupted by a restart.
+INTERRUPTED_AFTER = timedelta(hours=1)
+
+
+class Handler:
+
+    "Keeps track of how to run a kind of job"
+
+    def __init__(self, function, timeout=None, retries=0, backoff=10):
+        self.function = function
+        self.timeout = timeout  # seconds
+        self.retries = retries  # number of extra attempts if it fails
+        self.backoff = backoff  # seconds to wait before the first retry
+
+    def retry_delay(self, attempts):
+        "Wait twice as long after each failed attempt"
+        return timedelta(seconds=self.backoff * 2 ** (attempts - 1))
+
+
+handlers = {}
+
+
+def handler(kind, **options):
+    "Decorator that registers a function to take care of a kind of job"
+    def decorator(f):
+        handlers[kind] = Handler(f, **options)
+        return f
+    return decorator
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class TooManyHungJobs(Exception):
+    pass
+
+
+# Threads of jobs that timed out, and may still be running. There is no
+# way to stop a python thread, so we can only avoid starting new ones.
+MAX_ABANDONED_THREADS = 10
+abandoned_threads = []
+abandoned_threads_lock = Lock()
+
+
+def call_with_timeout(f, kwargs, timeout):
+    """Call the function in a separate thread, and give up waiting for
+    it after the timeout. A function that hangs forever will leak a
+    thread, but at least it won't block the worker. If there are
+    already MAX_ABANDONED_THREADS of those, TooManyHungJobs is raised
+    without calling the function."""
+    if timeout is None:
+        return f(**kwargs)
+    with abandoned_threads_lock:
+        abandoned_threads[:] = [thread for thread in abandoned_threads
+                                if thread.is_alive()]
+        if len(abandoned_threads) >= MAX_ABANDONED_THREADS:
+            raise TooManyHungJobs("{} jobs that timed out are still running"
+                                  .format(len(abandoned_threads)))
+    app = current_app._get_current_object()
+    errors = []
+
+    def run():
+        with app.app_context():
+            try:
+                f(**kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if not db.is_closed():
+                    db.close()
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        with abandoned_threads_lock:
+            abandoned_threads.append(thread)
+        raise JobTimeout("Timed out after {} s".format(timeout))
+    if errors:
+        raise errors[0]
+
+
+def run_job(job_id):
+    """Run the given job, unless it's already been taken care of or
+    isn't due yet. Returns True if the job was run."""
+    # Several workers (possibly in different processes) might try to run
+    # the same job, so we claim it by changing the status atomically.
+    now = datetime.utcnow()
+    claimed = (Job.update(status="running", started_at=now,
+                          attempts=Job.attempts + 1)
+               .where((Job.id == job_id) & (Job.status == "pending") &
+                      ((Job.run_after >> None) | (Job.run_after <= now)))
+               .execute())
+    if not claimed:
+        return False
+    job = Job.get(Job.id == job_id)
+    job_handler = handlers[job.kind]
+    try:
+        call_with_timeout(job_handler.function, job.args,
+                          job_handler.timeout)
+        job.status = "done"
+    except TooManyHungJobs as e:
+        # not the fault of this job, so it doesn't count as an attempt
+        logging.warning("Postponing job %d (%s): %s", job.id, job.kind, e)
+        job.status = "pending"
+        job.attempts -= 1
+        job.run_after = datetime.utcnow() + job_handler.retry_delay(1)
+    except Exception as e:
+        logging.exception("Job %d (%s) failed", job.id, job.kind)
+        job.error = str(e)
+        # A job that timed out may still be running, and running it
+        # again could do the same thing twice (e.g. send an email).
+        if (job.attempts <= job_handler.retries and
+                not isinstance(e, JobTimeout)):
+            job.status = "pending"
+            job.run_after = (datetime.utcnow() +
+                             job_handler.retry_delay(job.attempts))
+        else:
+            job.status = "failed"
+    job.finished_at = datetime.utcnow()
+    job.save()
+    return True
+
+
+def seconds_between(start, end):
+    return (fn.julianday(end) - fn.julianday(start)) * 86400
+
+
+class JobQueue:
+
+    "A bounded queue of jobs, and a pool of worker threads running them"
+
+    def __init__(self, n_workers=2, max_size=1000, poll_interval=10):
+        self.n_workers = n_workers
+        self.poll_interval = poll_interval  # seconds
+        self.queue = Queue(maxsize=max_size)
+        self.workers = []
+        self.app = None
+        self._pid = None  # of the process where the workers run
+        self._lock = Lock()
+
+    def init_app(self, app):
+        "Run jobs for the app, starting the workers on the first request"
+        self.app = app
+        app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        """Start the workers, unless they are already running in this
+        process. After a fork, the threads are not there any more."""
+        if self._pid == os.getpid() or self.app is None:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # whatever was queued belongs to the parent process
+            self.queue = Queue(maxsize=self.queue.maxsize)
+            self.workers = []
+            for i in range(self.n_workers):
+                worker = Thread(target=self._work, daemon=True,
+                                name="elogy-job-worker-{}".format(i))
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, kind, **args):
+        "Store a new job and queue it for running"
+        self.ensure_started()
+        job = Job.create(kind=kind, args=args)
+        try:
+            self.queue.put_nowait(job.id)
+        except Full:
+            # it's in the database, so a worker will get to it eventually
+            logging.warning("Job queue full, postponing job %d", job.id)
+        return job
+
+    def metrics(self):
+        """Some numbers about how the jobs are doing. The times are
+        averages in seconds, over the recently finished jobs."""
+        kinds = {}
+        counts = (Job.select(Job.kind, Job.status, fn.count(Job.id))
+                  .group_by(Job.kind, Job.status)
+                  .tuples())
+        for kind, status, n in counts:
+            stats = kinds.setdefault(kind, dict(pending=0, running=0,
+                                                done=0, failed=0,
+                                                wait=None, duration=None))
+            stats[status] = n
+        times = (Job.select(Job.kind,
+                            fn.avg(seconds_between(Job.created_at,
+                                                   Job.started_at)),
+                            fn.avg(seconds_between(Job.started_at,
+                                                   Job.finished_at)))
+                 .where(Job.status << ["done", "failed"])
+                 .group_by(Job.kind)
+                 .tuples())
+        for kind, wait, duration in times:
+            kinds[kind].update(wait=wait, duration=duration)
+        return {"queue_size": self.queue.qsize(),
+                "max_queue_size": self.queue.maxsize,
+                "kinds": kinds}
+
+    def _reset_interrupted(self, now):
+        """Jobs that have been running for much longer than they are
+        allowed to were most likely interrupted, e.g. by the server
+        being restarted. They are retried, if their handler allows it."""
+        for kind, job_handler in handlers.items():
+            limit = INTERRUPTED_AFTER
+            if job_handler.timeout is not None:
+                limit += timedelta(seconds=job_handler.timeout)
+            stale = ((Job.kind == kind) & (Job.status == "running") &
+                     (Job.started_at < now - limit))
+            (Job.update(status="pending", run_after=None)
+             .where(stale & (Job.attempts <= job_handler.retries))
+             .execute())
+            (Job.update(status="failed", error="Interrupted",
+                        finished_at=now)
+             .where(stale)
+             .execute())
+
+    def _poll(self):
+        "Look in the database for jobs that are waiting to be run"
+        now = datetime.utcnow()
+        self._reset_interrupted(now)
+        pending = (Job.select(Job.id)
+                   .where((Job.status == "pending") &
+                          ((Job.run_after >> None) | (Job.run_after <= now)))
+                   .order_by(Job.id)
+                   .limit(self.queue.maxsize - self.queue.qsize()))
+        for job in pending:
+            try:
+                self.queue.put_nowait(job.id)
+            except Full:
+                break
+        # clean up old jobs
+        (Job.delete()
+         .where((Job.status << ["done", "failed"]) &
+                (Job.finished_at < now - KEEP_FINISHED))
+         .execute())
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    job_id = self.queue.get(timeout=self.poll_interval)
+                except Empty:
+                    try:
+                        self._poll()
+                    except Exception:
+                        logging.exception("Could not check for pending jobs")
+                    finally:
+                        if not db.is_closed():
+                            db.close()
+                    continue
+                try:
+                    run_job(job_id)
+                except Exception:
+                    logging.exception("Error running job %d", job_id)
+                finally:
+                    if not db.is_closed():
+                        db.close()
+
+
+queue = JobQueue()
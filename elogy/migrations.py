@@ -0,0 +1,263 @@
+"""
+Keep the database schema up to date.
+
+Each migration is a function that takes the database from one version
+to the next; the current version is stored in the "schema_version"
+table. Migrations are run in order, each in its own transaction, when
+the application starts (see db.setup_database) or through the
+"flask migrate" command.
+
+A migration that needs to go through a large table (e.g. to fill in a
+new column) should be written as a generator, yielding after each
+chunk of work. The transaction is then committed after each chunk, so
+that the database isn't locked for too long. If interrupted, such a
+migration is started over from the beginning, so it must be possible
+to run it again. Put the filling in a separate migration from the
+schema change, and have it only touch the rows that are not yet done.
+
+Databases created before migrations were introduced are at version 0,
+so the first few migrations take care to not break if the things they
+add are already there.
+
+Never change a migration that has been released; add a new one.
+"""
+
+import logging
+
+from peewee import fn, SQL
+from playhouse.migrate import SqliteMigrator, migrate
+
+from .db import (db, fts_installed, make_preview, Logbook, LogbookChange,
+                 LogbookClosure, Entry, EntryChange, EntryLock,
+                 EntrySearch, Attachment, Job, Event, ChangeSequence)
+
+
+MIGRATIONS = []
+
+
+def migration(f):
+    "Decorator that adds a function to the list of migrations, in order"
+    MIGRATIONS.append(f)
+    return f
+
+
+def get_version():
+    db.execute_sql("CREATE TABLE IF NOT EXISTS schema_version "
+                   "(version INTEGER NOT NULL)")
+    row = db.execute_sql("SELECT version FROM schema_version").fetchone()
+    return row[0] if row else 0
+
+
+def set_version(version):
+    db.execute_sql("DELETE FROM schema_version")
+    db.execute_sql("INSERT INTO schema_version (version) VALUES (?)",
+                   (version,))
+
+
+def migrate_database():
+    """Run any migrations that have not yet been applied to the
+    database. Returns a list of the names of the migrations run."""
+    done = []
+    for version, step in enumerate(MIGRATIONS, start=1):
+        # take the write lock right away, in case several processes
+        # are starting up at the same time
+        with db.transaction("IMMEDIATE") as transaction:
+            if get_version() >= version:
+                continue
+            logging.info("Migrating database to version %d (%s)",
+                         version, step.__name__)
+            chunks = step()
+            if chunks is not None:
+                for _ in chunks:
+                    transaction.commit()  # ...and begin a new one
+            set_version(version)
+        done.append(step.__name__)
+    return done
+
+
+def id_chunks(model, chunk_size=1000, where=None):
+    """Go through the ids of a table, yielding (first, last) for each
+    chunk. If given, only the rows matching "where" are counted."""
+    last_id = 0
+    while True:
+        condition = model.id > last_id
+        if where is not None:
+            condition &= where
+        ids = [row[0] for row in (model.select(model.id)
+                                  .where(condition)
+                                  .order_by(model.id)
+                                  .limit(chunk_size)
+                                  .tuples())]
+        if not ids:
+            break
+        yield ids[0], ids[-1]
+        last_id = ids[-1]
+
+
+# The migrations, in order
+
+@migration
+def create_tables():
+    Logbook.create_table(fail_silently=True)
+    LogbookChange.create_table(fail_silently=True)
+    Entry.create_table(fail_silently=True)
+    EntryChange.create_table(fail_silently=True)
+    EntryLock.create_table(fail_silently=True)
+    Attachment.create_table(fail_silently=True)
+
+
+@migration
+def add_entry_search():
+    if not fts_installed():
+        logging.warning("SQLite does not support FTS5 with the trigram"
+                        " tokenizer; text searches will be slow.")
+        return
+    # the existing entries are indexed in fill_entry_search
+    EntrySearch.create_table(fail_silently=True)
+
+
+@migration
+def add_jobs():
+    Job.create_table(fail_silently=True)
+
+
+@migration
+def add_logbook_closure():
+    if not LogbookClosure.table_exists():
+        LogbookClosure.create_table()
+        LogbookClosure.rebuild()
+
+
+@migration
+def add_thread_summaries():
+    # the summaries are filled in by fill_thread_summaries
+    columns = [column.name for column in db.get_columns("entry")]
+    if "thread_last_activity" in columns:
+        return
+    migrator = SqliteMigrator(db)
+    migrate(
+        migrator.add_column("entry", "thread_last_activity",
+                            Entry.thread_last_activity),
+        migrator.add_column("entry", "n_followups", Entry.n_followups),
+        migrator.add_column("entry", "followup_authors",
+                            Entry.followup_authors))
+
+
+# Indexes for the most common queries, that can't be expressed through
+# the models. The test_query_plans tests check that they are used.
+
+@migration
+def add_thread_sort_indexes():
+    # used for listing threads, see Entry.search
+    db.execute_sql("DROP INDEX IF EXISTS entry_sort")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS entry_logbook_thread_sort "
+                   "ON entry (logbook_id, follows_id, priority, "
+                   "thread_last_activity, id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS entry_thread_sort "
+                   "ON entry (follows_id, priority, thread_last_activity, id)")
+
+
+@migration
+def add_lookup_indexes():
+    # Entry.next and Entry.previous
+    db.execute_sql("CREATE INDEX IF NOT EXISTS entry_logbook_activity "
+                   "ON entry (logbook_id, follows_id, "
+                   "coalesce(last_changed_at, created_at))")
+    # Entry.get_lock
+    db.execute_sql("CREATE INDEX IF NOT EXISTS entrylock_active "
+                   "ON entrylock (entry_id, cancelled_at, expires_at)")
+
+
+@migration
+def add_content_text():
+    # the text is filled in by fill_content_text
+    columns = [column.name for column in db.get_columns("entry")]
+    if "content_text" in columns:
+        return
+    migrator = SqliteMigrator(db)
+    migrate(migrator.add_column("entry", "content_text", Entry.content_text),
+            migrator.add_column("entry", "preview", Entry.preview))
+
+
+@migration
+def add_logbook_change_count():
+    columns = [column.name for column in db.get_columns("logbook")]
+    if "change_count" not in columns:
+        migrate(SqliteMigrator(db).add_column("logbook", "change_count",
+                                              Logbook.change_count))
+
+
+@migration
+def add_events():
+    Event.create_table(fail_silently=True)
+
+
+@migration
+def add_change_seq():
+    migrator = SqliteMigrator(db)
+    models = [Logbook, Entry, Attachment]
+    for model in models:
+        table = model._meta.db_table
+        columns = [column.name for column in db.get_columns(table)]
+        if "change_seq" not in columns:
+            # this also adds the index
+            migrate(migrator.add_column(table, "change_seq",
+                                        model.change_seq))
+    ChangeSequence.create_table(fail_silently=True)
+    yield
+    # Number the existing things in the order of the tables, and ids.
+    # Starting over from the beginning gives the same numbers.
+    offset = 0
+    for model in models:
+        for first, last in id_chunks(model):
+            (model.update(change_seq=model.id + offset)
+             .where(model.id.between(first, last))
+             .execute())
+            yield
+        offset += model.select(fn.max(model.id)).scalar() or 0
+    ChangeSequence.delete().execute()
+    ChangeSequence.create(id=ChangeSequence.ID, value=offset)
+
+
+# Filling in the things added by earlier migrations, for the entries
+# that don't have them yet. These come last, so that they also take
+# care of databases where an earlier version of them was interrupted.
+
+@migration
+def fill_entry_search():
+    if not EntrySearch.table_exists():
+        return  # no FTS5 support
+    not_indexed = Entry.id.not_in(SQL("(SELECT rowid FROM entrysearch)"))
+    for first, last in id_chunks(Entry, where=not_indexed):
+        entries = (Entry.select(Entry.id, Entry.title, Entry.content,
+                                Entry.content_type)
+                   .where(Entry.id.between(first, last) & not_indexed))
+        for entry in entries:
+            EntrySearch.index_entry(entry)
+        yield
+
+
+@migration
+def fill_thread_summaries():
+    missing = Entry.thread_last_activity >> None
+    for first, last in id_chunks(Entry, chunk_size=500, where=missing):
+        Entry.update_thread_summaries(
+            [row[0] for row in (Entry.select(Entry.id)
+                                .where(Entry.id.between(first, last) &
+                                       missing)
+                                .tuples())])
+        yield
+
+
+@migration
+def fill_content_text():
+    missing = Entry.content_text >> None
+    for first, last in id_chunks(Entry, where=missing):
+        entries = (Entry.select(Entry.id, Entry.content, Entry.content_type)
+                   .where(Entry.id.between(first, last) & missing))
+        for entry in entries:
+            text = entry.text_content
+            (Entry.update(content_text=text, preview=make_preview(text))
+             .where(Entry.id == entry.id)
+             .execute())
+        yield
@@ -63,7 +63,7 @@ def apply_patch(s, patch, revert=False):
                 if line[0] == sign or line[0] == ' ':
                     t += line[1:]
                 sl += (line[0] != sign)
-                t += ''.join(s[sl:])
+    t += ''.join(s[sl:])
     return t
 
 #
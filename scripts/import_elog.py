@@ -2,23 +2,28 @@
 
 The process is
 1. parse all logbooks from the config file
-2. parse all posts via the logbook data
+2. parse all posts via the logbook data (logbooks in parallel)
 3. import the logbooks to elogy
-4. import entries (with attachments)
+4. import entries, in batches (attachments are uploaded in parallel)
 6. done!
 
 There are several weird cases where we either do an educated guess,
 or just skip that particular logbook/entry/whatever. Hopefully the
 output should give you some hints as to why.
 
-There's no checking to see if a logbook is already present so
-in that case you will end up with several logbooks of the same
-name (which is fine in elogy).
+Everything that has been imported is written down in a checkpoint
+file, so if the script is interrupted, running it again (with the same
+checkpoint file) will continue where it left off. Apart from that,
+there's no checking to see if a logbook is already present so in that
+case you will end up with several logbooks of the same name (which is
+fine in elogy).
 
 Usage:
 
 $ python import_elog.py http://elogy-host /path/to/elogd.conf /path/to/elog/logbooks Logbook1 "Some other logbook" ParentLogbook/ChildLogbook
 
+See "python import_elog.py --help" for options.
+
 Note that the (optinal) names of logbooks to be imported must be the
 full names of the logbooks in the config file, not the names of the
 directories they are in! Logbook names are unique in elog, so it's
@@ -29,13 +34,15 @@ order to repair any links in entries to attachments or other entries.
 """
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import configparser
 from glob import glob
 import json
 import logging
 import os
+import threading
 import time
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid5
 
 try:
     import bbcode
@@ -44,6 +51,8 @@ except ImportError:
     bbcode = None
 from dateutil.parser import parse as parse_time
 from dateutil.tz import tzlocal
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 
 # elog treats some special values as attributes, elogy has
@@ -51,6 +60,11 @@ from dateutil.tz import tzlocal
 # attributes.
 EXCLUDED_ATTRIBUTES = set(["last edited", "author", "subject"])
 
+# the line that starts each entry in a logfile, followed by its id
+MID_MARKER = "$@MID@$:"
+# separates the headers of an entry from its body
+BODY_SEPARATOR = "=" * 40
+
 
 def get_logbook(config, name, parent=None,
                 attribute_config={}, attributes={},
@@ -126,7 +140,9 @@ def get_logbook(config, name, parent=None,
     except configparser.NoOptionError:
         children = None
     child_logbooks = []
-    logbook_uuid = str(uuid4())
+    # logbook names are unique, so this is the same each time we run,
+    # which is needed for the checkpoint
+    logbook_uuid = str(uuid5(NAMESPACE_URL, "elog:" + name))
     if children:
         # recurse into child logbooks, and so on
         children = [child.strip() for child in children.split(",")]
@@ -151,8 +167,10 @@ def get_logbook(config, name, parent=None,
     return logbook_uuid
 
 
-def get_entries(logbook, accumulator):
-    "Parse all entries belonging to a given logbook"
+def get_entries(logbook):
+    """Parse all entries belonging to a given logbook, returning them
+    in a dict keyed on (logbook_uuid, mid)"""
+    accumulator = {}
     logbook_path = logbook["path"]
     logging.info("parsing entries for logbook '%s'", logbook["name"])
     for logfile in sorted(glob(os.path.join(logbook_path, "*.log")),
@@ -224,42 +242,54 @@ def get_entries(logbook, accumulator):
                     data["attachments"] = attachments
                 accumulator[(logbook["uuid"], entry["mid"])] = data
         except UnicodeDecodeError as e:
-            logging.warning("error parsing logfile %s: %s", (logfile, e))
+            logging.warning("error parsing logfile %s: %s", logfile, e)
+    return accumulator
 
 
 def load_elog_file(filename):
-    "parse an elog .log file into separate entries"
+    """parse an elog .log file into separate entries. They are
+    generated one at a time, so that the whole file is never in
+    memory at once."""
 
     logging.debug("parsing logfile '%s'", filename)
 
     with open(filename, encoding="ISO-8859-1") as f:
-        content = f.read()
-
-    entries = []
-    for entry_text in content.split("$@MID@$:"):
-        if not entry_text:
-            continue
-        entry = {}
+        lines = None
+        for line in f:
+            if line.startswith(MID_MARKER):
+                if lines is not None:
+                    entry = parse_elog_entry(lines)
+                    if entry is not None:
+                        yield entry
+                lines = []
+            if lines is not None:
+                lines.append(line)
+        if lines is not None:
+            entry = parse_elog_entry(lines)
+            if entry is not None:
+                yield entry
+
+
+def parse_elog_entry(lines):
+    "parse the lines of a single entry from a logfile"
+    entry = {}
+    mid = int(lines[0][len(MID_MARKER):].strip())
+    for i, line in enumerate(lines[1:], 1):
+        if line.startswith(BODY_SEPARATOR):
+            break
         try:
-            header, body = entry_text.split("=" * 40, 1)
-        except ValueError as e:
-            print("Malformed entry!?", e)
-            print(entry)
-            continue
-        header_lines = header.split("\n")
-        mid = int(header_lines[0].strip())
-        for line in header_lines[1:]:
-            try:
-                key, value = line.split(":", 1)
-                if value.strip():
-                    entry[key.lower()] = value.strip()
-            except ValueError:
-                pass
-        entry["body"] = body.encode("utf-8")
-        entry["mid"] = mid
-        entries.append(entry)
-
-    return entries
+            key, value = line.split(":", 1)
+            if value.strip():
+                entry[key.lower()] = value.strip()
+        except ValueError:
+            pass
+    else:
+        print("Malformed entry!?", mid)
+        return
+    body = lines[i][len(BODY_SEPARATOR):] + "".join(lines[i+1:])
+    entry["body"] = body.encode("utf-8")
+    entry["mid"] = mid
+    return entry
 
 
 def process_body(body, encoding):
@@ -284,8 +314,8 @@ def create_logbook(session, url, logbook):
                               "attributes": logbook["attributes"]}).json()
 
 
-def create_entry(session, url, logbook_id, entry, entries):
-    "helper to upload an entry"
+def get_entry_data(entry):
+    "convert a parsed entry into the form the API expects"
     data = {
         "title": entry.get("title"),
         "authors": entry["authors"],
@@ -297,22 +327,36 @@ def create_entry(session, url, logbook_id, entry, entries):
     }
     if "last_changed_at" in entry:
         data["last_changed_at"] = entry["last_changed_at"].strftime('%Y-%m-%d %H:%M:%S.%f %z')
-    if "in_reply_to" in entry:
-        try:
-            follows = entries[entry["in_reply_to"]]
-            url += "{}/".format(follows["id"])
-        except KeyError:
-            logging.warning("could not find entry {} which {} is replying to!"
-                            .format(entry["in_reply_to"], entry["mid"]))
-
-    entry_result = session.post(url.format(logbook_id=logbook_id), json=data)
-    return entry_result
+    return data
+
+
+def create_entries(session, url, logbook_id, batch, entries):
+    """helper to upload a batch of entries (from the same logbook) in
+    one request. Replies may refer to entries already imported (whose
+    ids are in entries), or to earlier entries in the same batch."""
+    batch_data = []
+    in_batch = set()
+    for entry in batch:
+        data = get_entry_data(entry)
+        data["ref"] = str(entry["mid"])
+        if "in_reply_to" in entry:
+            if entry["in_reply_to"] in entries:
+                data["follows_id"] = entries[entry["in_reply_to"]]
+            elif entry["in_reply_to"] in in_batch:
+                data["follows_ref"] = str(entry["in_reply_to"][1])
+            else:
+                logging.warning("could not find entry {} which {} is replying to!"
+                                .format(entry["in_reply_to"], entry["mid"]))
+        batch_data.append(data)
+        in_batch.add((entry["logbook_uuid"], entry["mid"]))
+    return session.post(url.format(logbook_id=logbook_id),
+                        json={"entries": batch_data})
 
 
 def create_attachment(session, url, filename, embedded=False):
     "helper to upload an attachment"
     try:
-        print(filename)
+        logging.debug("uploading attachment %s", filename)
         timestamp = time.ctime(os.path.getctime(filename))
         with open(filename, "rb") as f:
             data = dict(timestamp=timestamp)
@@ -330,6 +374,63 @@ def create_attachment(session, url, filename, embedded=False):
         print("Could not find attachment", filename)
 
 
+
+def make_session(pool_size):
+    "a session that can be used from pool_size threads at once"
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Checkpoint:
+
+    """Keeps track of what has been imported, in a file, so that an
+    interrupted import can be resumed. Each line in the file is a JSON
+    object, appended as soon as something has been imported. Safe to
+    use from several threads."""
+
+    def __init__(self, filename):
+        self.logbooks = {}  # logbook_uuid -> elogy id
+        self.entries = {}  # (logbook_uuid, mid) -> elogy id
+        self.attachments = set()  # (logbook_uuid, mid, filename)
+        self._lock = threading.Lock()
+        line = ""
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        self._add(json.loads(line))
+                    except ValueError:
+                        # the last line may be cut off, if we crashed
+                        logging.warning("ignoring bad checkpoint line %r",
+                                        line)
+        self._file = open(filename, "a")
+        if line and not line.endswith("\n"):
+            self._file.write("\n")
+
+    def _add(self, record):
+        if "logbook" in record:
+            self.logbooks[record["logbook"]] = record["id"]
+        elif "entry" in record:
+            self.entries[tuple(record["entry"])] = record["id"]
+        elif "attachment" in record:
+            self.attachments.add(tuple(record["attachment"]))
+
+    def add(self, *records):
+        "note that something has been imported"
+        with self._lock:
+            for record in records:
+                self._add(record)
+                self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
 if __name__ == "__main__":
 
     # Argument 1 is the host:port of the logbook server to post to
@@ -338,23 +439,47 @@ if __name__ == "__main__":
     # Further arguments should be names of the toplevel logbooks to
     # import. If none are given, imports all logbooks it finds in the config.
 
-    import sys
-    from requests import Session
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Import an ELOG installation to elogy")
+    parser.add_argument("host_port", help="where elogy is running")
+    parser.add_argument("elogd_config", help="the elogd config file")
+    parser.add_argument("logbook_path",
+                        help="base path where to look for logbook files")
+    parser.add_argument("logbooks", nargs="*",
+                        help="names of logbooks to import (default: all)")
+    parser.add_argument("--checkpoint", default="import_elog.checkpoint",
+                        help="file that keeps track of what has been"
+                        " imported (default: %(default)s)")
+    parser.add_argument("--parse-processes", type=int, default=None,
+                        help="number of logbooks to parse at once"
+                        " (default: the number of CPUs)")
+    parser.add_argument("--upload-threads", type=int, default=4,
+                        help="number of attachments to upload at once"
+                        " (default: %(default)s)")
+    args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
-    host_port = sys.argv[1]
-    elogd_config = sys.argv[2]
-    logbook_path = sys.argv[3]
-    logbooks_to_import = sum((lb.split("/") for lb in sys.argv[4:]), [])
+    host_port = args.host_port
+    elogd_config = args.elogd_config
+    logbook_path = args.logbook_path
+    logbooks_to_import = sum((lb.split("/") for lb in args.logbooks), [])
     print("logbooks to import", logbooks_to_import)
 
-    s = Session()
+    s = make_session(args.upload_threads)
+    checkpoint = Checkpoint(args.checkpoint)
+    if checkpoint.entries:
+        logging.info("resuming; %d logbooks and %d entries already imported",
+                     len(checkpoint.logbooks), len(checkpoint.entries))
 
     # create a new logbook through the API
     LOGBOOK_URL = "http://%s/api/logbooks/" % host_port
-    ENTRY_URL = "http://%s/api/logbooks/{logbook_id}/entries/" % host_port
-    ATTACHMENT_URL = "http://%s/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/" % host_port
+    ENTRY_BATCH_URL = "http://%s/api/logbooks/{logbook_id}/entries/batch" % host_port
+    # number of entries to upload per request
+    BATCH_SIZE = 100
+    ATTACHMENT_URL = "http://%s/api/logbooks/{logbook_id}/entries/{entry_id}/attachments/" % host_port
 
     config = configparser.RawConfigParser(strict=False)
     config.optionxform = str  # preserve key case
@@ -370,9 +495,8 @@ if __name__ == "__main__":
         if key.startswith("Top group")
     ]
 
-    # get all logbooks into a flat dict, keyed on name
-    # I think logbook names are unique but to be sure
-    # i assign them uuids.
+    # get all logbooks into a flat dict, keyed on uuids made from the
+    # names (I think logbook names are unique but to be sure...)
     logbooks = {}
     for logbook in top_logbooks:
         # if logbooks_to_import and logbook not in logbooks_to_import:
@@ -381,71 +505,109 @@ if __name__ == "__main__":
                     root_path=logbook_path, toplevel=True,
                     accumulator=logbooks, to_import=logbooks_to_import)
     # get the entries in each logbook, also in a flat dict
-    # keyed on (logbook_uuid, mid)
+    # keyed on (logbook_uuid, mid). The logbooks are parsed in
+    # separate processes, since it's mostly CPU bound.
     entries = {}
-    for lid, logbook in logbooks.items():
-        get_entries(logbook, entries)
+    with ProcessPoolExecutor(args.parse_processes) as pool:
+        for logbook_entries in pool.map(get_entries, logbooks.values()):
+            entries.update(logbook_entries)
 
     # OK; now we're done parsing all the existing elog data. Now over
     # to actually importing it.
 
-    imported_logbooks = {}
-
     def create_logbooks(lb, parent=None):
         "Helper to recursively import logbooks"
-        # skip logbooks already imported (should never happen...)
-        if lb["uuid"] in imported_logbooks:
-            return
-        # skip child logbooks whose parents have not been imported
-        # (they will be imported after the parent is done)
-        if lb["parent"] is not None and lb["parent"] not in imported_logbooks:
-            return
-
-        if parent is not None:
-            url = LOGBOOK_URL + "{}/".format(parent)
-        else:
-            url = LOGBOOK_URL
-        result = create_logbook(s, url, lb)
-        if result is None:
-            return
-        result = result["logbook"]
-        imported_logbooks[lb["uuid"]] = result
+        # logbooks imported in an earlier run are kept
+        if lb["uuid"] not in checkpoint.logbooks:
+            if parent is not None:
+                url = LOGBOOK_URL + "{}/".format(parent)
+            else:
+                url = LOGBOOK_URL
+            result = create_logbook(s, url, lb)
+            if result is None:
+                return
+            checkpoint.add({"logbook": lb["uuid"],
+                            "id": result["logbook"]["id"]})
         for lid in lb["children"]:
-            create_logbooks(logbooks[lid], parent=result["id"])
+            create_logbooks(logbooks[lid],
+                            parent=checkpoint.logbooks[lb["uuid"]])
 
     logging.info("importing logbooks")
-    # import all the toplevel logbooks
+    # import all the toplevel logbooks, and their children
     for lid, logbook in logbooks.items():
-        create_logbooks(logbook)
+        if logbook["parent"] is None:
+            create_logbooks(logbook)
 
     # sort entries by creation time. By inserting them in chronological order,
     # hopefully we can be sure that replies will work properly
     sorted_entries = OrderedDict(sorted(entries.items(),
                                         key=lambda t: t[1]["created_at"]))
 
-    imported_entries = {}
-
-    logging.info("importing entries")
+    # replies are always in the same logbook, so the entries are
+    # uploaded in batches per logbook
+    logbook_entries = OrderedDict((lid, []) for lid in logbooks
+                                  if lid in checkpoint.logbooks)
     for (logbook_uuid, mid), entry in sorted_entries.items():
-        logbook_result = imported_logbooks[logbook_uuid]
+        if logbook_uuid in logbook_entries:
+            logbook_entries[logbook_uuid].append(entry)
+
+    def upload_attachment(logbook_uuid, mid, attachment):
+        """Helper to upload an attachment, and note that it's done. It
+        runs in the background, so nobody else would see any errors."""
         logbook = logbooks[logbook_uuid]
-        result = create_entry(s, ENTRY_URL, logbook_result["id"],
-                              entry, imported_entries)
-        if result.status_code == 200:
-            result = result.json()["entry"]
+        filename = os.path.join(logbook["path"], attachment)
+        try:
+            url = ATTACHMENT_URL.format(
+                logbook_id=checkpoint.logbooks[logbook_uuid],
+                entry_id=checkpoint.entries[(logbook_uuid, mid)])
+            if create_attachment(s, url, filename):
+                checkpoint.add({"attachment": [logbook_uuid, mid,
+                                               attachment]})
+        except Exception:
+            # it's not in the checkpoint, so it's retried next time
+            logging.exception("failed to upload attachment %s of entry %d"
+                              " in '%s'", filename, mid, logbook["name"])
+
+    logging.info("importing entries")
+    # attachments are uploaded in the background, while we go on
+    # with the entries
+    with ThreadPoolExecutor(args.upload_threads) as uploader:
+
+        def upload_attachments(entry):
             for attachment in entry.get("attachments", []):
-                filename = os.path.join(logbook["path"], attachment)
-                create_attachment(
-                    s, ATTACHMENT_URL.format(logbook=logbook_result,
-                                             entry=result),
-                    filename)
-            imported_entries[(logbook_uuid, mid)] = result
+                key = (entry["logbook_uuid"], entry["mid"], attachment)
+                if key not in checkpoint.attachments:
+                    uploader.submit(upload_attachment, *key)
+
+        for logbook_uuid, entries_to_import in logbook_entries.items():
+            logbook = logbooks[logbook_uuid]
+            # entries imported in an earlier run may still be
+            # missing some attachments
+            new_entries = []
+            for entry in entries_to_import:
+                if (logbook_uuid, entry["mid"]) in checkpoint.entries:
+                    upload_attachments(entry)
+                else:
+                    new_entries.append(entry)
+            for start in range(0, len(new_entries), BATCH_SIZE):
+                batch = new_entries[start:start + BATCH_SIZE]
+                result = create_entries(s, ENTRY_BATCH_URL,
+                                        checkpoint.logbooks[logbook_uuid],
+                                        batch, checkpoint.entries)
+                if result.status_code != 200:
+                    logging.error("failed to import entries %d-%d in '%s': %s",
+                                  batch[0]["mid"], batch[-1]["mid"],
+                                  logbook["name"], result.text)
+                    continue
+                checkpoint.add(*({"entry": [logbook_uuid, entry["mid"]],
+                                  "id": result["id"]}
+                                 for entry, result
+                                 in zip(batch, result.json()["entries"])))
+                for entry in batch:
+                    upload_attachments(entry)
+
+    checkpoint.close()
 
     # TO CONSIDER
-    # + How do we make this script idempotent?
-    #   The whole parsing step takes only a few seconds
-    #   so it can be done often. If we just sort by descending
-    #   creation date we could find the first entry that already
-    #   exists and then start from the next..?
-    #   I guess logbook changes will be harder. But they are
+    # + Logbook changes are not imported. But they are
     #   infrequent and can only be done by KITS.
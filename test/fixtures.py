@@ -46,6 +46,9 @@ def db(request):
 def elogy_client(request):
     os.environ["ELOGY_CONFIG_FILE"] = "../test/config.py"
     from elogy.app import app
+    from elogy.db import setup_database
+    # other tests may have pointed the database elsewhere
+    setup_database(app.config["DATABASE"]["name"])
     with app.test_client() as c:
         yield c
     try:
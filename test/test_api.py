@@ -1,7 +1,12 @@
-from io import BytesIO
+from base64 import b64encode, urlsafe_b64encode
+import csv
+from io import BytesIO, StringIO
 import json
+import re
+from time import sleep, time
 
-from pytest import mark
+from PIL import Image
+from pytest import mark, importorskip
 
 from .fixtures import elogy_client
 
@@ -137,6 +142,71 @@ def test_update_entry(elogy_client):
             .format(logbook=logbook, entry=entry)))["entry_changes"]
 
 
+def test_get_entry_conditional(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    url = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+           .format(logbook=logbook, entry=entry))
+
+    response = elogy_client.get(url)
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    # nothing has changed
+    response = elogy_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert response.headers["ETag"] == etag
+
+    # adding a followup changes the entry
+    post_json(elogy_client,
+              "/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+              .format(logbook=logbook, entry=entry),
+              data=dict(title="Followup", content="Followup content"))
+    response = elogy_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(decode_response(response)["entry"]["followups"]) == 1
+    etag = response.headers["ETag"]
+
+    # ...and so does editing it
+    elogy_client.put(url, data={**in_entry, "title": "New title",
+                                "revision_n": 0})
+    response = elogy_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert decode_response(response)["entry"]["title"] == "New title"
+
+    # old revisions can be cached for a while
+    response = elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/revisions/0"
+        .format(logbook=logbook, entry=entry))
+    assert response.headers["Cache-Control"].startswith("max-age=")
+    assert "ETag" in response.headers
+
+
+def test_get_entries_conditional(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    child = decode_response(elogy_client.post(
+        "/api/logbooks/{logbook[id]}/".format(logbook=logbook),
+        data=dict(name="Child")))["logbook"]
+    make_entry(elogy_client, logbook)
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)
+
+    etag = elogy_client.get(url).headers["ETag"]
+    response = elogy_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # different queries get different versions
+    response = elogy_client.get(url + "?title=Test",
+                                headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # a new entry in a child logbook shows up in the parent
+    make_entry(elogy_client, child)
+    response = elogy_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(decode_response(response)["entries"]) == 2
+
+
 def test_create_entry_followup(elogy_client):
     in_logbook, logbook = make_logbook(elogy_client)
     in_entry, entry = make_entry(elogy_client, logbook)
@@ -381,6 +451,65 @@ def test_create_attachment(elogy_client):
     assert response["entry"]["attachments"][0]["id"] == att["id"]
 
 
+def test_create_image_attachment_thumbnail(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    # upload an image
+    image = BytesIO()
+    Image.new("RGB", (300, 200), (255, 0, 0)).save(image, "PNG")
+    image.seek(0)
+    URL = ("/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+           .format(logbook=logbook, entry=entry))
+    att = decode_response(
+        elogy_client.post(
+            URL,
+            content_type='multipart/form-data',
+            data={"attachment": [(image, "thumbnail_test.png")]}))
+    # the thumbnail is not made during the upload
+    assert att["metadata"]["thumbnail_status"] == "pending"
+
+    # ...but we can get it right away anyway
+    response = elogy_client.get(att["location"] + ".thumbnail")
+    assert response.status_code == 200
+    thumbnail = Image.open(BytesIO(response.get_data()))
+    assert thumbnail.size == (100, 67)
+
+    response = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+        .format(logbook=logbook, entry=entry)))
+    metadata = response["entry"]["attachments"][0]["metadata"]
+    assert metadata["thumbnail_status"] == "done"
+    assert metadata["size"] == {"width": 300, "height": 200}
+    assert metadata["thumbnail_size"] == {"width": 100, "height": 67}
+
+
+def test_create_image_attachment_thumbnail_failed(elogy_client, monkeypatch):
+    from elogy import attachments
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    def broken_open(path):
+        raise ValueError("broken image")  # not an IOError
+
+    monkeypatch.setattr(attachments.Image, "open", broken_open)
+    att = decode_response(
+        elogy_client.post(
+            "/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+            .format(logbook=logbook, entry=entry),
+            content_type='multipart/form-data',
+            data={"attachment": [(BytesIO(b"\x89PNG garbage"),
+                                  "broken.png")]}))
+    response = elogy_client.get(att["location"] + ".thumbnail")
+    assert response.status_code == 404
+
+    response = decode_response(elogy_client.get(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/"
+        .format(logbook=logbook, entry=entry)))
+    metadata = response["entry"]["attachments"][0]["metadata"]
+    assert metadata["thumbnail_status"] == "failed"
+
+
 @mark.xfail(reason="See https://github.com/pallets/werkzeug/issues/1091")
 def test_create_attachment_with_single_quotes(elogy_client):
     in_logbook, logbook = make_logbook(elogy_client)
@@ -398,3 +527,496 @@ def test_create_attachment_with_single_quotes(elogy_client):
             content_type='multipart/form-data',
             data={"attachment": [(BytesIO(DATA), FILENAME)]}))
     assert att["filename"] == FILENAME
+
+
+def test_get_entries_count(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    for i in range(3):
+        make_entry(elogy_client, logbook)
+
+    result = decode_response(
+        elogy_client.get("/api/logbooks/{logbook[id]}/entries/?n=2"
+                         .format(logbook=logbook)))
+    assert len(result["entries"]) == 2
+    assert result["count"] == 3
+
+
+def test_get_entries_content_preview(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    post_json(elogy_client,
+              "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook),
+              data=dict(title="Entry", content_type="text/html",
+                        content="<h1>Title</h1><p>Some\n<i>text</i></p>"))
+    result = decode_response(
+        elogy_client.get("/api/logbooks/{logbook[id]}/entries/"
+                         .format(logbook=logbook)))
+    assert result["entries"][0]["content"] == "Title Some text"
+
+
+def test_get_entries_cursor(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    ids = [make_entry(elogy_client, logbook)[1]["id"] for i in range(5)]
+
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)
+    result = decode_response(elogy_client.get(url + "?n=2&cursor="))
+    assert result["count"] == 5
+    entries = result["entries"]
+    while result["next_cursor"]:
+        result = decode_response(
+            elogy_client.get(url + "?n=2&cursor=" + result["next_cursor"]))
+        entries.extend(result["entries"])
+    assert [e["id"] for e in entries] == list(reversed(ids))
+
+    bad_cursor = elogy_client.get(url + "?n=2&cursor=garbage")
+    assert bad_cursor.status_code == 400
+    for position in [[0, None, 1], [0, "", 1], [0, 12, 1]]:
+        cursor = urlsafe_b64encode(json.dumps(position).encode()).decode()
+        bad_cursor = elogy_client.get(url + "?n=2&cursor=" + cursor)
+        assert bad_cursor.status_code == 400
+
+
+def count_queries(monkeypatch):
+    "Keep track of the number of SQL queries executed"
+    from elogy.db import db
+    queries = []
+    execute_sql = db.execute_sql
+
+    def counting_execute_sql(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute_sql", counting_execute_sql)
+    return queries
+
+
+def test_get_entries_constant_queries(elogy_client, monkeypatch):
+    in_logbook, logbook = make_logbook(elogy_client)
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)
+
+    def add_entries(n):
+        for i in range(n):
+            in_entry, entry = make_entry(elogy_client, logbook)
+            elogy_client.post(
+                "{}{}/attachments/".format(url, entry["id"]),
+                content_type='multipart/form-data',
+                data={"attachment": [(BytesIO(b"some data"), "a.txt"),
+                                     (BytesIO(b"more data"), "b.txt")]})
+
+    add_entries(2)
+    queries = count_queries(monkeypatch)
+    result = decode_response(elogy_client.get(url))
+    n_queries = len(queries)
+    assert result["entries"][0]["n_attachments"] == 2
+    assert result["entries"][0]["attachment_preview"]["filename"] == "a.txt"
+
+    add_entries(8)
+    del queries[:]
+    result = decode_response(elogy_client.get(url))
+    assert len(result["entries"]) == 10
+    assert len(queries) == n_queries
+
+
+def test_get_entry_thread_constant_queries(elogy_client, monkeypatch):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    url = "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook)
+
+    def add_followup(parent_id):
+        return decode_response(
+            post_json(elogy_client, "{}{}/".format(url, parent_id),
+                      data=dict(title="Followup",
+                                content="This is a followup!",
+                                content_type="text/plain")))["entry"]
+
+    followup = add_followup(entry["id"])
+    queries = count_queries(monkeypatch)
+    decode_response(elogy_client.get("{}{}/".format(url, entry["id"])))
+    n_queries = len(queries)
+
+    # make a longer thread, with some nested followups
+    for i in range(5):
+        reply = add_followup(followup["id"])
+        add_followup(reply["id"])
+        followup = add_followup(entry["id"])
+    del queries[:]
+    result = decode_response(
+        elogy_client.get("{}{}/".format(url, entry["id"])))["entry"]
+    assert len(queries) == n_queries
+    assert result["n_followups"] == 6
+    assert result["followups"][1]["followups"][0]["followups"][0]["title"]
+
+    # asking for the thread, from a nested followup
+    del queries[:]
+    thread = decode_response(
+        elogy_client.get("{}{}/".format(url, reply["id"]),
+                         data={"thread": True}))["entry"]
+    assert thread["id"] == entry["id"]
+    assert len(queries) == n_queries + 1
+
+
+def wait_for_job(job_id, timeout=5):
+    from elogy.db import Job
+    start = time()
+    while time() - start < timeout:
+        job = Job.get(Job.id == job_id)
+        if job.status in ("done", "failed"):
+            return job
+        sleep(0.05)
+    raise AssertionError("Job {} did not finish in time".format(job_id))
+
+
+def test_pdf_export(elogy_client, monkeypatch, tmpdir):
+    from elogy import export
+    from elogy.app import app
+    from elogy.db import Job
+    monkeypatch.setitem(app.config, "EXPORT_FOLDER", str(tmpdir))
+    exported = []
+
+    def export_entries_as_pdf(logbook, entries, filename):
+        exported.append([entry.id for entry in entries])
+        with open(filename, "wb") as f:
+            f.write(b"%PDF-1.4 test")
+        return True
+
+    monkeypatch.setattr(export, "export_entries_as_pdf",
+                        export_entries_as_pdf)
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    url = "/api/logbooks/{logbook[id]}/exports/pdf/".format(logbook=logbook)
+
+    result = decode_response(elogy_client.post(url))["export"]
+    assert result["status"] in ("pending", "running", "done")
+    job = Job.select().where(Job.kind == "pdf_export").order_by(-Job.id).get()
+    assert wait_for_job(job.id).status == "done"
+    result = decode_response(elogy_client.get(
+        "/api/exports/pdf/{}/".format(result["id"])))["export"]
+    assert result["status"] == "done"
+    assert exported == [[entry["id"]]]
+    response = elogy_client.get(result["link"])
+    assert response.mimetype == "application/pdf"
+    assert response.get_data() == b"%PDF-1.4 test"
+
+    # the same export again is already done
+    n_jobs = Job.select().count()
+    assert decode_response(elogy_client.post(url))["export"] == result
+    assert Job.select().count() == n_jobs
+
+    # ...until something changes
+    make_entry(elogy_client, logbook)
+    new_result = decode_response(elogy_client.post(url))["export"]
+    assert new_result["id"] != result["id"]
+
+
+def test_pdf_export_failed(elogy_client, monkeypatch, tmpdir):
+    from elogy import export
+    from elogy.app import app
+    from elogy.db import Job
+    monkeypatch.setitem(app.config, "EXPORT_FOLDER", str(tmpdir))
+    monkeypatch.setattr(export, "export_entries_as_pdf",
+                        lambda *args: False)  # e.g. pdfkit not installed
+    in_logbook, logbook = make_logbook(elogy_client)
+    make_entry(elogy_client, logbook)
+
+    result = decode_response(elogy_client.post(
+        "/api/logbooks/{logbook[id]}/exports/pdf/"
+        .format(logbook=logbook)))["export"]
+    job = Job.select().where(Job.kind == "pdf_export").order_by(-Job.id).get()
+    assert wait_for_job(job.id).status == "failed"
+    response = elogy_client.get("/api/exports/pdf/{}/".format(result["id"]))
+    result = decode_response(response)["export"]
+    assert result["status"] == "failed"
+    assert "not available" in result["error"]
+    assert result["link"] is None
+    response = elogy_client.get("/api/exports/pdf/{}/file"
+                                .format(result["id"]))
+    assert response.status_code == 404
+    assert elogy_client.get("/api/exports/pdf/nonsense/").status_code == 404
+
+
+def test_pdf_export_reportlab(elogy_client, tmpdir):
+    importorskip("reportlab")
+    from elogy.app import app
+    from elogy.db import Entry, Logbook
+    from elogy.export import export_entries_as_pdf_reportlab
+    in_logbook, logbook = make_logbook(elogy_client)
+    entry = decode_response(post_json(
+        elogy_client,
+        "/api/logbooks/{logbook[id]}/entries/".format(logbook=logbook),
+        data=dict(title="Long <entry> & stuff",
+                  content="".join("<p>Line {}</p>".format(i)
+                                  for i in range(200)))))["entry"]
+    image = BytesIO()
+    Image.new("RGB", (300, 200), (255, 0, 0)).save(image, "PNG")
+    image.seek(0)
+    att = decode_response(elogy_client.post(
+        "/api/logbooks/{logbook[id]}/entries/{entry[id]}/attachments/"
+        .format(logbook=logbook, entry=entry),
+        content_type='multipart/form-data',
+        data={"attachment": [(image, "image.png")]}))
+    elogy_client.get(att["location"] + ".thumbnail")  # make it now
+
+    path = str(tmpdir.join("export.pdf"))
+    with app.app_context():
+        lb = Logbook.get(Logbook.id == logbook["id"])
+        assert export_entries_as_pdf_reportlab(
+            lb, Entry.search(logbook=lb), path)
+    with open(path, "rb") as f:
+        pdf = f.read()
+    assert pdf.startswith(b"%PDF")
+    assert len(re.findall(rb"/Type /Page\b(?!s)", pdf)) > 1
+    assert b"/Subtype /Image" in pdf
+
+
+def test_pdf_export_batches(elogy_client, monkeypatch):
+    from elogy import export
+    from elogy.app import app
+    from elogy.db import Entry, Logbook
+    in_logbook, logbook = make_logbook(elogy_client)
+    ids = [make_entry(elogy_client, logbook)[1]["id"] for i in range(5)]
+
+    monkeypatch.setattr(export, "PDF_BATCH_SIZE", 2)
+    with app.app_context():
+        lb = Logbook.get(Logbook.id == logbook["id"])
+        batches = list(export.iter_pdf_entries(Entry.search(logbook=lb)))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert (sorted(entry["id"] for batch in batches for entry in batch) ==
+            sorted(ids))
+
+
+def read_event(chunks):
+    "Get the data of the next event from an event stream"
+    for chunk in chunks:
+        for line in chunk.decode().splitlines():
+            if line.startswith("data: "):
+                return json.loads(line[len("data: "):])
+
+
+def test_logbook_events(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    url = "/api/logbooks/{logbook[id]}/events".format(logbook=logbook)
+
+    response = elogy_client.get(url, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b"retry:")
+    in_entry, entry = make_entry(elogy_client, logbook)
+    event = read_event(chunks)
+    assert event["type"] == "new_entry"
+    assert event["entry_id"] == entry["id"]
+    assert event["logbook_id"] == logbook["id"]
+    response.close()
+
+    # a reconnecting client gets what it has missed
+    response = elogy_client.get(
+        url, buffered=False, headers={"Last-Event-ID": event["id"] - 1})
+    assert read_event(iter(response.response)) == event
+    response.close()
+
+
+def test_sync(elogy_client):
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+    url = "/api/logbooks/{logbook[id]}/sync/".format(logbook=logbook)
+
+    changes = decode_response(elogy_client.get(url))
+    assert [l["id"] for l in changes["logbooks"]] == [logbook["id"]]
+    assert changes["entries"][0]["content"] == in_entry["content"]
+    assert changes["entries"][0]["logbook_id"] == logbook["id"]
+
+    make_entry(elogy_client, logbook)
+    changes = decode_response(elogy_client.get(
+        url + "?since={}".format(changes["last_seq"])))
+    assert len(changes["entries"]) == 1
+    assert changes["entries"][0]["id"] != entry["id"]
+    assert changes["logbooks"] == []
+
+
+def test_create_entry_batch(elogy_client):
+    logbook = decode_response(post_json(
+        elogy_client, "/api/logbooks/",
+        data=dict(name="Logbook", attributes=[
+            dict(name="Count", type="number")])))["logbook"]
+    response = post_json(
+        elogy_client,
+        "/api/logbooks/{logbook[id]}/entries/batch".format(logbook=logbook),
+        data={"entries": [
+            dict(title="First", content="Hello", content_type="text/plain",
+                 authors=[{"name": "Alice"}], attributes={"Count": "3"},
+                 ref="1"),
+            dict(title="Reply", content="<p>Hi</p>", follows_ref="1",
+                 authors=[{"name": "Bob"}])]})
+    assert response.status_code == 200
+    first, reply = decode_response(response)["entries"]
+    assert first["ref"] == "1"
+    assert reply["ref"] is None
+
+    result = decode_response(elogy_client.get(
+        "/api/logbooks/{}/entries/{}/".format(logbook["id"], first["id"])))
+    entry = result["entry"]
+    assert entry["title"] == "First"
+    assert entry["attributes"] == {"Count": 3}
+    followup, = entry["followups"]
+    assert followup["id"] == reply["id"]
+    assert followup["content"] == "<p>Hi</p>"
+
+    # references must be to earlier entries in the batch
+    response = post_json(
+        elogy_client,
+        "/api/logbooks/{logbook[id]}/entries/batch".format(logbook=logbook),
+        data={"entries": [dict(title="Reply", follows_ref="2"),
+                          dict(title="First", ref="2")]})
+    assert response.status_code == 400
+
+
+def test_create_entry_batch_events(elogy_client):
+    from elogy.db import Event
+    in_logbook, logbook = make_logbook(elogy_client)
+    url = "/api/logbooks/{logbook[id]}/entries/batch".format(logbook=logbook)
+    last_id = Event.last_id()
+    response = post_json(elogy_client, url, data={"entries": [
+        dict(title="First", ref="1"), dict(title="Reply", follows_ref="1")]})
+    ids = [e["id"] for e in decode_response(response)["entries"]]
+    events = Event.since(last_id, logbook["id"])
+    assert [(e.kind, e.entry_id) for e in events] == [
+        ("new_entry", entry_id) for entry_id in ids]
+
+
+def test_create_entry_batch_no_orphaned_images(elogy_client):
+    import os
+    from elogy.app import app
+
+    def uploaded_files():
+        return sorted(os.path.join(path, name) for path, _, names
+                      in os.walk(app.config["UPLOAD_FOLDER"])
+                      for name in names)
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    before = uploaded_files()
+    image = BytesIO()
+    Image.new("RGB", (10, 10), (255, 0, 0)).save(image, "PNG")
+    src = "data:image/png;base64," + b64encode(
+        image.getvalue()).decode()
+    response = post_json(
+        elogy_client,
+        "/api/logbooks/{logbook[id]}/entries/batch".format(logbook=logbook),
+        data={"entries": [
+            dict(title="Image", content='<p><img src="{}"></p>'.format(src)),
+            dict(title="Reply", follows_ref="nonsense")]})
+    assert response.status_code == 400
+    assert uploaded_files() == before
+
+
+def test_export_entries(elogy_client):
+    logbook = decode_response(post_json(
+        elogy_client, "/api/logbooks/",
+        data=dict(name="Logbook", attributes=[
+            dict(name="Shift", type="text"),
+            dict(name="Systems", type="multioption",
+                 options=["a", "b", "c"])])))["logbook"]
+    entries_url = ("/api/logbooks/{logbook[id]}/entries/"
+                   .format(logbook=logbook))
+    entry = decode_response(post_json(
+        elogy_client, entries_url,
+        data=dict(title="First", content="<p>Hello, world</p>",
+                  authors=[{"name": "Alice"}, {"name": "Bob"}],
+                  attributes={"Shift": "Night", "Systems": ["a", "c"]})))
+    post_json(elogy_client,
+              entries_url + "{}/".format(entry["entry"]["id"]),
+              data=dict(title="Followup", content="Reply"))
+
+    response = elogy_client.get(entries_url + "?download=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = [json.loads(line)
+             for line in response.get_data().decode().splitlines()]
+    assert sorted(line["title"] for line in lines) == ["First", "Followup"]
+    first, = [line for line in lines if line["title"] == "First"]
+    assert first["attributes"] == {"Shift": "Night", "Systems": ["a", "c"]}
+    assert first["content"] == "<p>Hello, world</p>"
+
+    response = elogy_client.get(entries_url + "?download=csv&title=First")
+    assert response.mimetype == "text/csv"
+    assert "Logbook.csv" in response.headers["Content-Disposition"]
+    header, row = csv.reader(StringIO(response.get_data().decode()))
+    assert header[-2:] == ["Shift", "Systems"]
+    row = dict(zip(header, row))
+    assert row["authors"] == "Alice, Bob"
+    assert row["Systems"] == "a; c"
+
+
+def test_entry_action(elogy_client, monkeypatch):
+    from elogy.app import app
+    from elogy.db import Job
+    actions = []
+    monkeypatch.setitem(app.config, "ACTIONS",
+                        {"new_entry": lambda data: actions.append(data)})
+
+    in_logbook, logbook = make_logbook(elogy_client)
+    in_entry, entry = make_entry(elogy_client, logbook)
+
+    # the action is run in the background
+    job = Job.select().where(Job.kind == "action").order_by(-Job.id).get()
+    assert wait_for_job(job.id).status == "done"
+    assert actions[0]["entry"]["id"] == entry["id"]
+
+    metrics = decode_response(elogy_client.get("/api/jobs/"))
+    assert metrics["kinds"]["action"]["done"] >= 1
+    assert metrics["kinds"]["action"]["wait"] is not None
+
+
+def test_job_timeout(elogy_client):
+    from elogy import jobs
+    from elogy.app import app
+
+    @jobs.handler("hang", timeout=0.1)
+    def hanging_job():
+        sleep(1)
+
+    with app.app_context():
+        job = jobs.queue.submit("hang")
+    job = wait_for_job(job.id)
+    assert job.status == "failed"
+    assert job.error == "Timed out after 0.1 s"
+
+
+def test_job_timeout_not_retried(elogy_client, monkeypatch):
+    from threading import Event
+    from elogy import jobs
+    from elogy.app import app
+    from elogy.db import Job
+
+    release = Event()
+    calls = []
+
+    @jobs.handler("stuck", timeout=0.1, retries=2, backoff=0)
+    def stuck_job():
+        calls.append(None)
+        release.wait(5)
+
+    monkeypatch.setattr(jobs, "MAX_ABANDONED_THREADS", 1)
+    monkeypatch.setattr(jobs, "abandoned_threads", [])
+    try:
+        with app.app_context():
+            # it might still be running, so it's not tried again
+            job = Job.create(kind="stuck")
+            assert jobs.run_job(job.id)
+            job = Job.get(Job.id == job.id)
+            assert job.status == "failed"
+            assert len(calls) == 1
+
+            # too many hung jobs; try again later
+            job = Job.create(kind="stuck")
+            assert jobs.run_job(job.id)
+            job = Job.get(Job.id == job.id)
+            assert job.status == "pending"
+            assert job.attempts == 0
+            assert len(calls) == 1
+    finally:
+        release.set()
+
+
+def test_connection_closed_after_request(elogy_client):
+    from elogy.app import app
+    from elogy.db import db
+    # elogy_client keeps the last request open, so use a separate one
+    make_logbook(app.test_client())
+    assert db.is_closed()
@@ -1,8 +1,24 @@
+from datetime import datetime, timedelta
 from operator import attrgetter
 
+from pytest import raises
+
 from .fixtures import db
 from elogy.db import Entry, EntryChange, EntryRevision
-from elogy.db import Logbook, LogbookChange, LogbookRevision
+from elogy.db import Logbook, LogbookChange, LogbookRevision, Event
+from elogy.db import Attachment, get_changes_since
+
+
+# Setup
+
+def test_pragmas(db):
+    from elogy.db import setup_database
+    assert db.pragma("synchronous") == (1,)  # NORMAL
+    assert db.pragma("temp_store") == (2,)  # MEMORY
+    assert db.pragma("busy_timeout") == (10000,)
+    setup_database(":memory:", close=False, pragmas={"cache_size": -1000})
+    assert db.pragma("cache_size") == (-1000,)
+    assert db.pragma("busy_timeout") == (10000,)
 
 
 # Logbook
@@ -20,6 +36,66 @@ def test_logbook_entries(db):
     assert len(lb.entries) == 2
 
 
+def test_logbook_hierarchy(db):
+    from elogy.db import LogbookClosure
+
+    lb1 = Logbook.create(name="Logbook1")
+    lb2 = Logbook.create(name="Logbook2", parent=lb1)
+    lb3 = Logbook.create(name="Logbook3", parent=lb2)
+    lb4 = Logbook.create(name="Logbook4")
+
+    assert lb3.ancestors == [lb1, lb2]
+    assert list(lb1.descendants) == [lb2, lb3]
+
+    # moving a logbook also moves its descendants
+    lb2.parent = lb4
+    lb2.save()
+    assert lb3.ancestors == [lb4, lb2]
+    assert list(lb1.descendants) == []
+    assert list(lb4.descendants) == [lb2, lb3]
+
+    lb2.parent = None
+    lb2.save()
+    assert lb2.ancestors == []
+    assert lb3.ancestors == [lb2]
+
+    # rebuilding from scratch gives the same result
+    def closure():
+        return sorted(LogbookClosure.select(LogbookClosure.ancestor,
+                                            LogbookClosure.descendant,
+                                            LogbookClosure.depth).tuples())
+    before = closure()
+    LogbookClosure.rebuild()
+    assert closure() == before
+
+
+def test_logbook_change_count(db):
+    parent = Logbook.create(name="Parent")
+    child = Logbook.create(name="Child", parent=parent)
+    other = Logbook.create(name="Other")
+
+    def counts():
+        return dict(Logbook.get_change_counts())
+
+    before = counts()
+    Entry.create(logbook=child, title="Entry")
+    after = counts()
+    assert after[child.id] > before[child.id]
+    assert after[parent.id] > before[parent.id]
+    assert after[other.id] == before[other.id]
+    assert Logbook.get_change_counts(child.id) == [
+        (parent.id, after[parent.id]), (child.id, after[child.id])]
+
+    # the children show the name of their parent
+    before = after
+    parent.name = "New name"  # saving a stale object
+    parent.save()
+    after = counts()
+    assert after[child.id] > before[child.id]
+    assert after[parent.id] > before[parent.id]
+    assert after[other.id] == before[other.id]
+
+
 def test_logbookrevision(db):
     lb = Logbook.create(name="Logbook1", description="Hello")
     # to properly update the logbook, use the "make_change" method
@@ -176,6 +252,161 @@ def test_entryrevisionwrapper2(db):
     assert wrapper2.content == entry_v2["content"]
 
 
+def test_entryrevision_out_of_range(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry1")
+    entry.make_change(title="Entry2").save()
+    entry.save()
+    entry.make_change(title="Entry3").save()
+    entry.save()
+    assert entry.revision_n == 2
+
+    for version in [-1, 3]:
+        with raises(EntryChange.DoesNotExist):
+            entry.get_revision(version)
+
+    # the revision number can also be found from the change alone
+    change = entry.get_revision(1).change
+    assert EntryRevision(change).revision_n == 1
+
+
+def test_entry_get_changes(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Title1", content="Content1")
+    entry.make_change(title="Title2").save()
+    entry.save()
+    entry.make_change(content="Content2").save()
+    entry.save()
+    entry.make_change(title="Title3", content="Content3").save()
+    entry.save()
+
+    changes = entry.get_changes()
+    assert [(c.get_old_value("title"), c.get_new_value("title"))
+            for c in changes] == [("Title1", "Title2"),
+                                  ("Title2", "Title2"),
+                                  ("Title2", "Title3")]
+    assert [(c.get_old_value("content"), c.get_new_value("content"))
+            for c in changes] == [("Content1", "Content1"),
+                                  ("Content1", "Content2"),
+                                  ("Content2", "Content3")]
+
+    # the same values must come out without the prefetching
+    for change, prefetched in zip(entry.changes.order_by(EntryChange.id),
+                                  changes):
+        assert change.old_values is None
+        for attr in ["title", "content"]:
+            assert (change.get_old_value(attr) ==
+                    prefetched.get_old_value(attr))
+            assert (change.get_new_value(attr) ==
+                    prefetched.get_new_value(attr))
+
+
+def test_logbook_get_changes(db):
+    lb = Logbook.create(name="Name1", description="Description1")
+    lb.make_change(name="Name2").save()
+    lb.save()
+    lb.make_change(description="Description2").save()
+    lb.save()
+
+    changes = lb.get_changes()
+    assert [(c.get_old_value("name"), c.get_new_value("name"))
+            for c in changes] == [("Name1", "Name2"), ("Name2", "Name2")]
+    assert ([(c.get_old_value("description"), c.get_new_value("description"))
+             for c in changes] ==
+            [("Description1", "Description1"),
+             ("Description1", "Description2")])
+
+    # the same values must come out without the prefetching
+    for change, prefetched in zip(lb.changes.order_by(LogbookChange.id),
+                                  changes):
+        assert change.old_values is None
+        for attr in ["name", "description"]:
+            assert (change.get_old_value(attr) ==
+                    prefetched.get_old_value(attr))
+            assert (change.get_new_value(attr) ==
+                    prefetched.get_new_value(attr))
+
+
+def test_entry_content_patches(db):
+    lb = Logbook.create(name="Logbook1")
+    lines = ["<p>Line {}</p>".format(i) for i in range(20)]
+    entry = Entry.create(logbook=lb, title="Entry1",
+                         content="\n".join(lines))
+    contents = [entry.content]
+    for i in range(25):
+        lines[i % 20] = "<p>Changed line {}</p>".format(i)
+        entry.make_change(content="\n".join(lines)).save()
+        entry.save()
+        contents.append(entry.content)
+
+    # content is stored as patches, except for some snapshots
+    changes = list(entry.changes.order_by(EntryChange.id))
+    snapshots = [i for i, change in enumerate(changes)
+                 if isinstance(change.changed["content"], str)]
+    assert snapshots == [0, 10, 20]
+
+    # all revisions can be reconstructed
+    for i, content in enumerate(contents):
+        assert entry.get_revision(i).content == content
+    for i, change in enumerate(entry.get_changes()):
+        assert change.get_old_value("content") == contents[i]
+        assert change.get_new_value("content") == contents[i + 1]
+
+
+def test_entry_content_snapshots(db, monkeypatch):
+    import elogy.db
+    lb = Logbook.create(name="Logbook1")
+    lines = ["<p>Line {}</p>".format(i) for i in range(20)]
+    entry = Entry.create(logbook=lb, title="Title", content="\n".join(lines))
+    contents = [entry.content]
+    for i in range(40):
+        # every other change leaves the content alone
+        if i % 2:
+            entry.make_change(title="Title {}".format(i)).save()
+        else:
+            lines[i % 20] = "<p>Changed line {}</p>".format(i)
+            entry.make_change(content="\n".join(lines)).save()
+        entry.save()
+        contents.append(entry.content)
+
+    # the snapshots are counted in changes to the content
+    changes = list(entry.changes.order_by(EntryChange.id))
+    snapshots = [i for i, change in enumerate(changes)
+                 if isinstance(change.changed.get("content"), str)]
+    assert snapshots == [0, 20]
+
+    # only the patches up to the next snapshot are applied
+    applied = []
+    apply_patch = elogy.db.apply_patch
+    monkeypatch.setattr(elogy.db, "apply_patch",
+                        lambda *args: applied.append(1) or apply_patch(*args))
+    for i, content in enumerate(contents):
+        del applied[:]
+        assert entry.get_revision(i).content == content
+        assert len(applied) < elogy.db.CONTENT_SNAPSHOT_INTERVAL
+
+
+def test_entry_compress_changes(db):
+    lb = Logbook.create(name="Logbook1")
+    lines = ["<p>Line {}</p>".format(i) for i in range(20)]
+    entry = Entry.create(logbook=lb, title="Entry1",
+                         content="\n".join(lines))
+    contents = [entry.content]
+    for i in range(5):
+        lines[i] = "<p>Changed line {}</p>".format(i)
+        content = "\n".join(lines)
+        # the way content used to be stored, in full
+        EntryChange.create(entry=entry, changed={"content": entry.content})
+        entry.content = content
+        entry.save()
+        contents.append(content)
+
+    assert entry.compress_changes() == 4
+    assert entry.compress_changes() == 0
+    for i, content in enumerate(contents):
+        assert entry.get_revision(i).content == content
+
+
 # Search
 
 def test_entry_content_search(db):
@@ -412,3 +643,481 @@ def test_entry_attribute_multioption_filter(db):
     assert len(results) == 2
     set([results[0].title, results[0].title]) == set(["First entry",
                                                       "Second entry"])
+
+
+def test_entry_thread_summary(db):
+    lb = Logbook.create(name="Logbook1")
+    created_at = datetime(2017, 1, 1, 12, 0, 0)
+    entry = Entry.create(logbook=lb, title="Entry", created_at=created_at,
+                         authors=[{"name": "Alice"}])
+    other = Entry.create(logbook=lb, title="Other",
+                         created_at=created_at + timedelta(hours=1))
+
+    result = list(Entry.search(logbook=lb))
+    assert [e.id for e in result] == [other.id, entry.id]
+    assert result[1].n_followups == 0
+    assert result[1].followup_authors == []
+
+    Entry.create(logbook=lb, title="Followup", follows=entry,
+                 created_at=created_at + timedelta(hours=2),
+                 authors=[{"name": "Bob"}, {"name": "Alice"}])
+    followup2 = Entry.create(logbook=lb, title="Followup2", follows=entry,
+                             created_at=created_at + timedelta(hours=3),
+                             authors=[{"name": "Bob"}])
+
+    # the thread with the latest activity comes first
+    result = list(Entry.search(logbook=lb))
+    assert [e.id for e in result] == [entry.id, other.id]
+    assert result[0].n_followups == 2
+    assert result[0].followup_authors == ["Bob", "Alice"]
+    assert result[0].timestamp == str(created_at + timedelta(hours=3))
+
+    # editing a followup also counts as activity in the thread
+    change = followup2.make_change(content="edited")
+    followup2.save()
+    change.save()
+    entry = Entry.get(Entry.id == entry.id)
+    assert entry.thread_last_activity == followup2.last_changed_at
+
+
+def test_entry_prefetch_followups(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry")
+    followup = Entry.create(logbook=lb, title="Followup", follows=entry)
+    reply = Entry.create(logbook=lb, title="Reply", follows=followup)
+    attachment = Attachment.create(entry=followup, path="a.png")
+    Attachment.create(entry=followup, path="b.png", embedded=True)
+
+    entry.prefetch_followups()
+    prefetched, = entry._prefetched_followups
+    assert prefetched.id == followup.id
+    assert [a.id for a in prefetched._prefetched_attachments] == [
+        attachment.id, attachment.id + 1]
+    assert [e.id for e in prefetched._prefetched_followups] == [reply.id]
+    # the relations can still be queried
+    assert [a.id for a in prefetched.get_attachments()] == [attachment.id]
+    assert entry.followups.count() == 1
+
+
+def test_entry_content_text(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="Entry",
+                         content="<p>Some <b>bold</b>\ntext</p>")
+    assert entry.content_text == "Some bold\ntext"
+    assert entry.preview == "Some bold text"
+
+    # updated on edit
+    entry.content = "<p>{}</p>".format("a" * 300)
+    entry.save()
+    entry = Entry.get(Entry.id == entry.id)
+    assert entry.content_text == "a" * 300
+    assert entry.preview == "a" * 200
+
+    # the listing uses the stored preview
+    result, = Entry.search(logbook=lb)
+    assert result.preview == "a" * 200
+
+
+def test_entry_search_child_logbooks(db):
+    lb1 = Logbook.create(name="Logbook1")
+    lb2 = Logbook.create(name="Logbook2", parent=lb1)
+    lb3 = Logbook.create(name="Logbook3", parent=lb2)
+    other = Logbook.create(name="Other")
+    Entry.create(logbook=lb1, title="Parent")
+    important = Entry.create(logbook=lb1, title="Important", priority=200)
+    entry2 = Entry.create(logbook=lb2, title="Entry2")
+    entry3 = Entry.create(logbook=lb3, title="Entry3")
+    Entry.create(logbook=other, title="Other", priority=200)
+
+    results = Entry.search(logbook=lb2, child_logbooks=True)
+    assert ({e.id for e in results} ==
+            {important.id, entry2.id, entry3.id})
+    result, = Entry.search(logbook=lb2, child_logbooks=True,
+                           count=True).tuples()
+    assert result[0] == 3
+
+
+def test_entry_content_search_fulltext(db):
+    lb = Logbook.create(name="Logbook1")
+
+    entries = [
+        {
+            "logbook": lb,
+            "title": "First entry",
+            "content": "<p>The <b>magnet</b> tripped.</p>"
+        },
+        {
+            "logbook": lb,
+            "title": "Second entry",
+            "content": "<p>Electromagnets are fun</p>"
+        },
+        {
+            "logbook": lb,
+            "title": "Third entry",
+            "content": "<p>Nothing to see here.</p>"
+        }
+    ]
+
+    for entry in entries:
+        Entry.create(**entry)
+
+    # plain words are matched as substrings, ignoring case and markup
+    results = list(Entry.search(logbook=lb, content_filter="MAGNET"))
+    assert set(map(attrgetter("title"), results)) == set(["First entry",
+                                                          "Second entry"])
+    results = list(Entry.search(logbook=lb, content_filter="magnet tripped"))
+    assert set(map(attrgetter("title"), results)) == set(["First entry"])
+
+    # combined with a title filter
+    result, = list(Entry.search(logbook=lb, content_filter="magnet",
+                                title_filter="second"))
+    assert result.title == "Second entry"
+
+
+def test_entry_content_search_fulltext_edit(db):
+    lb = Logbook.create(name="Logbook1")
+    entry = Entry.create(logbook=lb, title="First entry",
+                         content="Some content.")
+    assert not list(Entry.search(logbook=lb, content_filter="changed"))
+
+    # the index must follow changes to the entry
+    entry.make_change(content="Some changed content.").save()
+    entry.save()
+    result, = list(Entry.search(logbook=lb, content_filter="changed"))
+    assert result.id == entry.id
+    assert not list(Entry.search(logbook=lb, content_filter="Some content"))
+
+
+def test_entry_search_literal_and_regexp(db):
+    from elogy.db import text_condition
+    lb = Logbook.create(name="Logbook1")
+    entry1 = Entry.create(logbook=lb, title="Hello World",
+                          authors=[{"name": "Åsa Öberg"}])
+    entry2 = Entry.create(logbook=lb, title="Goodbye",
+                          authors=[{"name": "Bob"}])
+
+    def search(**kwargs):
+        return [e.id for e in Entry.search(logbook=lb, **kwargs)]
+
+    # plain ASCII terms don't need a regexp
+    assert text_condition("title", "Wo") == ("instr(lower(title), ?) > 0",
+                                             "wo")
+    assert search(title_filter="Wo") == [entry1.id]
+    assert search(title_filter="^g.*e$") == [entry2.id]
+    # non-ASCII case insensitivity needs python
+    assert text_condition("name", "åsa") == ("name REGEXP ?", "åsa")
+    assert search(author_filter="åsa") == [entry1.id]
+    assert search(author_filter="b") == [entry2.id, entry1.id]
+
+
+def test_entry_search_with_count(db):
+    lb = Logbook.create(name="Logbook1")
+    for i in range(5):
+        entry = Entry.create(logbook=lb, title="Entry {}".format(i))
+    # followups are not counted
+    Entry.create(logbook=lb, title="Followup", follows=entry)
+
+    entries, count = Entry.search_with_count(logbook=lb, n=2)
+    assert len(entries) == 2
+    assert count == 5
+
+    entries, count = Entry.search_with_count(logbook=lb, n=2, offset=4)
+    assert len(entries) == 1
+    assert count == 5
+
+    entries, count = Entry.search_with_count(logbook=lb,
+                                             title_filter="Nothing")
+    assert entries == []
+    assert count == 0
+
+
+def test_entry_search_after(db):
+    lb = Logbook.create(name="Logbook1")
+    # entries with the same timestamp are ordered by id
+    created_at = datetime(2017, 1, 1, 12, 0, 0)
+    for i in range(5):
+        Entry.create(logbook=lb, title="Entry {}".format(i),
+                     created_at=created_at)
+    for i in range(5, 10):
+        Entry.create(logbook=lb, title="Entry {}".format(i),
+                     created_at=created_at + timedelta(minutes=i))
+    Entry.create(logbook=lb, title="Pinned", priority=100,
+                 created_at=created_at)
+
+    all_entries = list(Entry.search(logbook=lb))
+    assert all_entries[0].title == "Pinned"
+
+    # paging through the results, three at a time
+    pages = []
+    after = None
+    while True:
+        page = list(Entry.search(logbook=lb, n=3, after=after))
+        if not page:
+            break
+        pages.append(page)
+        last = page[-1]
+        after = (last.priority, last.timestamp, last.id)
+    assert [len(page) for page in pages] == [3, 3, 3, 2]
+    assert ([e.id for page in pages for e in page] ==
+            [e.id for e in all_entries])
+
+
+# Jobs
+
+def test_run_job(db):
+    from elogy import jobs
+    from elogy.db import Job
+
+    calls = []
+
+    @jobs.handler("test")
+    def test_job(value):
+        calls.append(value)
+
+    job = Job.create(kind="test", args={"value": 17})
+    assert jobs.run_job(job.id)
+    # a job is only run once
+    assert not jobs.run_job(job.id)
+    assert calls == [17]
+    job = Job.get(Job.id == job.id)
+    assert job.status == "done"
+    assert job.attempts == 1
+
+    @jobs.handler("broken")
+    def broken_job():
+        raise RuntimeError("oops")
+
+    job = Job.create(kind="broken")
+    jobs.run_job(job.id)
+    job = Job.get(Job.id == job.id)
+    assert job.status == "failed"
+    assert job.error == "oops"
+
+
+def test_run_job_retry(db):
+    from elogy import jobs
+    from elogy.db import Job
+
+    calls = []
+
+    @jobs.handler("flaky", retries=1, backoff=0)
+    def flaky_job():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("oops")
+
+    job = Job.create(kind="flaky")
+    assert jobs.run_job(job.id)
+    job = Job.get(Job.id == job.id)
+    assert job.status == "pending"
+    assert jobs.run_job(job.id)
+    job = Job.get(Job.id == job.id)
+    assert job.status == "done"
+    assert job.attempts == 2
+
+    @jobs.handler("slow_retry", retries=1, backoff=60)
+    def slow_retry_job():
+        raise RuntimeError("oops")
+
+    job = Job.create(kind="slow_retry")
+    assert jobs.run_job(job.id)
+    # not time to retry yet
+    assert not jobs.run_job(job.id)
+    assert Job.get(Job.id == job.id).status == "pending"
+
+
+def test_interrupted_jobs(db):
+    from elogy import jobs
+    from elogy.db import Job
+
+    @jobs.handler("interrupted", timeout=10, retries=1)
+    def interrupted_job():
+        pass
+
+    long_ago = datetime.utcnow() - jobs.INTERRUPTED_AFTER - timedelta(
+        seconds=20)
+    retried = Job.create(kind="interrupted", status="running", attempts=1,
+                         started_at=long_ago)
+    given_up = Job.create(kind="interrupted", status="running", attempts=2,
+                          started_at=long_ago)
+    running = Job.create(kind="interrupted", status="running", attempts=1,
+                         started_at=datetime.utcnow())
+
+    jobs.JobQueue()._poll()
+    assert Job.get(Job.id == retried.id).status == "pending"
+    given_up = Job.get(Job.id == given_up.id)
+    assert given_up.status == "failed"
+    assert given_up.error == "Interrupted"
+    assert Job.get(Job.id == running.id).status == "running"
+
+
+# Migrations
+
+def test_migrations(db):
+    from elogy.migrations import MIGRATIONS, get_version, migrate_database
+
+    # a fresh database is already up to date
+    assert get_version() == len(MIGRATIONS)
+    assert migrate_database() == []
+
+    Logbook.create(name="Logbook1")
+    Logbook.create(name="Logbook2")
+
+    def add_logbook_numbers():
+        db.execute_sql("ALTER TABLE logbook ADD COLUMN number INTEGER")
+        yield
+        for logbook in Logbook.select():
+            db.execute_sql("UPDATE logbook SET number = ? WHERE id = ?",
+                           (logbook.id * 10, logbook.id))
+            yield  # commits each time
+
+    MIGRATIONS.append(add_logbook_numbers)
+    try:
+        assert migrate_database() == ["add_logbook_numbers"]
+        assert get_version() == len(MIGRATIONS)
+        assert (db.execute_sql("SELECT number FROM logbook ORDER BY id")
+                .fetchall() == [(10,), (20,)])
+        assert migrate_database() == []
+    finally:
+        MIGRATIONS.remove(add_logbook_numbers)
+
+
+def test_migrations_resume_filling(db):
+    from elogy.db import EntrySearch
+    from elogy.migrations import (MIGRATIONS, migrate_database, set_version,
+                                  fill_entry_search)
+
+    lb = Logbook.create(name="Logbook")
+    entries = [Entry.create(logbook=lb, title="Entry {}".format(i),
+                            content="Magnet {}".format(i))
+               for i in range(5)]
+
+    # as if the filling was interrupted after the first entries
+    ids = [entry.id for entry in entries[2:]]
+    (Entry.update(thread_last_activity=None, content_text=None, preview=None)
+     .where(Entry.id << ids)
+     .execute())
+    if EntrySearch.enabled:
+        db.execute_sql("DELETE FROM entrysearch WHERE rowid IN ({})"
+                       .format(", ".join("?" for _ in ids)), ids)
+    set_version(MIGRATIONS.index(fill_entry_search))
+
+    assert migrate_database() == ["fill_entry_search",
+                                  "fill_thread_summaries",
+                                  "fill_content_text"]
+    assert (Entry.select()
+            .where(Entry.thread_last_activity >> None)
+            .count() == 0)
+    assert ([e.content_text for e in Entry.select().order_by(Entry.id)] ==
+            ["Magnet {}".format(i) for i in range(5)])
+    if EntrySearch.enabled:
+        results = list(Entry.search(logbook=lb, content_filter="magnet"))
+        assert len(results) == len(entries)
+
+
+def test_event_since(db):
+    parent = Logbook.create(name="Parent")
+    child = Logbook.create(name="Child", parent=parent)
+    other = Logbook.create(name="Other")
+    last_id = Event.last_id()
+    events = [Event.create(kind="new_entry", logbook=logbook)
+              for logbook in [parent, child, other]]
+
+    assert [e.id for e in Event.since(last_id)] == [e.id for e in events]
+    assert ([e.id for e in Event.since(last_id, parent.id)] ==
+            [e.id for e in events[:2]])
+    assert Event.since(events[0].id, child.id)[0].id == events[1].id
+    assert Event.since(events[-1].id) == []
+    assert Event.last_id() == events[-1].id
+
+
+def test_get_changes_since(db):
+    parent = Logbook.create(name="Parent")
+    child = Logbook.create(name="Child", parent=parent)
+    other = Logbook.create(name="Other")
+    entry = Entry.create(logbook=child, title="Entry")
+    followup = Entry.create(logbook=child, title="Followup", follows=entry)
+    Entry.create(logbook=other, title="Other entry")
+    attachment = Attachment.create(entry=entry, path="a.png")
+    Attachment.create(path="unattached.png")
+
+    changes = get_changes_since(0, parent.id)
+    assert [l.id for l in changes["logbooks"]] == [parent.id, child.id]
+    assert [e.id for e in changes["entries"]] == [entry.id, followup.id]
+    assert [a.id for a in changes["attachments"]] == [attachment.id]
+    assert not changes["more"]
+    last_seq = changes["last_seq"]
+    assert get_changes_since(last_seq)["entries"] == []
+
+    # only what has changed since last time
+    change = entry.make_change(title="Changed")
+    entry.save()
+    change.save()
+    changes = get_changes_since(last_seq, parent.id)
+    assert [e.title for e in changes["entries"]] == ["Changed"]
+    assert changes["logbooks"] == changes["attachments"] == []
+    assert changes["last_seq"] > last_seq
+
+    # in several steps
+    changes = get_changes_since(0, n=4)
+    assert changes["more"]
+    assert sum(len(changes[name])
+               for name in ["logbooks", "entries", "attachments"]) == 4
+    seen = 4
+    while changes["more"]:
+        changes = get_changes_since(changes["last_seq"], n=4)
+        seen += sum(len(changes[name])
+                    for name in ["logbooks", "entries", "attachments"])
+    assert seen == 3 + 3 + 1
+
+
+def test_entry_create_many(db):
+    lb = Logbook.create(name="Logbook")
+    existing = Entry.create(logbook=lb, title="Existing")
+    last_seq = get_changes_since(0)["last_seq"]
+    change_count = Logbook.get(Logbook.id == lb.id).change_count
+    first = dict(logbook=lb, title="First", content="<p>Magnet trip</p>",
+                 authors=[{"name": "Alice"}])
+    entries = [
+        first,
+        dict(logbook=lb, title="Reply", content="Fixed", follows=first,
+             content_type="text/plain", authors=[{"name": "Bob"}]),
+        dict(logbook=lb, title="Late reply", follows=existing.id,
+             authors=[{"name": "Carol"}])
+    ]
+    first_id, reply_id, late_id = Entry.create_many(entries)
+
+    first = Entry.get(Entry.id == first_id)
+    assert first.content_text == first.preview == "Magnet trip"
+    assert first.n_followups == 1
+    assert first.followup_authors == ["Bob"]
+    assert Entry.get(Entry.id == reply_id).follows_id == first_id
+    assert Entry.get(Entry.id == existing.id).followup_authors == ["Carol"]
+    assert Logbook.get(Logbook.id == lb.id).change_count > change_count
+    changes = get_changes_since(last_seq)
+    assert [e.id for e in changes["entries"]] == [first_id, reply_id, late_id]
+    result, = Entry.search(logbook=lb, content_filter="magnet")
+    assert result.id == first_id
+
+    # followups must come after the entries they follow
+    later = dict(logbook=lb, title="Later")
+    with raises(ValueError):
+        Entry.create_many([dict(logbook=lb, follows=later), later])
+    assert Entry.select().count() == 4
+
+
+def test_iter_entries(db):
+    from elogy.export import iter_entries
+    parent = Logbook.create(name="Parent")
+    child = Logbook.create(name="Child", parent=parent)
+    entries = [Entry.create(logbook=lb, title="Entry {}".format(i))
+               for i, lb in enumerate([parent, child] * 3)]
+    followup = Entry.create(logbook=child, title="Followup",
+                            follows=entries[1])
+
+    # followups are included
+    result = list(iter_entries(logbook=parent, child_logbooks=True))
+    assert sorted(e.id for e in result) == sorted(
+        [e.id for e in entries] + [followup.id])
+    result = list(iter_entries(logbook=child, title_filter="Entry"))
+    assert sorted(e.id for e in result) == [e.id for e in entries[1::2]]
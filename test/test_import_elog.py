@@ -0,0 +1,131 @@
+from importlib.util import spec_from_file_location, module_from_spec
+import json
+import os
+
+import pytest
+from pytest import importorskip
+
+
+LOGFILE = """\
+$@MID@$: 1
+Date: Mon, 01 Jan 2018 10:00:00 +0100
+Author: Alice, Bob
+Subject: First entry
+Type: Routine
+Attachment: 180101_100000_plot.png,180101_100000_data.txt
+Encoding: plain
+========================================
+Line one
+Line two: with a colon
+
+$@MID@$: 2
+Date: Mon, 01 Jan 2018 11:00:00 +0100
+In reply to: 1
+Author: Carol
+Subject: Re: First entry
+Attachment:
+Encoding: HTML
+========================================
+<p>Reply</p>
+$@MID@$: 3
+Date: Mon, 01 Jan 2018 12:00:00 +0100
+Subject: No body separator, so it's skipped
+$@MID@$: 4
+Date: Mon, 01 Jan 2018 13:00:00 +0100
+Author: Alice
+Subject: Last entry
+Encoding: plain
+========================================
+The end"""
+
+
+@pytest.fixture(scope="module")
+def import_elog():
+    "The script is not in a package, so it's loaded from the file"
+    importorskip("requests")
+    path = os.path.join(os.path.dirname(__file__), os.pardir,
+                        "scripts", "import_elog.py")
+    spec = spec_from_file_location("import_elog", path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def logfile(tmpdir):
+    path = tmpdir.join("180101a.log")
+    path.write_binary(LOGFILE.encode("ISO-8859-1"))
+    return str(path)
+
+
+def test_load_elog_file(import_elog, logfile):
+    entries = list(import_elog.load_elog_file(logfile))
+    assert [e["mid"] for e in entries] == [1, 2, 4]
+    first, reply, last = entries
+    assert first["author"] == "Alice, Bob"
+    assert first["subject"] == "First entry"
+    assert first["type"] == "Routine"
+    assert first["encoding"] == "plain"
+    # colons in the body are not mistaken for headers
+    assert first["body"] == b"\nLine one\nLine two: with a colon\n\n"
+    assert "line two" not in first
+    assert reply["in reply to"] == "1"
+    assert "attachment" not in reply  # empty headers are left out
+    assert reply["body"] == b"\n<p>Reply</p>\n"
+    # no newline at the end of the file
+    assert last["body"] == b"\nThe end"
+
+
+def test_get_entries(import_elog, logfile, tmpdir):
+    logbook = {
+        "uuid": "some-uuid",
+        "name": "Some logbook",
+        "path": str(tmpdir),
+        "attributes": [{"name": "Type", "type": "text"}]
+    }
+    entries = import_elog.get_entries(logbook)
+    assert sorted(entries) == [("some-uuid", 1), ("some-uuid", 2),
+                               ("some-uuid", 4)]
+
+    first = entries[("some-uuid", 1)]
+    assert first["title"] == "First entry"
+    assert [a["name"] for a in first["authors"]] == ["Alice", "Bob"]
+    assert first["attributes"] == {"Type": "Routine"}
+    assert first["attachments"] == ["180101_100000_plot.png",
+                                    "180101_100000_data.txt"]
+    assert first["content_type"] == "text/plain; charset=utf-8"
+    assert first["metadata"]["original_elog_url"] == "Some+logbook/1"
+    assert "in_reply_to" not in first
+
+    reply = entries[("some-uuid", 2)]
+    assert reply["in_reply_to"] == ("some-uuid", 1)
+    assert reply["content"] == "\n<p>Reply</p>\n"
+    assert reply["content_type"] == "text/html; charset=utf-8"
+    assert "attachments" not in reply
+
+
+def test_checkpoint_resume(import_elog, tmpdir):
+    filename = str(tmpdir.join("checkpoint"))
+    checkpoint = import_elog.Checkpoint(filename)
+    checkpoint.add({"logbook": "some-uuid", "id": 1})
+    checkpoint.add({"entry": ["some-uuid", 1], "id": 10},
+                   {"entry": ["some-uuid", 2], "id": 11})
+    checkpoint.add({"attachment": ["some-uuid", 1, "plot.png"]})
+    checkpoint.close()
+
+    # as if we crashed in the middle of writing a line
+    with open(filename, "a") as f:
+        f.write(json.dumps({"entry": ["some-uuid", 4], "id": 12})[:-5])
+
+    checkpoint = import_elog.Checkpoint(filename)
+    assert checkpoint.logbooks == {"some-uuid": 1}
+    assert checkpoint.entries == {("some-uuid", 1): 10,
+                                  ("some-uuid", 2): 11}
+    assert checkpoint.attachments == {("some-uuid", 1, "plot.png")}
+
+    # the broken line doesn't get in the way of new ones
+    checkpoint.add({"entry": ["some-uuid", 4], "id": 12})
+    checkpoint.close()
+    checkpoint = import_elog.Checkpoint(filename)
+    assert checkpoint.entries[("some-uuid", 4)] == 12
+    checkpoint.close()
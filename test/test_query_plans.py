@@ -0,0 +1,189 @@
+"""
+Check that the most common queries are able to use indexes, instead
+of scanning whole tables. This is done by running the actual code,
+recording the queries and asking SQLite how it would run them.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import re
+
+from .fixtures import db
+from elogy.db import Entry, Event, Logbook, get_changes_since
+
+
+# things that show up as "SCAN" in query plans, but are fine
+NOT_TABLES = {"CONSTANT", "thread"}
+
+
+@contextmanager
+def recorded_queries(db):
+    "Collect all SELECT queries run inside the block"
+    queries = []
+    execute_sql = db.execute_sql
+
+    def recording_execute_sql(sql, params=None, *args, **kwargs):
+        if sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            queries.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    db.execute_sql = recording_execute_sql
+    try:
+        yield queries
+    finally:
+        del db.execute_sql  # back to the method
+
+
+def query_plan(db, sql, params):
+    return [row[-1] for row in
+            db.execute_sql("EXPLAIN QUERY PLAN " + sql, params or ())]
+
+
+def full_scans(plan):
+    for detail in plan:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", detail)
+        if (match and match.group(1) not in NOT_TABLES
+                and "INDEX" not in match.group(2)):
+            yield detail
+
+
+def check_plans(db, queries, sorted=False):
+    """Fail if any of the queries would scan a whole table, or
+    (if sorted is set) need to sort its results."""
+    assert queries
+    for sql, params in queries:
+        plan = query_plan(db, sql, params)
+        assert not list(full_scans(plan)), (sql, plan)
+        if sorted:
+            assert not any("TEMP B-TREE FOR ORDER BY" in detail
+                           for detail in plan), (sql, plan)
+
+
+def make_entries(lb, n=5):
+    created_at = datetime(2017, 1, 1, 12, 0, 0)
+    entries = [Entry.create(logbook=lb, title="Entry {}".format(i),
+                            authors=[{"name": "Author"}],
+                            created_at=created_at + timedelta(hours=i))
+               for i in range(n)]
+    Entry.create(logbook=lb, title="Followup", follows=entries[0])
+    return entries
+
+
+def test_query_plan_listing(db):
+    parent = Logbook.create(name="Parent")
+    lb = Logbook.create(name="Logbook", parent=parent)
+    make_entries(lb)
+    last = list(Entry.search(logbook=lb))[-1]
+    after = (last.priority, last.timestamp, last.id)
+    for kwargs in [dict(logbook=lb),
+                   dict(logbook=lb, child_logbooks=True),
+                   dict(logbook=parent, child_logbooks=True),
+                   dict(),
+                   dict(logbook=lb, after=after),
+                   dict(logbook=lb, child_logbooks=True, after=after)]:
+        with recorded_queries(db) as queries:
+            list(Entry.search(n=3, **kwargs))
+        check_plans(db, queries, sorted=True)
+        # counting has to go through all the results anyway
+        with recorded_queries(db) as queries:
+            Entry.search_with_count(n=3, **kwargs)
+        check_plans(db, queries)
+
+
+def test_query_plan_search(db):
+    lb = Logbook.create(name="Logbook")
+    make_entries(lb)
+    for kwargs in [dict(title_filter="Entry"),
+                   dict(content_filter="[Ee]ntry"),
+                   dict(author_filter="Auth"),
+                   dict(attachment_filter="png")]:
+        with recorded_queries(db) as queries:
+            list(Entry.search(logbook=lb, child_logbooks=True, n=3,
+                              **kwargs))
+        check_plans(db, queries)
+
+
+def test_query_plan_next_previous(db):
+    lb = Logbook.create(name="Logbook")
+    entries = make_entries(lb)
+    with recorded_queries(db) as queries:
+        assert entries[2].next.id == entries[3].id
+        assert entries[2].previous.id == entries[1].id
+    check_plans(db, queries, sorted=True)
+
+
+def test_query_plan_lock(db):
+    lb = Logbook.create(name="Logbook")
+    entry, *_ = make_entries(lb)
+    entry.get_lock(ip="1.2.3.4", acquire=True)
+    with recorded_queries(db) as queries:
+        assert entry.get_lock().owned_by_ip == "1.2.3.4"
+    check_plans(db, queries)
+
+
+def test_query_plan_changes(db):
+    lb = Logbook.create(name="Logbook")
+    entry, *_ = make_entries(lb)
+    for i in range(3):
+        change = entry.make_change(title="Changed {}".format(i))
+        entry.save()
+        change.save()
+        lb.make_change(name="Changed {}".format(i)).save()
+        lb.save()
+    with recorded_queries(db) as queries:
+        entry.get_changes()
+        entry.get_revision(1)
+        lb.get_changes()
+        lb.get_revision(1)
+    check_plans(db, queries)
+
+
+def test_query_plan_thread(db):
+    lb = Logbook.create(name="Logbook")
+    entry, *_ = make_entries(lb)
+    followup = entry.followups.get()
+    with recorded_queries(db) as queries:
+        thread = followup._thread
+        thread.prefetch_followups()
+        Entry.prefetch_related([thread])
+    check_plans(db, queries)
+
+
+def test_query_plan_change_counts(db):
+    parent = Logbook.create(name="Parent")
+    lb = Logbook.create(name="Logbook", parent=parent)
+    with recorded_queries(db) as queries:
+        Logbook.get_change_counts(lb.id)
+    check_plans(db, queries)
+
+
+def test_query_plan_events(db):
+    parent = Logbook.create(name="Parent")
+    lb = Logbook.create(name="Logbook", parent=parent)
+    Event.create(kind="new_logbook", logbook=lb)
+    with recorded_queries(db) as queries:
+        Event.since(0)
+        Event.since(0, parent.id)
+        Event.last_id()
+    check_plans(db, queries)
+
+
+def test_query_plan_changes_since(db):
+    parent = Logbook.create(name="Parent")
+    lb = Logbook.create(name="Logbook", parent=parent)
+    make_entries(lb)
+    with recorded_queries(db) as queries:
+        get_changes_since(3)
+        get_changes_since(3, parent.id)
+    check_plans(db, queries)
+
+
+def test_query_plan_export(db):
+    from elogy.export import iter_entries
+    parent = Logbook.create(name="Parent")
+    lb = Logbook.create(name="Logbook", parent=parent)
+    make_entries(lb)
+    with recorded_queries(db) as queries:
+        list(iter_entries(logbook=parent, child_logbooks=True))
+    # no sorting, so nothing needs to be kept around
+    check_plans(db, queries, sorted=True)